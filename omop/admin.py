@@ -299,10 +299,12 @@ class OncologyEpisodeDetailAdmin(admin.ModelAdmin):
 @admin.register(TrialArm)
 class TrialArmAdmin(admin.ModelAdmin):
     list_display = ("trial_arm_id", "nct_number", "arm_name", "arm_code", "arm_type", "status", 
-                   "n_patients", "enrollment_start_date", "last_data_cut")
+                   "n_patients", "enrollment_start_date", "last_data_cut", "current_safety_score",
+                   "current_safety_category")
     search_fields = ("nct_number", "arm_name", "arm_code")
-    list_filter = ("status", "arm_type", "enrollment_start_date")
-    readonly_fields = ("created_at", "updated_at")
+    list_filter = ("status", "arm_type", "enrollment_start_date", "current_safety_category")
+    readonly_fields = ("current_data_cut_date", "current_safety_score", "current_web", "current_eair",
+                       "current_safety_category", "created_at", "updated_at")
 
 @admin.register(AdverseEvent)
 class AdverseEventAdmin(admin.ModelAdmin):
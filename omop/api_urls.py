@@ -8,7 +8,8 @@ from .api_views import (
     TrialArmViewSet,
     AdverseEventViewSet,
     TrialArmSafetyMetricsViewSet,
-    trial_matching
+    trial_matching,
+    safety_sweep
 )
 
 # Create router and register viewsets
@@ -21,6 +22,9 @@ urlpatterns = [
     # Trial matching endpoint
     path('trial-matching/', trial_matching, name='trial-matching'),
     
+    # What-if safety scoring across WEB thresholds and grade weights
+    path('safety-sweep/', safety_sweep, name='safety-sweep'),
+    
     # Include router URLs
     path('', include(router.urls)),
 ]
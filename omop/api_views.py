@@ -4,14 +4,28 @@ API Views for EXACTOMOP Safety Scoring
 
 from rest_framework import viewsets, status
 from rest_framework.decorators import action, api_view
+from rest_framework.exceptions import NotFound, ParseError
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
-from django.db.models import Q, Prefetch
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.parsers import JSONParser
+from rest_framework.utils.urls import replace_query_param
+from django.conf import settings
+from django.db.models import F, Q, Prefetch
+from django.http import StreamingHttpResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_date
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
+import csv
+import json
 
 from .models_safety import TrialArm, AdverseEvent, TrialArmSafetyMetrics
+from .safety_engine import (
+    DEFAULT_GRADE_WEIGHTS, SafetyScoreSweep, load_grade_counts,
+    parse_grade_weights, parse_h_values
+)
 from .serializers import (
-    TrialArmSerializer, AdverseEventSerializer, 
+    TrialArmSerializer, AdverseEventSerializer, AdverseEventBulkSerializer,
     TrialArmSafetyMetricsSerializer, TrialMatchingResponseSerializer
 )
 
@@ -23,17 +37,121 @@ class StandardResultsSetPagination(PageNumberPagination):
     max_page_size = 100
 
 
+class AdverseEventKeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination for adverse events, newest first.
+    
+    Pages are selected with WHERE (event_date, adverse_event_id) < cursor
+    instead of OFFSET and no COUNT(*) is issued, so deep pages cost the same
+    as the first. Only a "next" link is provided.
+    """
+    page_size = 25
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    ordering = ('-event_date', '-adverse_event_id')
+    
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            event_date, adverse_event_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(event_date__lt=event_date) |
+                Q(event_date=event_date, adverse_event_id__lt=adverse_event_id)
+            )
+        
+        # Fetch one extra row to learn whether there is a next page
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[:self.page_size]
+        self.last = results[-1] if results else None
+        return results
+    
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+    
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param,
+            self.encode_cursor(self.last.event_date, self.last.adverse_event_id)
+        )
+    
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data,
+        })
+    
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+    
+    def encode_cursor(self, event_date, adverse_event_id):
+        """Encode a (event_date, adverse_event_id) position as an opaque token."""
+        raw = f"{event_date.isoformat()}|{adverse_event_id}"
+        return urlsafe_b64encode(raw.encode()).decode()
+    
+    def decode_cursor(self, cursor):
+        """Decode a cursor token, raising NotFound if it is malformed."""
+        try:
+            event_date, adverse_event_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+            event_date = parse_date(event_date)
+            adverse_event_id = int(adverse_event_id)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+        if event_date is None:
+            raise NotFound('Invalid cursor')
+        return event_date, adverse_event_id
+
+
+class NDJSONParser(JSONParser):
+    """Parse newline-delimited JSON into a list, one object per line."""
+    media_type = 'application/x-ndjson'
+    
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        rows = []
+        for line_number, line in enumerate(stream.read().decode(encoding).splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError as exc:
+                raise ParseError(f'NDJSON parse error on line {line_number}: {exc}')
+        return rows
+
+
 class TrialArmViewSet(viewsets.ModelViewSet):
     """
     ViewSet for Trial Arms with safety metrics.
     
     Endpoints:
     - GET /api/trial-arms/ - List all trial arms
+      (supports ?min_safety_score= and ?ordering=safety_score|-safety_score)
     - GET /api/trial-arms/{id}/ - Get specific trial arm
     - GET /api/trial-arms/{id}/safety-metrics/ - Get all safety metrics for an arm
     - GET /api/trial-arms/{id}/adverse-events/ - Get all adverse events for an arm
     """
-    queryset = TrialArm.objects.all().prefetch_related('safety_metrics')
+    queryset = TrialArm.objects.all().with_latest_metrics()
     serializer_class = TrialArmSerializer
     pagination_class = StandardResultsSetPagination
     
@@ -51,16 +169,23 @@ class TrialArmViewSet(viewsets.ModelViewSet):
         if nct_number:
             queryset = queryset.filter(nct_number=nct_number)
         
-        # Filter by minimum safety score
+        # Filter by minimum safety score (current snapshot, indexed)
         min_safety_score = self.request.query_params.get('min_safety_score', None)
         if min_safety_score:
-            # Get trial arms with latest safety score >= threshold
-            trial_arm_ids = []
-            for arm in queryset:
-                latest = arm.safety_metrics.order_by('-data_cut_date').first()
-                if latest and float(latest.safety_score) >= float(min_safety_score):
-                    trial_arm_ids.append(arm.trial_arm_id)
-            queryset = queryset.filter(trial_arm_id__in=trial_arm_ids)
+            queryset = queryset.filter(current_safety_score__gte=float(min_safety_score))
+        
+        # Order by current safety score; arms without metrics sort last
+        ordering = self.request.query_params.get('ordering', None)
+        if ordering == 'safety_score':
+            queryset = queryset.order_by(
+                F('current_safety_score').asc(nulls_last=True), 'trial_arm_id'
+            )
+        elif ordering == '-safety_score':
+            queryset = queryset.order_by(
+                F('current_safety_score').desc(nulls_last=True), 'trial_arm_id'
+            )
+        else:
+            queryset = queryset.order_by('trial_arm_id')
         
         return queryset
     
@@ -87,14 +212,29 @@ class AdverseEventViewSet(viewsets.ModelViewSet):
     
     Endpoints:
     - GET /api/adverse-events/ - List all adverse events
+      (?pagination=keyset for cursor pagination without a total count)
     - POST /api/adverse-events/ - Create new adverse event
     - GET /api/adverse-events/{id}/ - Get specific adverse event
     - PUT /api/adverse-events/{id}/ - Update adverse event
     - DELETE /api/adverse-events/{id}/ - Delete adverse event
+    - GET /api/adverse-events/export/ - Stream all matching events as NDJSON or CSV
+    - POST /api/adverse-events/bulk/ - Create many events from a JSON array or NDJSON
     """
     queryset = AdverseEvent.objects.all().select_related('person', 'trial_arm')
     serializer_class = AdverseEventSerializer
     pagination_class = StandardResultsSetPagination
+    export_chunk_size = 2000
+    
+    @property
+    def paginator(self):
+        """Use keyset pagination when requested with ?pagination=keyset."""
+        if not hasattr(self, '_paginator'):
+            request = getattr(self, 'request', None)
+            if request is not None and request.query_params.get('pagination') == 'keyset':
+                self._paginator = AdverseEventKeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
     
     def get_queryset(self):
         """Filter adverse events by query parameters."""
@@ -121,6 +261,118 @@ class AdverseEventViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(person_id=int(person_id))
         
         return queryset
+    
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Stream every adverse event matching the list filters.
+        
+        Rows are read with a server-side cursor in chunks of export_chunk_size
+        and written as they are read, so memory use does not grow with the
+        result size.
+        
+        Query Parameters:
+        - export_format: ndjson (default) or csv
+        - grade, serious, trial_arm_id, person_id: Same filters as the list
+        """
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            return Response(
+                {'error': "export_format must be 'ndjson' or 'csv'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        fields = AdverseEventSerializer.Meta.fields
+        # Foreign keys are exported as IDs under their serializer field names
+        columns = [
+            f'{field}_id' if field in ('person', 'trial_arm') else field
+            for field in fields
+        ]
+        rows = self.get_queryset().select_related(None).order_by(
+            'adverse_event_id'
+        ).values_list(*columns).iterator(chunk_size=self.export_chunk_size)
+        
+        if export_format == 'csv':
+            content = _stream_csv(fields, rows, self.export_chunk_size)
+            content_type = 'text/csv'
+        else:
+            content = _stream_ndjson(fields, rows, self.export_chunk_size)
+            content_type = 'application/x-ndjson'
+        
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="adverse_events.{export_format}"'
+        )
+        return response
+    
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Create many adverse events in one request.
+        
+        Accepts a JSON array (application/json) or one event per line
+        (application/x-ndjson). Either every row is created or, if any row is
+        invalid, none are and the errors are returned by row index.
+        """
+        serializer = AdverseEventBulkSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            errors = serializer.errors
+            if 'non_field_errors' in errors:
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            return Response(
+                {'errors': [
+                    {'row': index, 'errors': row_errors}
+                    for index, row_errors in sorted(errors.items())
+                ]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        events = serializer.save()
+        
+        return Response({
+            'created': len(events),
+            'adverse_event_ids': [event.adverse_event_id for event in events],
+        }, status=status.HTTP_201_CREATED)
+
+
+def _export_value(value):
+    """Render dates and datetimes as ISO 8601 for export."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _stream_ndjson(fields, rows, chunk_size):
+    """Yield newline-delimited JSON, one object per row, in chunk_size batches."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(fields, map(_export_value, row)))) + '\n')
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+class _Echo:
+    """File-like object whose write() returns the value, for csv.writer."""
+    
+    def write(self, value):
+        return value
+
+
+def _stream_csv(fields, rows, chunk_size):
+    """Yield a CSV header and rows in chunk_size batches."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    lines = []
+    for row in rows:
+        lines.append(writer.writerow([_export_value(value) for value in row]))
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
 
 
 class TrialArmSafetyMetricsViewSet(viewsets.ReadOnlyModelViewSet):
@@ -208,21 +460,16 @@ def trial_matching(request):
         # Query active trial arms
         trial_arms = TrialArm.objects.filter(
             status__in=['ACTIVE', 'ENDED']
-        ).prefetch_related('safety_metrics')
+        ).with_latest_metrics()
         
         # Filter by minimum safety score if specified
         if min_safety_score > 0:
-            trial_arm_ids = []
-            for arm in trial_arms:
-                latest = arm.safety_metrics.order_by('-data_cut_date').first()
-                if latest and float(latest.safety_score) >= min_safety_score:
-                    trial_arm_ids.append(arm.trial_arm_id)
-            trial_arms = trial_arms.filter(trial_arm_id__in=trial_arm_ids)
+            trial_arms = trial_arms.filter(current_safety_score__gte=min_safety_score)
         
         # Build response with safety scoring
         results = []
         for arm in trial_arms:
-            latest_metrics = arm.safety_metrics.order_by('-data_cut_date').first()
+            safety_score = arm.current_safety_score
             
             # Calculate match score (simplified - extend with real matching logic)
             match_score = 0.8  # Placeholder
@@ -232,13 +479,13 @@ def trial_matching(request):
                 'trial_arm': TrialArmSerializer(arm).data,
                 'match_score': match_score,
                 'match_reasons': match_reasons,
-                'safety_score': float(latest_metrics.safety_score) if latest_metrics else None,
-                'safety_category': _get_safety_category(latest_metrics) if latest_metrics else None,
-                'web': float(latest_metrics.web) if latest_metrics else None,
-                'eair': float(latest_metrics.eair) if latest_metrics and latest_metrics.eair else None,
+                'safety_score': float(safety_score) if safety_score is not None else None,
+                'safety_category': arm.current_safety_category or None,
+                'web': float(arm.current_web) if arm.current_web is not None else None,
+                'eair': float(arm.current_eair) if arm.current_eair else None,
                 'recommended': (
-                    latest_metrics and 
-                    float(latest_metrics.safety_score) >= 60 and 
+                    safety_score is not None and 
+                    float(safety_score) >= 60 and 
                     match_score >= 0.7
                 )
             }
@@ -263,47 +510,81 @@ def trial_matching(request):
         min_safety_score = float(request.query_params.get('min_safety_score', 0))
         max_results = int(request.query_params.get('max_results', 25))
         
+        # Arms without safety metrics have no current score and are skipped
         trial_arms = TrialArm.objects.filter(
-            status=status_filter
-        ).prefetch_related('safety_metrics')
+            status=status_filter,
+            current_safety_score__isnull=False,
+            current_safety_score__gte=min_safety_score,
+        ).order_by('-current_safety_score', 'trial_arm_id').with_latest_metrics()[:max_results]
         
         results = []
         for arm in trial_arms:
-            latest_metrics = arm.safety_metrics.order_by('-data_cut_date').first()
-            
-            # Skip if no safety metrics or below threshold
-            if not latest_metrics:
-                continue
-            if float(latest_metrics.safety_score) < min_safety_score:
-                continue
-            
             result = {
                 'trial_arm': TrialArmSerializer(arm).data,
-                'safety_score': float(latest_metrics.safety_score),
-                'safety_category': _get_safety_category(latest_metrics),
-                'web': float(latest_metrics.web),
-                'eair': float(latest_metrics.eair) if latest_metrics.eair else None,
+                'safety_score': float(arm.current_safety_score),
+                'safety_category': arm.current_safety_category or None,
+                'web': float(arm.current_web),
+                'eair': float(arm.current_eair) if arm.current_eair else None,
             }
             results.append(result)
         
-        # Sort by safety score
-        results.sort(key=lambda x: x['safety_score'], reverse=True)
-        results = results[:max_results]
-        
         return Response(results)
 
 
-def _get_safety_category(metrics):
-    """Helper function to categorize safety score."""
-    if not metrics:
-        return None
-    score = float(metrics.safety_score)
-    if score >= 80:
-        return "LOW_RISK"
-    elif score >= 60:
-        return "MODERATE_RISK"
-    elif score >= 40:
-        return "ELEVATED_RISK"
-    else:
-        return "HIGH_RISK"
+@api_view(['GET'])
+def safety_sweep(request):
+    """
+    What-if safety scoring across WEB thresholds and grade weights.
+    
+    GET /api/safety-sweep/ - Score every arm's latest metrics for each H value
+    and grade weighting in one vectorized pass
+    
+    Query Parameters:
+    - h: Comma-separated WEB thresholds (default: settings.SAFETY_WEB_THRESHOLD)
+    - weights: Comma-separated grade 1-2:3-4:5 weights (default: 1:10:100)
+    - status: Filter by trial arm status
+    
+    Response:
+    {
+        "h_values": [10.0, 15.0],
+        "grade_weights": [[1.0, 10.0, 100.0]],
+        "arms": [
+            {
+                "trial_arm_id": 1,
+                "arm_code": "ARM_A",
+                "e1_2_count": 5, "e3_4_count": 1, "e5_count": 0,
+                "results": [
+                    {"grade_weights": [1.0, 10.0, 100.0], "h": 10.0, "web": 15.0,
+                     "safety_score": 40.0, "safety_category": "ELEVATED_RISK", "rank": 2},
+                    ...
+                ]
+            }
+        ]
+    }
+    """
+    try:
+        h_values = parse_h_values(
+            request.query_params.get('h', str(getattr(settings, 'SAFETY_WEB_THRESHOLD', 15.0)))
+        )
+        grade_weights = parse_grade_weights(
+            request.query_params.get('weights', ':'.join(str(w) for w in DEFAULT_GRADE_WEIGHTS))
+        )
+        trial_arms = TrialArm.objects.all()
+        status_filter = request.query_params.get('status', None)
+        if status_filter:
+            trial_arms = trial_arms.filter(status=status_filter)
+
+        trial_arm_ids, counts = load_grade_counts(trial_arms)
+        sweep = SafetyScoreSweep(trial_arm_ids, counts, h_values, grade_weights)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    data = sweep.to_dict()
+    arm_codes = dict(
+        TrialArm.objects.filter(trial_arm_id__in=trial_arm_ids.tolist())
+        .values_list('trial_arm_id', 'arm_code')
+    )
+    for arm in data['arms']:
+        arm['arm_code'] = arm_codes.get(arm['trial_arm_id'])
 
+    return Response(data)
@@ -2,3 +2,7 @@ from django.apps import AppConfig
 class OmopConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "omop"
+
+    def ready(self):
+        from .change_log import connect_change_log
+        connect_change_log()
@@ -0,0 +1,133 @@
+"""
+Change Log for EXACTOMOP
+Records which persons' OMOP data changed in PatientChangeLog, so PatientInfo
+consumers can read the persons changed since their watermark with one indexed
+range query instead of guessing from clinical dates.
+"""
+
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Max, Min
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from .models import PatientChangeLog, PatientChangeWatermark, PatientInfo, Person
+
+
+# How long a transaction that logged a change may stay open before committing.
+# change_id is taken from a sequence when the row is inserted, not when it
+# commits, so a lower id can become visible after a higher one.
+CHANGE_LOG_GRACE = timedelta(minutes=5)
+
+
+def tracked_models():
+    """Person and every OMOP CDM model with a person FK, except PatientInfo."""
+    models = [Person]
+    for model in apps.get_app_config('omop').get_models():
+        # Safety scoring models live in models_safety and do not feed PatientInfo
+        if model is PatientInfo or model.__module__ != Person.__module__:
+            continue
+        try:
+            field = model._meta.get_field('person')
+        except FieldDoesNotExist:
+            continue
+        if field.is_relation and field.related_model is Person:
+            models.append(model)
+    return models
+
+
+def record_person_change(sender, instance, **kwargs):
+    """Log a save or delete of a person-keyed row."""
+    person_id = instance.pk if sender is Person else instance.person_id
+    if person_id is not None:
+        PatientChangeLog.objects.create(person_id=person_id, table_name=sender._meta.db_table)
+
+
+def connect_change_log():
+    """
+    Connect the change handlers; called from OmopConfig.ready().
+
+    bulk_create, bulk_update, QuerySet.update() and raw SQL send no signals;
+    loaders using them should call log_person_changes() themselves.
+    """
+    for model in tracked_models():
+        post_save.connect(
+            record_person_change, sender=model,
+            dispatch_uid=f'change_log_save_{model.__name__}'
+        )
+        post_delete.connect(
+            record_person_change, sender=model,
+            dispatch_uid=f'change_log_delete_{model.__name__}'
+        )
+
+
+def log_person_changes(person_ids, table_name):
+    """Log changes made without model signals, one row per person."""
+    PatientChangeLog.objects.bulk_create([
+        PatientChangeLog(person_id=person_id, table_name=table_name)
+        for person_id in set(person_ids)
+    ])
+
+
+def latest_change_id():
+    """Highest change_id logged so far, or 0."""
+    return PatientChangeLog.objects.aggregate(latest=Max('change_id'))['latest'] or 0
+
+
+def settled_change_id(grace=CHANGE_LOG_GRACE):
+    """
+    Highest change_id logged more than grace ago, or 0.
+
+    Ids up to it are taken to be committed, which is safe as a watermark as
+    long as no transaction stays open longer than grace after logging a
+    change. MAX(change_id) is not: an open transaction may still commit a
+    lower id after it is read. Reads one entry of the (changed_at, change_id)
+    index, however many changes were logged within the grace period.
+    """
+    return PatientChangeLog.objects.filter(
+        changed_at__lt=timezone.now() - grace
+    ).order_by('-changed_at', '-change_id').values_list('change_id', flat=True).first() or 0
+
+
+def get_watermark(consumer):
+    """Last change_id processed by a consumer, or 0 if it has never run."""
+    return PatientChangeWatermark.objects.filter(consumer=consumer).values_list(
+        'last_change_id', flat=True
+    ).first() or 0
+
+
+def advance_watermark(consumer, change_id):
+    """Record that a consumer has processed all changes up to change_id."""
+    PatientChangeWatermark.objects.update_or_create(
+        consumer=consumer, defaults={'last_change_id': change_id}
+    )
+
+
+def prune_change_log():
+    """
+    Delete the change rows every consumer has processed, i.e. at or below the
+    lowest watermark, and return how many were deleted.
+
+    Nothing is deleted until some consumer has a watermark. A consumer added
+    later starts from the rows still logged, so create its watermark (with
+    advance_watermark(consumer, 0)) before the others prune past what it needs.
+    """
+    lowest = PatientChangeWatermark.objects.aggregate(lowest=Min('last_change_id'))['lowest']
+    if not lowest:
+        return 0
+    deleted, _ = PatientChangeLog.objects.filter(change_id__lte=lowest).delete()
+    return deleted
+
+
+def changed_person_ids(after, upto):
+    """
+    Person IDs with changes in (after, upto], as a values queryset.
+
+    The range is on the primary key, so the lookup is an index range scan;
+    use it as a subquery, e.g. person_id__in=changed_person_ids(...).
+    """
+    return PatientChangeLog.objects.filter(
+        change_id__gt=after, change_id__lte=upto
+    ).values('person_id')
@@ -0,0 +1,218 @@
+"""
+Concept Classifier for EXACTOMOP
+Maps measurement concept IDs to the PatientInfo lab field or oncology biomarker
+they represent, and condition concept IDs to whether they are cancers, so
+classifying an OMOP row is a dict or set lookup instead of keyword matching on
+its concept name.
+"""
+
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+
+from .models import Concept, ICDOMorphologyConcept, MeasurementConcept, OncologyConcept
+
+
+# Lab keyword rules in priority order: (target field, name keywords), including
+# the abbreviations update_patient_info has always matched
+LAB_RULES = [
+    ('hemoglobin_level', ('hemoglobin', 'hgb')),
+    ('hematocrit', ('hematocrit', 'hct')),  # No PatientInfo column; kept in the OMOP data only
+    ('platelet_count', ('platelet', 'plt')),
+    ('white_blood_cell_count', ('white blood cell', 'wbc', 'leukocyte')),
+    ('serum_creatinine_level', ('creatinine',)),
+    ('serum_bilirubin_level_total', ('bilirubin',)),
+    ('albumin_level', ('albumin',)),
+]
+
+# PatientInfo columns populated from LAB_RULES
+PATIENT_INFO_LAB_FIELDS = [
+    'hemoglobin_level', 'platelet_count', 'white_blood_cell_count',
+    'serum_creatinine_level', 'serum_bilirubin_level_total', 'albumin_level',
+]
+
+# Oncology biomarker keyword rules in priority order: (biomarker, name keywords)
+BIOMARKER_RULES = [
+    ('her2', ('her2',)),
+    ('er', ('estrogen receptor', 'er status')),
+    ('pr', ('progesterone receptor', 'pr status')),
+    ('tmb', ('tumor mutational burden', 'tmb')),
+    ('msi', ('microsatellite', 'msi')),
+]
+
+
+# OMOP domain of the concepts the lab and biomarker rules apply to
+MEASUREMENT_DOMAIN = 'Measurement'
+
+# Condition concept name keywords that indicate a cancer diagnosis
+CANCER_KEYWORDS = (
+    'cancer', 'carcinoma', 'adenocarcinoma', 'sarcoma', 'lymphoma',
+    'leukemia', 'melanoma', 'tumor', 'neoplasm', 'malignant',
+)
+
+
+def _match(rules, concept_name):
+    """Return the first rule target whose keywords occur in the concept name."""
+    name = (concept_name or '').lower()
+    for target, keywords in rules:
+        if any(keyword in name for keyword in keywords):
+            return target
+    return None
+
+
+class ConceptClassifier:
+    """
+    concept_id -> lab field and concept_id -> biomarker lookup tables.
+
+    Concepts absent from a table match no rule. Explicit
+    MeasurementConcept.patient_info_field mappings take precedence over the
+    keyword rules for lab fields.
+    """
+
+    def __init__(self, concepts, explicit_fields=None):
+        self.lab_fields = {}
+        self.biomarkers = {}
+        for concept_id, concept_name in concepts:
+            lab_field = _match(LAB_RULES, concept_name)
+            if lab_field:
+                self.lab_fields[concept_id] = lab_field
+            biomarker = _match(BIOMARKER_RULES, concept_name)
+            if biomarker:
+                self.biomarkers[concept_id] = biomarker
+        self.lab_fields.update(explicit_fields or {})
+
+    def lab_field(self, concept_id):
+        """Lab field a measurement concept populates, or None."""
+        return self.lab_fields.get(concept_id)
+
+    def biomarker(self, concept_id):
+        """Biomarker a measurement concept reports, or None."""
+        return self.biomarkers.get(concept_id)
+
+    def concept_ids_for(self, lab_fields):
+        """Concept IDs that populate any of the given lab fields."""
+        lab_fields = set(lab_fields)
+        return [
+            concept_id for concept_id, field in self.lab_fields.items()
+            if field in lab_fields
+        ]
+
+
+def _name_filter(keywords):
+    """Q matching concept names that contain any of the keywords."""
+    name_filter = Q()
+    for keyword in keywords:
+        name_filter |= Q(concept_name__icontains=keyword)
+    return name_filter
+
+
+def lab_concepts(lab_fields=None):
+    """
+    Concepts that may populate any of lab_fields (every lab field when None),
+    as a queryset to use as a subquery, e.g.
+    measurement_concept_id__in=lab_concepts().
+
+    A superset of the classifier's mapping: a name matching several rules is
+    classified by the first, and explicit mappings override names, so check
+    ConceptClassifier.lab_field() on the rows it selects.
+    """
+    explicit = MeasurementConcept.objects.all()
+    rules = LAB_RULES
+    if lab_fields is not None:
+        lab_fields = set(lab_fields)
+        explicit = explicit.filter(patient_info_field__in=lab_fields)
+        rules = [(field, keywords) for field, keywords in LAB_RULES if field in lab_fields]
+
+    concept_filter = Q(concept_id__in=explicit.values('concept_id'))
+    if rules:
+        concept_filter |= Q(
+            _name_filter(keyword for _, keywords in rules for keyword in keywords),
+            domain_id=MEASUREMENT_DOMAIN
+        )
+    return Concept.objects.filter(concept_filter).values('concept_id')
+
+
+def cancer_concepts():
+    """
+    Concepts that denote a cancer diagnosis, as a queryset.
+
+    A concept qualifies if its name contains a cancer keyword, it is a
+    malignant ICD-O morphology, or it is an oncology histology concept. Use it
+    as a subquery, e.g. condition_concept_id__in=cancer_concepts().
+    """
+    return Concept.objects.filter(
+        _name_filter(CANCER_KEYWORDS)
+        | Q(concept_id__in=ICDOMorphologyConcept.objects.filter(
+            behavior_code='3'
+        ).values('concept_id'))
+        | Q(concept_id__in=OncologyConcept.objects.filter(
+            oncology_category='histology'
+        ).values('concept_id'))
+    ).values('concept_id')
+
+
+_classifier = None
+_cancer_concept_ids = None
+
+
+def get_concept_classifier():
+    """
+    Return the process-wide classifier, building it on first use.
+
+    Only Measurement-domain concepts whose names contain a rule keyword are
+    loaded, with one query, so procedures, drugs or conditions that happen to
+    share a keyword ('hct', 'msi', ...) are never classified as labs.
+    MeasurementConcept mappings apply regardless of domain.
+    """
+    global _classifier
+    if _classifier is None:
+        keywords = {
+            keyword
+            for _, rule_keywords in LAB_RULES + BIOMARKER_RULES
+            for keyword in rule_keywords
+        }
+        _classifier = ConceptClassifier(
+            Concept.objects.filter(_name_filter(keywords), domain_id=MEASUREMENT_DOMAIN).values_list(
+                'concept_id', 'concept_name'
+            ),
+            dict(MeasurementConcept.objects.values_list('concept_id', 'patient_info_field')),
+        )
+    return _classifier
+
+
+def get_cancer_concept_ids():
+    """Return the process-wide frozenset of cancer concept IDs, loading it on first use."""
+    global _cancer_concept_ids
+    if _cancer_concept_ids is None:
+        _cancer_concept_ids = frozenset(
+            cancer_concepts().values_list('concept_id', flat=True)
+        )
+    return _cancer_concept_ids
+
+
+def is_cancer_condition(condition):
+    """Check if a condition occurrence is a cancer diagnosis."""
+    return condition.condition_concept_id in get_cancer_concept_ids()
+
+
+def invalidate_concept_classifier(**kwargs):
+    """
+    Drop the cached classifier and cancer concept set so they are rebuilt on
+    next use.
+
+    Connected to vocabulary model saves and deletes; call it directly after
+    bulk vocabulary loads, which send no signals.
+    """
+    global _classifier, _cancer_concept_ids
+    _classifier = None
+    _cancer_concept_ids = None
+
+
+for _model in (Concept, MeasurementConcept, ICDOMorphologyConcept, OncologyConcept):
+    post_save.connect(
+        invalidate_concept_classifier, sender=_model,
+        dispatch_uid=f'invalidate_concept_classifier_save_{_model.__name__}'
+    )
+    post_delete.connect(
+        invalidate_concept_classifier, sender=_model,
+        dispatch_uid=f'invalidate_concept_classifier_delete_{_model.__name__}'
+    )
@@ -2,18 +2,147 @@
 Django management command to compute safety scores for trial arms.
 
 Usage:
-    python manage.py compute_safety_scores [--force] [--verbosity=2]
+    python manage.py compute_safety_scores [--force] [--chunk-size=500] [--workers=N] [--verbosity=2]
+    python manage.py compute_safety_scores --data-cuts=2024-01-01:2025-06-01:monthly
+    python manage.py compute_safety_scores --changed-only
+    python manage.py compute_safety_scores --sweep-h=5,10,15,20,30
 """
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.models import Count, Q, Value
+from django.db.models.functions import Coalesce, Least
 from django.utils import timezone
 from datetime import datetime, timedelta
 from decimal import Decimal
 from collections import defaultdict
+import calendar
+import math
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import time
+import traceback
+
+import django
 
 from omop.models_safety import TrialArm, AdverseEvent, TrialArmSafetyMetrics
+from omop.safety_engine import SafetyScoreSweep, parse_h_values
+
+
+# Counts used for arms without any adverse events up to their data cut
+EMPTY_AE_COUNTS = {
+    'e1_2_count': 0,
+    'e3_4_count': 0,
+    'e5_count': 0,
+    'patients_with_any_ae': 0,
+    'total_ae_count': 0,
+}
+
+# Columns overwritten when a (trial_arm, data_cut_date) row already exists
+METRIC_UPDATE_FIELDS = [
+    'computation_date', 'analysis_period_start', 'analysis_period_end',
+    'person_years', 'n_patients', 'e1_2_count', 'e3_4_count', 'e5_count',
+    'total_ae_count', 'patients_with_any_ae', 'eair', 'web', 'safety_score',
+    'web_threshold_h', 'updated_at',
+]
+
+
+# Supported --data-cuts step names
+DATA_CUT_STEPS = ['weekly', 'monthly', 'quarterly', 'yearly']
+
+
+def _add_months(day, months):
+    """Add months to a date, clamping the day to the end of the target month."""
+    month_index = day.month - 1 + months
+    year = day.year + month_index // 12
+    month = month_index % 12 + 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def parse_data_cuts(spec):
+    """
+    Parse a START:END:STEP data cut spec (e.g. 2024-01-01:2025-06-01:monthly)
+    into the list of cut dates from START to END inclusive.
+    """
+    try:
+        start_text, end_text, step = spec.split(':')
+        start = datetime.strptime(start_text, '%Y-%m-%d').date()
+        end = datetime.strptime(end_text, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(
+            f"Invalid --data-cuts '{spec}': expected START:END:STEP with YYYY-MM-DD dates"
+        )
+    if step not in DATA_CUT_STEPS:
+        raise CommandError(
+            f"Invalid --data-cuts step '{step}': choose from {', '.join(DATA_CUT_STEPS)}"
+        )
+    if end < start:
+        raise CommandError(f"Invalid --data-cuts '{spec}': END is before START")
+
+    cut_dates = []
+    i = 0
+    while True:
+        if step == 'weekly':
+            cut_date = start + timedelta(weeks=i)
+        else:
+            months = {'monthly': 1, 'quarterly': 3, 'yearly': 12}[step]
+            cut_date = _add_months(start, months * i)
+        if cut_date > end:
+            break
+        cut_dates.append(cut_date)
+        i += 1
+    return cut_dates
+
+
+def arm_data_cut(trial_arm, today):
+    """
+    Latest data cut metrics may be computed at for an arm: its last_data_cut,
+    never later than today.
+    """
+    if trial_arm.last_data_cut:
+        return min(trial_arm.last_data_cut, today)
+    return today
+
+
+def partition_trial_arm_ids(trial_arm_ids, n_partitions):
+    """Split trial arm IDs into at most n_partitions contiguous, non-empty lists."""
+    size, remainder = divmod(len(trial_arm_ids), n_partitions)
+    partitions = []
+    start = 0
+    for i in range(n_partitions):
+        end = start + size + (1 if i < remainder else 0)
+        if end > start:
+            partitions.append(trial_arm_ids[start:end])
+        start = end
+    return partitions
+
+
+def _compute_partition(trial_arm_ids, web_threshold_h, today, cut_dates=None):
+    """
+    Process pool entry point: compute metrics for one partition of arms.
+    """
+    started = time.perf_counter()
+    try:
+        trial_arms = list(
+            TrialArm.objects.filter(trial_arm_id__in=trial_arm_ids).order_by('trial_arm_id')
+        )
+        computed_metrics, errors = Command().compute_metrics_for_arms(
+            trial_arms, web_threshold_h, today, cut_dates
+        )
+    finally:
+        # Release this worker's connection; never close the parent's
+        if multiprocessing.parent_process() is not None:
+            connections.close_all()
+
+    return {
+        'pid': os.getpid(),
+        'n_arms': len(trial_arms),
+        'seconds': time.perf_counter() - started,
+        'computed_metrics': computed_metrics,
+        'errors': errors,
+    }
 
 
 class Command(BaseCommand):
@@ -35,13 +164,87 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be computed without saving',
         )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='Number of metrics rows per bulk upsert statement (default: 500)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes used to compute metrics (default: 1)',
+        )
+        parser.add_argument(
+            '--data-cuts',
+            help=(
+                'Backfill metrics at a series of data cut dates, given as '
+                f"START:END:STEP with STEP one of {', '.join(DATA_CUT_STEPS)} "
+                '(implies --force)'
+            ),
+        )
+        parser.add_argument(
+            '--changed-only',
+            action='store_true',
+            help=(
+                'Only recompute arms whose adverse events or arm fields changed '
+                'since their metrics were last computed (replaces the monthly check)'
+            ),
+        )
+        parser.add_argument(
+            '--sweep-h',
+            help=(
+                'Comma-separated WEB thresholds (e.g. 5,10,15,20); report each arm\'s '
+                'safety score and rank at every H instead of saving metrics (implies --force)'
+            ),
+        )
 
     def handle(self, *args, **options):
         force = options.get('force', False)
         trial_arm_id = options.get('trial_arm_id')
         dry_run = options.get('dry_run', False)
+        chunk_size = options.get('chunk_size', 500)
+        workers = options.get('workers', 1)
+        data_cuts = options.get('data_cuts')
+        changed_only = options.get('changed_only', False)
+        sweep_h = options.get('sweep_h')
         verbosity = options.get('verbosity', 1)
 
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be a positive integer")
+        if workers < 1:
+            raise CommandError("--workers must be a positive integer")
+
+        # Get current month's first day for checking if already computed
+        today = timezone.now().date()
+        current_month_start = today.replace(day=1)
+
+        cut_dates = parse_data_cuts(data_cuts) if data_cuts else None
+        if cut_dates:
+            future_cuts = [cut_date for cut_date in cut_dates if cut_date > today]
+            if future_cuts:
+                self.stdout.write(self.style.WARNING(
+                    f"Skipping {len(future_cuts)} data cut(s) after today ({today})"
+                ))
+                cut_dates = [cut_date for cut_date in cut_dates if cut_date <= today]
+            if not cut_dates:
+                raise CommandError(f"Invalid --data-cuts '{data_cuts}': no cut dates on or before today")
+
+        h_values = None
+        if sweep_h:
+            try:
+                h_values = parse_h_values(sweep_h)
+            except ValueError:
+                raise CommandError(f"Invalid --sweep-h '{sweep_h}': expected numbers like 5,10,15")
+            if not h_values or not all(math.isfinite(h) and h > 0 for h in h_values):
+                raise CommandError("--sweep-h values must be finite and positive")
+            # Nothing is saved, so the monthly check does not apply
+            force = True
+        if cut_dates:
+            # A historical backfill always recomputes the requested cuts
+            force = True
+
         # Get the WEB threshold from settings
         web_threshold_h = Decimal(str(getattr(settings, 'SAFETY_WEB_THRESHOLD', 15.0)))
 
@@ -50,10 +253,6 @@ class Command(BaseCommand):
                 f"Starting safety score computation with WEB threshold H={web_threshold_h}"
             ))
 
-        # Get current month's first day for checking if already computed
-        today = timezone.now().date()
-        current_month_start = today.replace(day=1)
-
         # Query trial arms
         trial_arms_query = TrialArm.objects.filter(
             status__in=['ACTIVE', 'ENDED', 'COMPLETED']
@@ -62,8 +261,11 @@ class Command(BaseCommand):
         if trial_arm_id:
             trial_arms_query = trial_arms_query.filter(trial_arm_id=trial_arm_id)
 
-        # Filter out arms already computed this month unless --force
-        if not force:
+        # Filter out arms already computed this month unless --force;
+        # --changed-only replaces that check with a per-arm staleness check
+        if changed_only:
+            trial_arms_query = trial_arms_query.needs_safety_recompute()
+        elif not force:
             already_computed = TrialArmSafetyMetrics.objects.filter(
                 computation_date__gte=current_month_start
             ).values_list('trial_arm_id', flat=True)
@@ -78,64 +280,65 @@ class Command(BaseCommand):
             self.stdout.write(
                 f"Found {len(trial_arms)} trial arm(s) to process"
             )
+            if cut_dates:
+                self.stdout.write(
+                    f"Backfilling {len(cut_dates)} data cut(s) from "
+                    f"{cut_dates[0]} to {cut_dates[-1]}"
+                )
 
         if not trial_arms:
             self.stdout.write(self.style.WARNING("No trial arms to process"))
             return
 
-        computed_count = 0
-        error_count = 0
-
-        for trial_arm in trial_arms:
-            try:
-                metrics = self.compute_metrics_for_arm(
-                    trial_arm, web_threshold_h, verbosity
-                )
-                
-                if verbosity >= 2:
-                    self.stdout.write(
-                        f"\n{trial_arm.arm_name} ({trial_arm.arm_code}):"
-                    )
-                    self.stdout.write(f"  Person-years: {metrics['person_years']}")
-                    self.stdout.write(f"  Grade 1-2 count: {metrics['e1_2_count']}")
-                    self.stdout.write(f"  Grade 3-4 count: {metrics['e3_4_count']}")
-                    self.stdout.write(f"  Grade 5 count: {metrics['e5_count']}")
-                    self.stdout.write(f"  EAIR: {metrics['eair']}")
-                    self.stdout.write(f"  WEB: {metrics['web']}")
-                    self.stdout.write(
-                        self.style.SUCCESS(f"  Safety Score: {metrics['safety_score']}")
-                    )
+        compute_started = time.perf_counter()
+        if workers > 1:
+            computed_metrics, errors = self.compute_in_parallel(
+                trial_arms, web_threshold_h, today, workers, verbosity, cut_dates
+            )
+        else:
+            computed_metrics, errors = self.compute_metrics_for_arms(
+                trial_arms, web_threshold_h, today, cut_dates
+            )
 
-                if not dry_run:
-                    with transaction.atomic():
-                        # Update or create safety metrics
-                        safety_metrics, created = TrialArmSafetyMetrics.objects.update_or_create(
-                            trial_arm=trial_arm,
-                            data_cut_date=metrics['data_cut_date'],
-                            defaults=metrics
-                        )
-                        
-                        action = "Created" if created else "Updated"
-                        if verbosity >= 1:
-                            self.stdout.write(
-                                self.style.SUCCESS(
-                                    f"{action} safety metrics for {trial_arm.arm_code} "
-                                    f"(Score: {safety_metrics.safety_score})"
-                                )
-                            )
-                
-                computed_count += 1
+        computed_count = len(computed_metrics)
+        error_count = len(errors)
 
-            except Exception as e:
-                error_count += 1
+        if verbosity >= 2:
+            for metrics in computed_metrics:
+                trial_arm = metrics['trial_arm']
                 self.stdout.write(
-                    self.style.ERROR(
-                        f"Error computing metrics for {trial_arm.arm_code}: {str(e)}"
-                    )
+                    f"\n{trial_arm.arm_name} ({trial_arm.arm_code}):"
+                )
+                self.stdout.write(f"  Data cut: {metrics['data_cut_date']}")
+                self.stdout.write(f"  Person-years: {metrics['person_years']}")
+                self.stdout.write(f"  Grade 1-2 count: {metrics['e1_2_count']}")
+                self.stdout.write(f"  Grade 3-4 count: {metrics['e3_4_count']}")
+                self.stdout.write(f"  Grade 5 count: {metrics['e5_count']}")
+                self.stdout.write(f"  EAIR: {metrics['eair']}")
+                self.stdout.write(f"  WEB: {metrics['web']}")
+                self.stdout.write(
+                    self.style.SUCCESS(f"  Safety Score: {metrics['safety_score']}")
                 )
-                if verbosity >= 2:
-                    import traceback
-                    self.stdout.write(traceback.format_exc())
+
+        for trial_arm, message, trace in errors:
+            self.stdout.write(
+                self.style.ERROR(
+                    f"Error computing metrics for {trial_arm.arm_code}: {message}"
+                )
+            )
+            if verbosity >= 2:
+                self.stdout.write(trace)
+
+        compute_seconds = time.perf_counter() - compute_started
+
+        if h_values and computed_metrics:
+            self.report_h_sweep(computed_metrics, h_values)
+
+        save_seconds = 0.0
+        if computed_metrics and not dry_run and not h_values:
+            save_started = time.perf_counter()
+            self.save_metrics(computed_metrics, chunk_size, verbosity)
+            save_seconds = time.perf_counter() - save_started
 
         # Summary
         if verbosity >= 1:
@@ -149,44 +352,280 @@ class Command(BaseCommand):
                 self.stdout.write(
                     self.style.ERROR(f"Errors: {error_count}")
                 )
-            if dry_run:
+            self.stdout.write(
+                f"Computed {computed_count} metrics row(s) in {compute_seconds:.2f}s"
+            )
+            if save_seconds:
+                self.stdout.write(
+                    f"Saved {len(computed_metrics)} row(s) in {save_seconds:.2f}s "
+                    f"(chunk size {chunk_size})"
+                )
+            if dry_run or h_values:
                 self.stdout.write(
-                    self.style.WARNING("DRY RUN - No data was saved")
+                    self.style.WARNING(
+                        "H SWEEP - No data was saved" if h_values and not dry_run
+                        else "DRY RUN - No data was saved"
+                    )
                 )
 
-    def compute_metrics_for_arm(self, trial_arm, web_threshold_h, verbosity):
+    def aggregate_ae_counts(self, trial_arms, today):
         """
-        Compute safety metrics for a single trial arm.
+        Count adverse events for many trial arms in a single GROUP BY query.
+
+        Events are limited to each arm's own data cut (last_data_cut capped at
+        today, or today when unset). Returns {trial_arm_id: counts} for arms
+        with events.
         """
-        # Determine data cut date
-        data_cut_date = trial_arm.last_data_cut or timezone.now().date()
-        
-        # Compute person-years
-        if trial_arm.follow_up_months and trial_arm.n_patients:
-            person_years = Decimal(str(trial_arm.n_patients)) * (
-                Decimal(str(trial_arm.follow_up_months)) / Decimal('12')
-            )
-        elif trial_arm.enrollment_start_date and data_cut_date:
-            # Fallback: derive from enrollment date to last data cut
-            days_followup = (data_cut_date - trial_arm.enrollment_start_date).days
-            months_followup = Decimal(str(days_followup)) / Decimal('30.44')  # Average days per month
-            person_years = Decimal(str(trial_arm.n_patients)) * (months_followup / Decimal('12'))
+        rows = AdverseEvent.objects.filter(
+            trial_arm_id__in=[arm.trial_arm_id for arm in trial_arms],
+            event_date__lte=Least(Coalesce('trial_arm__last_data_cut', Value(today)), Value(today)),
+        ).order_by().values('trial_arm_id').annotate(
+            e1_2_count=Count('person_id', distinct=True, filter=Q(grade__in=[1, 2])),
+            e3_4_count=Count('person_id', distinct=True, filter=Q(grade__in=[3, 4])),
+            e5_count=Count('person_id', distinct=True, filter=Q(grade=5)),
+            patients_with_any_ae=Count('person_id', distinct=True),
+            total_ae_count=Count('adverse_event_id'),
+        )
+
+        return {row.pop('trial_arm_id'): row for row in rows}
+
+    def compute_metrics_for_arms(self, trial_arms, web_threshold_h, today, cut_dates=None):
+        """
+        Compute metrics for a list of trial arms.
+
+        Without cut_dates, each arm is computed at its own data cut using one
+        aggregate query. With cut_dates, every arm is computed at every cut
+        from one event sweep, skipping cuts on or before its enrollment start
+        and cuts after its own data cut (see arm_data_cut()).
+
+        Returns (computed_metrics, errors) where errors is a list of
+        (trial_arm, message, traceback) for arms that could not be computed.
+        """
+        if cut_dates:
+            counts_by_cut = self.sweep_ae_counts(trial_arms, cut_dates)
+            targets = [
+                (trial_arm, cut_date, counts_by_cut[cut_date])
+                for trial_arm in trial_arms
+                for cut_date in cut_dates
+                if cut_date <= arm_data_cut(trial_arm, today)
+                and not (
+                    trial_arm.enrollment_start_date
+                    and cut_date <= trial_arm.enrollment_start_date
+                )
+            ]
         else:
-            raise ValueError(
-                f"Cannot compute person-years for {trial_arm.arm_code}: "
-                "missing follow_up_months or enrollment dates"
+            # Count adverse events for all arms with one GROUP BY query
+            ae_counts = self.aggregate_ae_counts(trial_arms, today)
+            targets = [
+                (trial_arm, arm_data_cut(trial_arm, today), ae_counts)
+                for trial_arm in trial_arms
+            ]
+
+        computed_metrics = []
+        errors = []
+        for trial_arm, data_cut_date, ae_counts in targets:
+            try:
+                computed_metrics.append(self.build_metrics(
+                    trial_arm,
+                    data_cut_date,
+                    ae_counts.get(trial_arm.trial_arm_id, EMPTY_AE_COUNTS),
+                    web_threshold_h,
+                ))
+            except Exception as e:
+                errors.append((trial_arm, str(e), traceback.format_exc()))
+
+        return computed_metrics, errors
+
+    def compute_in_parallel(self, trial_arms, web_threshold_h, today, workers, verbosity,
+                            cut_dates=None):
+        """
+        Partition the arms across a process pool and merge the results.
+
+        Each worker opens its own database connection; the parent's
+        connections are closed first so forked workers never share them.
+        """
+        partitions = partition_trial_arm_ids(
+            [arm.trial_arm_id for arm in trial_arms], workers
+        )
+        connections.close_all()
+
+        computed_metrics = []
+        errors = []
+        with ProcessPoolExecutor(max_workers=len(partitions), initializer=django.setup) as pool:
+            futures = [
+                pool.submit(_compute_partition, partition, web_threshold_h, today, cut_dates)
+                for partition in partitions
+            ]
+            for future in futures:
+                result = future.result()
+                computed_metrics.extend(result['computed_metrics'])
+                errors.extend(result['errors'])
+
+                if verbosity >= 1:
+                    seconds = result['seconds']
+                    rate = result['n_arms'] / seconds if seconds else 0
+                    self.stdout.write(
+                        f"Worker {result['pid']}: {result['n_arms']} arm(s) in "
+                        f"{seconds:.2f}s ({rate:.1f} arms/s)"
+                    )
+
+        return computed_metrics, errors
+
+    def report_h_sweep(self, computed_metrics, h_values):
+        """
+        Print each computed row's safety score and rank at every WEB threshold.
+        """
+        sweep = SafetyScoreSweep(
+            list(range(len(computed_metrics))),
+            [
+                [metrics['e1_2_count'], metrics['e3_4_count'], metrics['e5_count']]
+                for metrics in computed_metrics
+            ],
+            h_values,
+        )
+
+        self.stdout.write("\nSafety score sensitivity to WEB threshold H (score / rank):")
+        self.stdout.write(
+            f"{'Arm':<20} {'Data cut':<12} {'WEB':>8} "
+            + " ".join(f"{'H=' + format(h, 'g'):>14}" for h in h_values)
+        )
+        for i, metrics in enumerate(computed_metrics):
+            cells = " ".join(
+                f"{sweep.scores[0, h, i]:>8.2f} / {sweep.ranks[0, h, i]:<3}"
+                for h in range(len(h_values))
+            )
+            self.stdout.write(
+                f"{metrics['trial_arm'].arm_code:<20} {str(metrics['data_cut_date']):<12} "
+                f"{sweep.web[0, i]:>8.0f} {cells}"
             )
 
-        if person_years <= 0:
-            raise ValueError(
-                f"Invalid person-years ({person_years}) for {trial_arm.arm_code}"
+    def sweep_ae_counts(self, trial_arms, cut_dates):
+        """
+        Count adverse events for many trial arms at many data cuts in a single
+        pass over events ordered by event_date, accumulating per-arm patient
+        sets and snapshotting the counts each time a cut date is passed.
+
+        Returns {cut_date: {trial_arm_id: counts}}.
+        """
+        cut_dates = sorted(cut_dates)
+        events = AdverseEvent.objects.filter(
+            trial_arm_id__in=[arm.trial_arm_id for arm in trial_arms],
+            event_date__lte=cut_dates[-1],
+        ).order_by('event_date').values_list(
+            'trial_arm_id', 'person_id', 'grade', 'event_date'
+        )
+
+        patients = defaultdict(lambda: {
+            'e1_2_count': set(),
+            'e3_4_count': set(),
+            'e5_count': set(),
+            'patients_with_any_ae': set(),
+        })
+        total_ae_counts = defaultdict(int)
+
+        def snapshot():
+            return {
+                trial_arm_id: {
+                    **{bucket: len(ids) for bucket, ids in buckets.items()},
+                    'total_ae_count': total_ae_counts[trial_arm_id],
+                }
+                for trial_arm_id, buckets in patients.items()
+            }
+
+        counts_by_cut = {}
+        next_cut = 0
+        for trial_arm_id, person_id, grade, event_date in events.iterator(chunk_size=5000):
+            while event_date > cut_dates[next_cut]:
+                counts_by_cut[cut_dates[next_cut]] = snapshot()
+                next_cut += 1
+
+            buckets = patients[trial_arm_id]
+            buckets['patients_with_any_ae'].add(person_id)
+            total_ae_counts[trial_arm_id] += 1
+            if grade in [1, 2]:
+                buckets['e1_2_count'].add(person_id)
+            elif grade in [3, 4]:
+                buckets['e3_4_count'].add(person_id)
+            elif grade == 5:
+                buckets['e5_count'].add(person_id)
+
+        final_counts = snapshot()
+        for cut_date in cut_dates[next_cut:]:
+            counts_by_cut[cut_date] = final_counts
+
+        return counts_by_cut
+
+    def save_metrics(self, computed_metrics, chunk_size, verbosity):
+        """
+        Upsert computed metrics on (trial_arm, data_cut_date) with bulk
+        INSERT ... ON CONFLICT statements of chunk_size rows, and refresh the
+        arms' current snapshot, all in one transaction.
+        """
+        trial_arm_ids = sorted({
+            metrics['trial_arm'].trial_arm_id for metrics in computed_metrics
+        })
+        id_chunks = [
+            trial_arm_ids[i:i + chunk_size]
+            for i in range(0, len(trial_arm_ids), chunk_size)
+        ]
+
+        existing = set()
+        for id_chunk in id_chunks:
+            existing.update(
+                TrialArmSafetyMetrics.objects.filter(
+                    trial_arm_id__in=id_chunk
+                ).values_list('trial_arm_id', 'data_cut_date')
             )
 
+        with transaction.atomic():
+            for i in range(0, len(computed_metrics), chunk_size):
+                chunk_started = time.perf_counter()
+                chunk = computed_metrics[i:i + chunk_size]
+                TrialArmSafetyMetrics.objects.bulk_create(
+                    [TrialArmSafetyMetrics(**metrics) for metrics in chunk],
+                    update_conflicts=True,
+                    unique_fields=['trial_arm', 'data_cut_date'],
+                    update_fields=METRIC_UPDATE_FIELDS,
+                )
+                if verbosity >= 2:
+                    self.stdout.write(
+                        f"Upserted rows {i + 1}-{i + len(chunk)} in "
+                        f"{time.perf_counter() - chunk_started:.3f}s"
+                    )
+
+            # Keep the arms' current safety snapshot in sync
+            for id_chunk in id_chunks:
+                TrialArm.objects.filter(
+                    trial_arm_id__in=id_chunk
+                ).refresh_current_safety()
+
+        if verbosity >= 1:
+            for metrics in computed_metrics:
+                trial_arm = metrics['trial_arm']
+                key = (trial_arm.trial_arm_id, metrics['data_cut_date'])
+                action = "Updated" if key in existing else "Created"
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"{action} safety metrics for {trial_arm.arm_code} "
+                        f"at {metrics['data_cut_date']} (Score: {metrics['safety_score']:.2f})"
+                    )
+                )
+
+    def compute_metrics_for_arm(self, trial_arm, web_threshold_h, verbosity):
+        """
+        Compute safety metrics for a single trial arm.
+
+        Reference implementation that counts patients in Python; the command
+        itself uses aggregate_ae_counts() for all arms at once.
+        """
+        # Determine data cut date
+        data_cut_date = arm_data_cut(trial_arm, timezone.now().date())
+
         # Get adverse events for this trial arm
         adverse_events = AdverseEvent.objects.filter(
             trial_arm=trial_arm,
             event_date__lte=data_cut_date
-        ).select_related('person')
+        )
 
         # Count patients with events by grade
         # A patient can have multiple AEs, we count unique patients
@@ -197,7 +636,7 @@ class Command(BaseCommand):
         total_ae_count = 0
 
         for ae in adverse_events:
-            patient_id = ae.person.person_id
+            patient_id = ae.person_id
             patients_with_any_ae.add(patient_id)
             total_ae_count += 1
             
@@ -208,13 +647,61 @@ class Command(BaseCommand):
             elif ae.grade == 5:
                 patients_with_grade_5.add(patient_id)
 
-        e1_2_count = len(patients_with_grade_1_2)
-        e3_4_count = len(patients_with_grade_3_4)
-        e5_count = len(patients_with_grade_5)
+        ae_counts = {
+            'e1_2_count': len(patients_with_grade_1_2),
+            'e3_4_count': len(patients_with_grade_3_4),
+            'e5_count': len(patients_with_grade_5),
+            'patients_with_any_ae': len(patients_with_any_ae),
+            'total_ae_count': total_ae_count,
+        }
+
+        return self.build_metrics(trial_arm, data_cut_date, ae_counts, web_threshold_h)
+
+    def build_metrics(self, trial_arm, data_cut_date, ae_counts, web_threshold_h):
+        """
+        Build the TrialArmSafetyMetrics field values for a trial arm from its
+        per-grade patient counts.
+
+        follow_up_months is the follow-up reached at the arm's own data cut;
+        at an earlier data cut only the share accrued since enrollment start
+        is counted.
+        """
+        # Compute person-years
+        if trial_arm.follow_up_months and trial_arm.n_patients:
+            follow_up_months = Decimal(str(trial_arm.follow_up_months))
+            arm_cut = arm_data_cut(trial_arm, timezone.now().date())
+            enrollment_start = trial_arm.enrollment_start_date
+            if enrollment_start and enrollment_start < data_cut_date < arm_cut:
+                follow_up_months *= (
+                    Decimal((data_cut_date - enrollment_start).days)
+                    / Decimal((arm_cut - enrollment_start).days)
+                )
+            person_years = Decimal(str(trial_arm.n_patients)) * (
+                follow_up_months / Decimal('12')
+            )
+        elif trial_arm.enrollment_start_date and data_cut_date:
+            # Fallback: derive from enrollment date to last data cut
+            days_followup = (data_cut_date - trial_arm.enrollment_start_date).days
+            months_followup = Decimal(str(days_followup)) / Decimal('30.44')  # Average days per month
+            person_years = Decimal(str(trial_arm.n_patients)) * (months_followup / Decimal('12'))
+        else:
+            raise ValueError(
+                f"Cannot compute person-years for {trial_arm.arm_code}: "
+                "missing follow_up_months or enrollment dates"
+            )
+
+        if person_years <= 0:
+            raise ValueError(
+                f"Invalid person-years ({person_years}) for {trial_arm.arm_code}"
+            )
+
+        e1_2_count = ae_counts['e1_2_count']
+        e3_4_count = ae_counts['e3_4_count']
+        e5_count = ae_counts['e5_count']
 
         # Compute EAIR (Event-Adjusted Incidence Rate)
         # EAIR = number of patients with events / person-years
-        num_patients_with_event = len(patients_with_any_ae)
+        num_patients_with_event = ae_counts['patients_with_any_ae']
         eair = Decimal(str(num_patients_with_event)) / person_years if person_years > 0 else Decimal('0')
 
         # Compute WEB (Weighted Event Burden)
@@ -247,11 +734,10 @@ class Command(BaseCommand):
             'e1_2_count': e1_2_count,
             'e3_4_count': e3_4_count,
             'e5_count': e5_count,
-            'total_ae_count': total_ae_count,
+            'total_ae_count': ae_counts['total_ae_count'],
             'patients_with_any_ae': num_patients_with_event,
             'eair': eair,
             'web': web,
             'safety_score': safety_score,
             'web_threshold_h': web_threshold_h,
         }
-
@@ -4,46 +4,132 @@ Django management command to migrate OMOP CDM data to PatientInfo table.
 This command extracts data from OMOP Person, Measurement, Observation, ConditionOccurrence,
 TreatmentRegimen, and other tables to populate the consolidated PatientInfo model.
 
+Persons are migrated in batches. For each batch the known measurement and
+observation concepts are pivoted into per-person columns with one
+conditional-aggregation query per table, concept names come from an in-memory
+cache, and PatientInfo rows are written with bulk_create/bulk_update.
+
+--rebuild (alias --clean) replaces every PatientInfo row without ever leaving
+the table empty: see omop.patient_info_rebuild.
+
 Usage:
     python manage.py migrate_omop_to_patientinfo
-    python manage.py migrate_omop_to_patientinfo --clean
+    python manage.py migrate_omop_to_patientinfo --rebuild
     python manage.py migrate_omop_to_patientinfo --person-ids 1,2,3
+    python manage.py migrate_omop_to_patientinfo --batch-size 1000
 """
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
+from django.db.models import Case, Max, Q, Value, When
+from django.db.models.functions import Coalesce, NullIf
 from django.utils import timezone
 from datetime import datetime, date
+from contextlib import nullcontext
 import json
 
+from omop.measurement_queries import latest_measurements, latest_per_concept
+from omop.patient_info_rebuild import patient_info_rebuild
 from omop.models import (
     Person, PatientInfo, Measurement, Observation, ConditionOccurrence, 
     TreatmentRegimen, TreatmentLine, GenomicVariant, Concept
 )
 
 
+# Breast cancer condition concepts
+BREAST_CANCER_CONCEPTS = [4112853, 4263086, 4180790]
+
+# Measurement concepts pivoted into PatientInfo columns
+HORMONE_RECEPTOR_CONCEPTS = {
+    4268518: 'estrogen_receptor_status',      # ER status
+    4069297: 'progesterone_receptor_status',  # PR status
+    4058187: 'her2_status',                   # HER2 status
+}
+BLOOD_WORK_CONCEPTS = {
+    3000963: ('hemoglobin_level', 'G/DL'),             # Hemoglobin
+    3013682: ('white_blood_cell_count', 'CELLS/L'),    # White blood cell count
+    3012888: ('platelet_count', 'CELLS/UL'),           # Platelet count
+    3016723: ('serum_creatinine_level', 'MG/DL'),      # Creatinine
+    3006906: ('albumin_level', 'G/DL'),                # Albumin
+}
+TUMOR_MARKER_CONCEPTS = [
+    3007220,  # CA 15-3
+    3009261,  # CA 27.29
+]
+
+# Observation concepts pivoted into PatientInfo columns
+ECOG_CONCEPT = 4161279
+KARNOFSKY_CONCEPT = 4174715
+SMOKING_CONCEPT = 4013634
+ALCOHOL_CONCEPT = 4267213
+STAGING_CONCEPTS = [
+    1635579,  # TNM T stage
+    1634371,  # TNM N stage
+    1634444,  # TNM M stage
+    1635919,  # Overall stage
+]
+
+# PatientInfo columns written by the extract_* methods
+MIGRATED_FIELDS = [
+    'patient_age', 'gender', 'ethnicity', 'country',
+    'disease', 'stage', 'tumor_stage', 'nodes_stage', 'distant_metastasis_stage',
+    'estrogen_receptor_status', 'progesterone_receptor_status', 'her2_status',
+    'hemoglobin_level', 'hemoglobin_level_units',
+    'white_blood_cell_count', 'white_blood_cell_count_units',
+    'platelet_count', 'platelet_count_units',
+    'serum_creatinine_level', 'serum_creatinine_level_units',
+    'albumin_level', 'albumin_level_units', 'molecular_markers',
+    'ecog_performance_status', 'karnofsky_performance_score',
+    'no_tobacco_use_status', 'tobacco_use_details', 'substance_use_details',
+    'therapy_lines_count', 'first_line_date', 'first_line_outcome', 'first_line_therapy',
+    'second_line_date', 'second_line_outcome', 'second_line_therapy', 'last_treatment',
+    'genetic_mutations', 'bmi', 'no_other_active_malignancies', 'consent_capability',
+    'updated_at',
+]
+
+
+def _pivot(concept_field, concept_id, value):
+    """Aggregate picking value from the row of one concept in a person's group."""
+    return Max(Case(When(**{concept_field: concept_id}, then=value)))
+
+
 class Command(BaseCommand):
     help = 'Migrate OMOP CDM data to PatientInfo table'
 
     def add_arguments(self, parser):
         parser.add_argument(
-            '--clean',
+            '--rebuild', '--clean',
+            dest='rebuild',
             action='store_true',
-            help='Clean existing PatientInfo records before migration',
+            help='Replace all PatientInfo records with the migrated ones; existing '
+                 'records stay readable until the rebuild completes',
         )
         parser.add_argument(
             '--person-ids',
             type=str,
             help='Comma-separated list of Person IDs to migrate (if not specified, migrates all)',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of persons to migrate per batch',
+        )
 
     def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+        
         self.stdout.write("🔄 Starting OMOP to PatientInfo migration...")
         
-        if options['clean']:
-            self.stdout.write("🧹 Cleaning existing PatientInfo records...")
-            PatientInfo.objects.all().delete()
-            self.stdout.write("✅ Cleaned existing PatientInfo records")
+        self.rebuild = None
+        if options['rebuild']:
+            self.stdout.write(
+                "🏗️ Rebuilding PatientInfo; existing records stay readable until the swap, "
+                "other PatientInfo writes wait until it completes"
+            )
+            self.rebuild = patient_info_rebuild()
 
         # Determine which persons to migrate
         if options['person_ids']:
@@ -55,53 +141,210 @@ class Command(BaseCommand):
         total_persons = persons.count()
         self.stdout.write(f"📊 Found {total_persons} persons to migrate")
 
+        # concept_id -> concept_name, filled on demand across batches
+        self.concept_names = {}
         migrated_count = 0
         failed_count = 0
 
-        for person in persons:
-            try:
-                with transaction.atomic():
-                    patient_info = self.migrate_person_to_patient_info(person)
-                    if patient_info:
-                        migrated_count += 1
-                        if migrated_count % 10 == 0:
-                            self.stdout.write(f"✅ Migrated {migrated_count}/{total_persons} patients")
-                    else:
-                        failed_count += 1
-                        self.stdout.write(f"⚠️  Skipped Person {person.person_id} (no data to migrate)")
-                        
-            except Exception as e:
-                failed_count += 1
-                self.stdout.write(f"❌ Error migrating Person {person.person_id}: {str(e)}")
+        persons = persons.order_by('person_id')
+        last_seen = None
+        try:
+            # A rebuild is one transaction, holding its lock on PatientInfo until the swap
+            with transaction.atomic() if self.rebuild else nullcontext():
+                if self.rebuild:
+                    self.rebuild.start()
+                while True:
+                    page = persons if last_seen is None else persons.filter(person_id__gt=last_seen)
+                    batch = list(page[:batch_size])
+                    if not batch:
+                        break
+                    last_seen = batch[-1].person_id
+                    
+                    migrated, failed = self.migrate_batch(batch)
+                    migrated_count += migrated
+                    failed_count += failed
+                    self.stdout.write(f"✅ Migrated {migrated_count}/{total_persons} patients")
+                
+                if self.rebuild:
+                    self.rebuild.finish()
+            if self.rebuild:
+                self.stdout.write("✅ Rebuilt PatientInfo records are live")
+        except Exception as e:
+            if self.rebuild is None:
+                raise
+            # The rebuild's transaction is rolled back; existing records are left as they were
+            self.rebuild.discard()
+            raise CommandError(f"Rebuild abandoned: {e}")
 
         self.stdout.write(f"\n🎉 Migration complete!")
         self.stdout.write(f"✅ Successfully migrated: {migrated_count}")
         self.stdout.write(f"❌ Failed/Skipped: {failed_count}")
         self.stdout.write(f"📊 Total processed: {total_persons}")
 
-    def migrate_person_to_patient_info(self, person):
-        """Migrate a single Person and related OMOP data to PatientInfo"""
+    def migrate_batch(self, persons):
+        """
+        Migrate a batch of persons and write their PatientInfo rows together.
         
-        # Check if PatientInfo already exists
-        patient_info, created = PatientInfo.objects.get_or_create(
-            person=person,
-            defaults={}
-        )
+        Returns (migrated, failed) counts.
+        """
+        person_ids = [person.person_id for person in persons]
+        if self.rebuild:
+            existing = {}  # Rebuilt records start empty, as after a delete
+        else:
+            existing = PatientInfo.objects.in_bulk(person_ids, field_name='person_id')
+        measurements = self.pivot_measurements(person_ids)
+        observations = self.pivot_observations(person_ids)
+        breast_cancer_ids = set(ConditionOccurrence.objects.filter(
+            person_id__in=person_ids, condition_concept_id__in=BREAST_CANCER_CONCEPTS
+        ).values_list('person_id', flat=True))
+        
+        # Concept names the extract_* methods look up
+        concept_ids = set(TUMOR_MARKER_CONCEPTS)
+        concept_ids.update(person.race_concept_id for person in persons)
+        for values in observations.values():
+            concept_ids.update(values['staging_concepts'])
+        self.load_concept_names(concept_ids)
+
+        new_infos = []
+        changed_infos = []
+        failed = 0
+        for person in persons:
+            patient_info = existing.get(person.person_id)
+            if patient_info is not None:
+                self.stdout.write(f"📝 Updating existing PatientInfo for Person {person.person_id}")
+            else:
+                patient_info = PatientInfo(person=person)
+            
+            try:
+                self.migrate_person_to_patient_info(
+                    person, patient_info,
+                    has_breast_cancer=person.person_id in breast_cancer_ids,
+                    measurements=measurements.get(person.person_id, {}),
+                    observations=observations.get(person.person_id, {}),
+                )
+            except Exception as e:
+                failed += 1
+                self.stdout.write(f"❌ Error migrating Person {person.person_id}: {str(e)}")
+                continue
+            
+            if patient_info.pk is None:
+                new_infos.append(patient_info)
+            else:
+                changed_infos.append(patient_info)
+
+        try:
+            with transaction.atomic():
+                if self.rebuild:
+                    self.rebuild.load(new_infos)
+                else:
+                    PatientInfo.objects.bulk_create(new_infos)
+                    PatientInfo.objects.bulk_update(changed_infos, fields=MIGRATED_FIELDS)
+        except Exception as e:
+            if self.rebuild:
+                raise  # A rebuild missing a whole batch must not be swapped in
+            self.stdout.write(f"❌ Error saving batch starting at Person {person_ids[0]}: {str(e)}")
+            return 0, len(persons)
         
-        if not created:
-            self.stdout.write(f"📝 Updating existing PatientInfo for Person {person.person_id}")
+        return len(new_infos) + len(changed_infos), failed
+
+    def pivot_measurements(self, person_ids):
+        """
+        Latest hormone receptor, blood work and tumor marker results per person.
+        
+        One query: the latest row per (person, concept) is selected in a
+        subquery and pivoted to one row per person, keyed by concept ID.
+        Blood work and tumor markers skip rows without a numeric value.
+        """
+        latest = Q(pk__in=latest_measurements(
+            person_ids, list(HORMONE_RECEPTOR_CONCEPTS)
+        ).values('pk')) | Q(pk__in=latest_measurements(
+            person_ids, list(BLOOD_WORK_CONCEPTS) + TUMOR_MARKER_CONCEPTS, numeric_only=True
+        ).values('pk'))
+        
+        # Receptor status is reported in the source value, else the result value
+        status = Coalesce(NullIf('measurement_source_value', Value('')), 'value_source_value')
+        pivots = {
+            concept_id: _pivot('measurement_concept_id', concept_id, status)
+            for concept_id in HORMONE_RECEPTOR_CONCEPTS
+        }
+        for concept_id in list(BLOOD_WORK_CONCEPTS) + TUMOR_MARKER_CONCEPTS:
+            pivots[concept_id] = _pivot('measurement_concept_id', concept_id, 'value_as_number')
+        
+        rows = Measurement.objects.filter(latest).values('person_id').annotate(
+            **{f'concept_{concept_id}': pivot for concept_id, pivot in pivots.items()}
+        ).order_by()
+        return {
+            row['person_id']: {concept_id: row[f'concept_{concept_id}'] for concept_id in pivots}
+            for row in rows
+        }
+
+    def pivot_observations(self, person_ids):
+        """
+        Latest performance status, tobacco, alcohol and TNM staging per person.
+        
+        One query, pivoted like pivot_measurements. Staging values are
+        returned in STAGING_CONCEPTS order as (value_as_string,
+        value_as_concept_id) pairs, with the value concepts under
+        'staging_concepts'.
+        """
+        concept_ids = [ECOG_CONCEPT, KARNOFSKY_CONCEPT, SMOKING_CONCEPT, ALCOHOL_CONCEPT] + STAGING_CONCEPTS
+        latest_ids = latest_per_concept(
+            Observation.objects.filter(person_id__in=person_ids, observation_concept_id__in=concept_ids),
+            'observation_concept_id', 'observation_datetime'
+        ).values('pk')
+        
+        pivots = {
+            'ecog': _pivot('observation_concept_id', ECOG_CONCEPT, 'value_as_number'),
+            'karnofsky': _pivot('observation_concept_id', KARNOFSKY_CONCEPT, 'value_as_number'),
+            'smoking': _pivot('observation_concept_id', SMOKING_CONCEPT, 'observation_source_value'),
+            'alcohol': _pivot('observation_concept_id', ALCOHOL_CONCEPT, 'observation_source_value'),
+        }
+        for concept_id in STAGING_CONCEPTS:
+            pivots[f'stage_{concept_id}'] = _pivot('observation_concept_id', concept_id, 'value_as_string')
+            pivots[f'stage_{concept_id}_concept'] = _pivot(
+                'observation_concept_id', concept_id, 'value_as_concept_id'
+            )
+        
+        observations = {}
+        rows = Observation.objects.filter(pk__in=latest_ids).values('person_id').annotate(**pivots).order_by()
+        for row in rows:
+            staging = [
+                (row[f'stage_{concept_id}'], row[f'stage_{concept_id}_concept'])
+                for concept_id in STAGING_CONCEPTS
+            ]
+            observations[row['person_id']] = {
+                'ecog': row['ecog'],
+                'karnofsky': row['karnofsky'],
+                'smoking': row['smoking'],
+                'alcohol': row['alcohol'],
+                'staging': staging,
+                'staging_concepts': [concept_id for _, concept_id in staging if concept_id],
+            }
+        return observations
+
+    def load_concept_names(self, concept_ids):
+        """Add names of concepts not yet cached, with one query."""
+        missing = {concept_id for concept_id in concept_ids if concept_id} - self.concept_names.keys()
+        if missing:
+            self.concept_names.update(
+                Concept.objects.filter(concept_id__in=missing).values_list('concept_id', 'concept_name')
+            )
+
+    def migrate_person_to_patient_info(self, person, patient_info, has_breast_cancer,
+                                       measurements, observations):
+        """Fill a person's PatientInfo from the batch's pivoted OMOP data (not saved)"""
 
         # Extract demographics from Person
         self.extract_demographics(person, patient_info)
         
         # Extract disease information from ConditionOccurrence
-        self.extract_disease_info(person, patient_info)
+        self.extract_disease_info(patient_info, has_breast_cancer, observations)
         
         # Extract lab values and biomarkers from Measurement
-        self.extract_lab_values(person, patient_info)
+        self.extract_lab_values(patient_info, measurements)
         
         # Extract clinical observations
-        self.extract_observations(person, patient_info)
+        self.extract_observations(patient_info, observations)
         
         # Extract treatment information
         self.extract_treatment_info(person, patient_info)
@@ -112,7 +355,7 @@ class Command(BaseCommand):
         # Calculate derived fields
         self.calculate_derived_fields(patient_info)
         
-        patient_info.save()
+        patient_info.updated_at = timezone.now()
         return patient_info
 
     def extract_demographics(self, person, patient_info):
@@ -135,12 +378,8 @@ class Command(BaseCommand):
             patient_info.gender = gender_mapping.get(person.gender_concept_id)
         
         # Race and ethnicity
-        if person.race_concept_id:
-            try:
-                race_concept = Concept.objects.get(concept_id=person.race_concept_id)
-                patient_info.ethnicity = race_concept.concept_name
-            except Concept.DoesNotExist:
-                pass
+        if person.race_concept_id in self.concept_names:
+            patient_info.ethnicity = self.concept_names[person.race_concept_id]
         
         # Location information
         if person.location_id:
@@ -148,166 +387,78 @@ class Command(BaseCommand):
             # For now, we'll set some defaults
             patient_info.country = "United States"
 
-    def extract_disease_info(self, person, patient_info):
-        """Extract disease information from ConditionOccurrence"""
+    def extract_disease_info(self, patient_info, has_breast_cancer, observations):
+        """Extract disease information from ConditionOccurrence and staging Observations"""
         
-        # Get primary condition (assuming breast cancer for our dataset)
-        primary_condition = ConditionOccurrence.objects.filter(
-            person=person,
-            condition_concept_id__in=[4112853, 4263086, 4180790]  # Breast cancer concepts
-        ).first()
-        
-        if primary_condition:
+        # Primary condition (assuming breast cancer for our dataset)
+        if has_breast_cancer:
             patient_info.disease = "breast cancer"
             
-            # Extract staging information from related Observations
-            staging_obs = Observation.objects.filter(
-                person=person,
-                observation_concept_id__in=[
-                    1635579,  # TNM T stage
-                    1634371,  # TNM N stage  
-                    1634444,  # TNM M stage
-                    1635919,  # Overall stage
-                ]
-            )
-            
-            stage_components = []
-            for obs in staging_obs:
-                if obs.value_as_string:
-                    stage_components.append(obs.value_as_string)
-                elif obs.value_as_concept:
-                    try:
-                        concept = Concept.objects.get(concept_id=obs.value_as_concept.concept_id)
-                        stage_components.append(concept.concept_name)
-                    except Concept.DoesNotExist:
-                        pass
+            # Staging information from the latest T, N, M and overall stage observations
+            stage_values = [
+                value_as_string or self.concept_names.get(value_as_concept_id)
+                for value_as_string, value_as_concept_id in observations.get('staging', [])
+            ]
+            stage_components = [value for value in stage_values if value]
             
             if stage_components:
                 patient_info.stage = " ".join(stage_components)
-                patient_info.tumor_stage = stage_components[0] if len(stage_components) > 0 else None
-                patient_info.nodes_stage = stage_components[1] if len(stage_components) > 1 else None
-                patient_info.distant_metastasis_stage = stage_components[2] if len(stage_components) > 2 else None
+                patient_info.tumor_stage, patient_info.nodes_stage, patient_info.distant_metastasis_stage = stage_values[:3]
 
-    def extract_lab_values(self, person, patient_info):
-        """Extract laboratory values and biomarkers from Measurement"""
+    def extract_lab_values(self, patient_info, measurements):
+        """Extract laboratory values and biomarkers from pivoted Measurement results"""
         
         # Hormone receptor status (ER, PR, HER2)
-        hormone_measurements = Measurement.objects.filter(
-            person=person,
-            measurement_concept_id__in=[
-                4268518,  # ER status
-                4069297,  # PR status  
-                4058187,  # HER2 status
-            ]
-        )
-        
-        for measurement in hormone_measurements:
-            if measurement.measurement_concept_id == 4268518:  # ER
-                patient_info.estrogen_receptor_status = measurement.measurement_source_value or measurement.value_as_string
-            elif measurement.measurement_concept_id == 4069297:  # PR
-                patient_info.progesterone_receptor_status = measurement.measurement_source_value or measurement.value_as_string
-            elif measurement.measurement_concept_id == 4058187:  # HER2
-                patient_info.her2_status = measurement.measurement_source_value or measurement.value_as_string
-
-        # Blood work values
-        blood_measurements = Measurement.objects.filter(
-            person=person,
-            measurement_concept_id__in=[
-                3000963,  # Hemoglobin
-                3013682,  # White blood cell count
-                3012888,  # Platelet count
-                3016723,  # Creatinine
-                3006906,  # Albumin
-            ]
-        )
-        
-        for measurement in blood_measurements:
-            value = measurement.value_as_number
+        for concept_id, field in HORMONE_RECEPTOR_CONCEPTS.items():
+            if measurements.get(concept_id) is not None:
+                setattr(patient_info, field, measurements[concept_id])
+
+        # Blood work values, latest numeric result per concept
+        for concept_id, (field, units) in BLOOD_WORK_CONCEPTS.items():
+            value = measurements.get(concept_id)
             if value is None:
                 continue
-                
-            if measurement.measurement_concept_id == 3000963:  # Hemoglobin
-                patient_info.hemoglobin_level = value
-                patient_info.hemoglobin_level_units = 'G/DL'
-            elif measurement.measurement_concept_id == 3013682:  # WBC
-                patient_info.white_blood_cell_count = value
-                patient_info.white_blood_cell_count_units = 'CELLS/L'
-            elif measurement.measurement_concept_id == 3012888:  # Platelets
-                patient_info.platelet_count = int(value) if value else None
-                patient_info.platelet_count_units = 'CELLS/UL'
-            elif measurement.measurement_concept_id == 3016723:  # Creatinine
-                patient_info.serum_creatinine_level = value
-                patient_info.serum_creatinine_level_units = 'MG/DL'
-            elif measurement.measurement_concept_id == 3006906:  # Albumin
-                patient_info.albumin_level = value
-                patient_info.albumin_level_units = 'G/DL'
+            
+            if field == 'platelet_count':
+                value = int(value) if value else None
+            setattr(patient_info, field, value)
+            setattr(patient_info, f'{field}_units', units)
 
         # Tumor markers
-        tumor_markers = Measurement.objects.filter(
-            person=person,
-            measurement_concept_id__in=[
-                3007220,  # CA 15-3
-                3009261,  # CA 27.29
-            ]
-        )
-        
         # For now, we'll store these in a text field since PatientInfo doesn't have specific fields
         marker_values = []
-        for marker in tumor_markers:
-            if marker.value_as_number:
-                concept_name = "Unknown"
-                try:
-                    concept = Concept.objects.get(concept_id=marker.measurement_concept_id)
-                    concept_name = concept.concept_name
-                except Concept.DoesNotExist:
-                    pass
-                marker_values.append(f"{concept_name}: {marker.value_as_number}")
+        for concept_id in TUMOR_MARKER_CONCEPTS:
+            value = measurements.get(concept_id)
+            if value:
+                concept_name = self.concept_names.get(concept_id, "Unknown")
+                marker_values.append(f"{concept_name}: {value}")
         
         if marker_values:
             # Store in a generic text field for now
-            if hasattr(patient_info, 'molecular_markers'):
-                patient_info.molecular_markers = "; ".join(marker_values)
+            patient_info.molecular_markers = "; ".join(marker_values)
 
-    def extract_observations(self, person, patient_info):
+    def extract_observations(self, patient_info, observations):
         """Extract clinical observations and social determinants"""
         
         # Performance status
-        performance_obs = Observation.objects.filter(
-            person=person,
-            observation_concept_id__in=[
-                4161279,  # ECOG performance status
-                4174715,  # Karnofsky performance status
-            ]
-        ).first()
-        
-        if performance_obs:
-            if performance_obs.value_as_number is not None:
-                if performance_obs.observation_concept_id == 4161279:  # ECOG
-                    patient_info.ecog_performance_status = int(performance_obs.value_as_number)
-                elif performance_obs.observation_concept_id == 4174715:  # Karnofsky
-                    patient_info.karnofsky_performance_score = int(performance_obs.value_as_number)
+        if observations.get('ecog') is not None:
+            patient_info.ecog_performance_status = int(observations['ecog'])
+        if observations.get('karnofsky') is not None:
+            patient_info.karnofsky_performance_score = int(observations['karnofsky'])
 
         # Smoking status
-        smoking_obs = Observation.objects.filter(
-            person=person,
-            observation_concept_id=4013634  # Smoking status
-        ).first()
-        
-        if smoking_obs and smoking_obs.observation_source_value:
-            patient_info.no_tobacco_use_status = smoking_obs.observation_source_value.lower() == 'never'
-            if smoking_obs.observation_source_value.lower() != 'never':
-                patient_info.tobacco_use_details = smoking_obs.observation_source_value
+        smoking = observations.get('smoking')
+        if smoking:
+            patient_info.no_tobacco_use_status = smoking.lower() == 'never'
+            if smoking.lower() != 'never':
+                patient_info.tobacco_use_details = smoking
 
         # Alcohol use
-        alcohol_obs = Observation.objects.filter(
-            person=person,
-            observation_concept_id=4267213  # Alcohol use
-        ).first()
-        
-        if alcohol_obs and alcohol_obs.observation_source_value:
+        alcohol = observations.get('alcohol')
+        if alcohol:
             # Store alcohol use details if not 'Never'
-            if alcohol_obs.observation_source_value.lower() != 'never':
-                patient_info.substance_use_details = f"Alcohol: {alcohol_obs.observation_source_value}"
+            if alcohol.lower() != 'never':
+                patient_info.substance_use_details = f"Alcohol: {alcohol}"
 
     def extract_treatment_info(self, person, patient_info):
         """Extract treatment information from TreatmentRegimen and TreatmentLine"""
@@ -1,5 +1,12 @@
-from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from omop.concept_classifier import (
+    PATIENT_INFO_LAB_FIELDS, get_concept_classifier, is_cancer_condition
+)
+from omop.measurement_queries import latest_lab_values
+from omop.patient_payload import build_payload, to_json_value
 from omop.models import (
     Person, PatientInfo, ConditionOccurrence, Measurement, 
     DrugExposure, ProcedureOccurrence, Observation, Episode,
@@ -8,12 +15,160 @@ from omop.models import (
     RadiationOccurrence, StemCellTransplant, ClinicalTrial, BiospecimenCollection,
     OncologyEpisodeDetail, CancerStagingMap, OncologyVocabulary
 )
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, timedelta
+from io import StringIO
 import logging
-import json
+import multiprocessing
+import os
+import time
+
+import django
 
 logger = logging.getLogger(__name__)
 
+# PatientInfo columns assigned by Command.update_patient_info; the other
+# attributes it sets have no column and are not persisted
+PATIENT_INFO_FIELDS = ['patient_age', 'gender', 'disease', 'stage'] + PATIENT_INFO_LAB_FIELDS + [
+    'biomarker_results', 'genetic_test_results', 'omop_data_json', 'updated_at',
+]
+
+# Person-keyed OMOP tables read by the get_* builders:
+# (records key, model, select_related, ordering)
+PATIENT_DATA_TABLES = [
+    ('conditions', ConditionOccurrence, ['condition_concept', 'person'], ['condition_start_date']),
+    ('measurements', Measurement, ['measurement_concept', 'unit_concept'], ['-measurement_datetime']),
+    ('biomarker_measurements', BiomarkerMeasurement, [], []),
+    ('trial_biomarkers', ClinicalTrialBiomarker, [], []),
+    ('genomic_variants', GenomicVariant, [], []),
+    ('molecular_tests', MolecularTest, [], []),
+    ('treatment_lines', TreatmentLine, [], ['line_number']),
+    ('treatment_regimens', TreatmentRegimen, [], ['regimen_start_date']),
+    ('drug_exposures', DrugExposure, ['drug_concept'], ['-drug_exposure_start_datetime']),
+    ('procedures', ProcedureOccurrence, ['procedure_concept'], ['-procedure_datetime']),
+    ('observations', Observation, [], []),
+    ('tumor_assessments', TumorAssessment, [], ['-assessment_date']),
+    ('episodes', Episode, [], ['episode_start_date']),
+    ('episode_details', OncologyEpisodeDetail, [], ['pk']),
+    ('clinical_trials', ClinicalTrial, [], []),
+    ('radiation', RadiationOccurrence, ['radiation_concept'], []),
+    ('transplants', StemCellTransplant, [], []),
+    ('biospecimens', BiospecimenCollection, [], []),
+]
+
+
+def fetch_patient_records(person_ids):
+    """
+    Fetch the OMOP rows of a batch of persons with one query per table.
+
+    Returns {person_id: {records key: [rows]}} with rows in each table's
+    builder ordering and concept FKs already joined, plus 'latest_labs':
+    {lab field: latest Measurement} from one more query.
+    """
+    records = {
+        person_id: {key: [] for key, _, _, _ in PATIENT_DATA_TABLES}
+        for person_id in person_ids
+    }
+    for key, model, related, ordering in PATIENT_DATA_TABLES:
+        rows = model.objects.filter(person_id__in=person_ids)
+        if related:
+            rows = rows.select_related(*related)
+        if ordering:
+            rows = rows.order_by(*ordering)
+        for row in rows:
+            records[row.person_id][key].append(row)
+    for person_id, lab_values in latest_lab_values(person_ids).items():
+        records[person_id]['latest_labs'] = lab_values
+    return records
+
+
+def iter_person_batches(persons, batch_size, start_after=None):
+    """
+    Yield lists of persons ordered by person_id using keyset pagination.
+    
+    Each batch is selected with person_id > last seen ORDER BY person_id
+    LIMIT batch_size, so late batches cost the same as early ones.
+    """
+    persons = persons.order_by('person_id')
+    last_seen = start_after
+    while True:
+        page = persons if last_seen is None else persons.filter(person_id__gt=last_seen)
+        batch = list(page[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_seen = batch[-1].person_id
+
+
+def default_checkpoint_file():
+    """populate_patient_info.checkpoint in settings.PATIENT_INFO_CHECKPOINT_DIR."""
+    return os.path.join(
+        getattr(settings, 'PATIENT_INFO_CHECKPOINT_DIR', '.'), 'populate_patient_info.checkpoint'
+    )
+
+
+def read_checkpoint(path):
+    """Return the last completed person_id stored in a checkpoint file, or None."""
+    try:
+        with open(path) as checkpoint:
+            return int(checkpoint.read().strip())
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        raise CommandError(f'Invalid checkpoint file: {path}')
+
+
+def write_checkpoint(path, person_id):
+    """Atomically record the last completed person_id."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as checkpoint:
+        checkpoint.write(f'{person_id}\n')
+    os.replace(temp_path, path)
+
+
+def person_id_ranges(person_ids, n_ranges):
+    """
+    Split sorted person IDs into at most n_ranges contiguous, non-empty
+    (first_id, last_id) ranges holding roughly equal numbers of persons.
+    """
+    size, remainder = divmod(len(person_ids), n_ranges)
+    ranges = []
+    start = 0
+    for i in range(n_ranges):
+        end = start + size + (1 if i < remainder else 0)
+        if end > start:
+            ranges.append((person_ids[start], person_ids[end - 1]))
+        start = end
+    return ranges
+
+
+def _populate_range(first_id, last_id, batch_size, dry_run, force_update):
+    """
+    Process pool entry point: populate PatientInfo for one person_id range.
+    """
+    started = time.perf_counter()
+    stderr = StringIO()
+    try:
+        totals = Command(stdout=StringIO(), stderr=stderr).populate(
+            Person.objects.filter(person_id__gte=first_id, person_id__lte=last_id),
+            batch_size, dry_run, force_update
+        )
+    finally:
+        # Release this worker's connection; never close the parent's
+        if multiprocessing.parent_process() is not None:
+            connections.close_all()
+
+    return {
+        'pid': os.getpid(),
+        'first_id': first_id,
+        'last_id': last_id,
+        'seconds': time.perf_counter() - started,
+        'totals': totals,
+        'error_lines': stderr.getvalue().splitlines(),
+    }
+
+
 class Command(BaseCommand):
     help = 'Populate PatientInfo table from OMOP CDM tables with comprehensive oncology extensions'
 
@@ -39,12 +194,54 @@ class Command(BaseCommand):
             action='store_true',
             help='Force update existing PatientInfo records',
         )
+        parser.add_argument(
+            '--start-after',
+            type=int,
+            help='Only process persons with a person_id greater than this',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Continue after the last person_id recorded in the checkpoint file',
+        )
+        parser.add_argument(
+            '--checkpoint-file',
+            type=str,
+            help='File recording the last completed person_id '
+                 '(default: populate_patient_info.checkpoint in settings.PATIENT_INFO_CHECKPOINT_DIR)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes, each handling a contiguous person_id range (default: 1)',
+        )
 
     def handle(self, *args, **options):
         person_id = options.get('person_id')
         batch_size = options.get('batch_size')
         dry_run = options.get('dry_run')
         force_update = options.get('force_update')
+        start_after = options.get('start_after')
+        checkpoint_file = options.get('checkpoint_file') or default_checkpoint_file()
+        workers = options.get('workers')
+        
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+        
+        if options.get('resume'):
+            if workers > 1:
+                raise CommandError('--resume cannot be used with --workers')
+            if start_after is not None:
+                raise CommandError('--resume and --start-after cannot be used together')
+            start_after = read_checkpoint(checkpoint_file)
+            if start_after is None:
+                self.stdout.write(f'No checkpoint found in {checkpoint_file}, starting from the beginning')
+        
+        if start_after is not None:
+            self.stdout.write(f'Starting after person {start_after}')
         
         if dry_run:
             self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
@@ -56,75 +253,198 @@ class Command(BaseCommand):
             persons = Person.objects.all()
             self.stdout.write(f'Processing all persons in batches of {batch_size}')
         
-        total_processed = 0
-        total_created = 0
-        total_updated = 0
+        if start_after is not None:
+            persons = persons.filter(person_id__gt=start_after)
         
-        for i in range(0, persons.count(), batch_size):
-            batch = persons[i:i + batch_size]
+        if workers > 1 and not person_id:
+            totals = self.populate_in_parallel(persons, workers, batch_size, dry_run, force_update)
+        else:
+            use_checkpoint = not dry_run and not person_id
+            totals = self.populate(
+                persons, batch_size, dry_run, force_update,
+                checkpoint_file if use_checkpoint else None
+            )
             
-            for person in batch:
-                try:
-                    created, updated = self.process_person(person, dry_run, force_update)
-                    if created:
-                        total_created += 1
-                    if updated:
-                        total_updated += 1
-                    total_processed += 1
-                    
-                    if total_processed % 50 == 0:
-                        self.stdout.write(f'Processed {total_processed} persons...')
-                        
-                except Exception as e:
-                    self.stderr.write(f'Error processing person {person.person_id}: {str(e)}')
-                    logger.error(f'Error processing person {person.person_id}: {str(e)}')
+            # A finished run has nothing to resume, unless persons failed
+            if use_checkpoint and os.path.exists(checkpoint_file):
+                if totals['errors']:
+                    self.stdout.write(self.style.WARNING(
+                        f'Checkpoint kept at person {read_checkpoint(checkpoint_file)} because of '
+                        f'{totals["errors"]} errors; rerun with --resume to retry from there'
+                    ))
+                else:
+                    os.remove(checkpoint_file)
         
         self.stdout.write(
             self.style.SUCCESS(
-                f'Processing complete. Processed: {total_processed}, '
-                f'Created: {total_created}, Updated: {total_updated}'
+                f'Processing complete. Processed: {totals["processed"]}, '
+                f'Created: {totals["created"]}, Updated: {totals["updated"]}, '
+                f'Errors: {totals["errors"]}'
             )
         )
 
-    @transaction.atomic
-    def process_person(self, person, dry_run=False, force_update=False):
-        """Process a single person and create/update PatientInfo"""
+    def populate(self, persons, batch_size, dry_run=False, force_update=False,
+                 checkpoint_file=None):
+        """
+        Process persons in keyset batches and return the summed counts.
+        
+        When checkpoint_file is given, the last person_id of each finished
+        batch is recorded there. It stops advancing at the first batch with
+        errors, so --resume retries the failed persons.
+        """
+        totals = {'processed': 0, 'created': 0, 'updated': 0, 'errors': 0}
+        total_persons = persons.count()
+        total_seen = 0
+        started = time.perf_counter()
+        checkpoint_held = False
+        
+        for batch in iter_person_batches(persons, batch_size):
+            counts = self.process_batch(batch, dry_run, force_update)
+            for key, count in zip(totals, counts):
+                totals[key] += count
+            total_seen += len(batch)
+            
+            if counts[3]:
+                checkpoint_held = True
+            if checkpoint_file and not checkpoint_held:
+                write_checkpoint(checkpoint_file, batch[-1].person_id)
+            
+            self.stdout.write(self.format_progress(total_seen, total_persons, started))
         
-        # Check if PatientInfo already exists
-        patient_info, created = PatientInfo.objects.get_or_create(person=person)
+        return totals
+
+    def populate_in_parallel(self, persons, workers, batch_size, dry_run, force_update):
+        """
+        Shard persons into person_id ranges across a process pool and sum the counts.
+        
+        Each worker opens its own database connection; the parent's
+        connections are closed first so forked workers never share them.
+        """
+        ranges = person_id_ranges(
+            list(persons.order_by('person_id').values_list('person_id', flat=True)), workers
+        )
+        totals = {'processed': 0, 'created': 0, 'updated': 0, 'errors': 0}
+        if not ranges:
+            return totals
+        
+        connections.close_all()
+        
+        with ProcessPoolExecutor(max_workers=len(ranges), initializer=django.setup) as pool:
+            futures = [
+                pool.submit(_populate_range, first_id, last_id, batch_size, dry_run, force_update)
+                for first_id, last_id in ranges
+            ]
+            for future in futures:
+                result = future.result()
+                for key in totals:
+                    totals[key] += result['totals'][key]
+                for line in result['error_lines']:
+                    self.stderr.write(line)
+                
+                seconds = result['seconds']
+                n_persons = result['totals']['processed'] + result['totals']['errors']
+                rate = n_persons / seconds if seconds else 0
+                self.stdout.write(
+                    f"Worker {result['pid']}: persons {result['first_id']}-{result['last_id']}, "
+                    f"{n_persons} in {seconds:.2f}s ({rate:.1f} rows/s)"
+                )
+        
+        return totals
+
+    def format_progress(self, seen, total, started):
+        """Progress line with throughput and estimated time remaining."""
+        elapsed = time.perf_counter() - started
+        rate = seen / elapsed if elapsed > 0 else 0
+        eta = timedelta(seconds=round((total - seen) / rate)) if rate else 'unknown'
+        return f'Processed {seen}/{total} persons ({rate:.1f} rows/s, ETA {eta})'
+
+    def process_batch(self, persons, dry_run=False, force_update=False):
+        """
+        Create/update PatientInfo for a batch of persons.
+        
+        Existing rows are loaded with one query, new and changed instances are
+        built in memory and written with bulk_create/bulk_update in a single
+        transaction. Returns (processed, created, updated, errors) counts.
+        """
+        existing = PatientInfo.objects.in_bulk(
+            [person.person_id for person in persons], field_name='person_id'
+        )
         
-        if not created and not force_update:
-            return False, False
+        # Existing records are left alone unless forced
+        to_process = [
+            person for person in persons
+            if force_update or person.person_id not in existing
+        ]
+        records = fetch_patient_records([person.person_id for person in to_process])
         
-        # Collect all data for this person
-        patient_data = self.collect_patient_data(person)
+        new_infos = []
+        changed_infos = []
+        processed = len(persons) - len(to_process)
+        errors = 0
         
-        if dry_run:
-            self.stdout.write(f'DRY RUN: Would process person {person.person_id}')
-            return False, False
+        for person in to_process:
+            try:
+                patient_data = self.collect_patient_data(person, records[person.person_id])
+                
+                if dry_run:
+                    self.stdout.write(f'DRY RUN: Would process person {person.person_id}')
+                    processed += 1
+                    continue
+                
+                patient_info = existing.get(person.person_id)
+                if patient_info is None:
+                    patient_info = PatientInfo(person=person)
+                    new_infos.append(patient_info)
+                else:
+                    changed_infos.append(patient_info)
+                
+                self.update_patient_info(patient_info, patient_data)
+                processed += 1
+                
+            except Exception as e:
+                errors += 1
+                self.stderr.write(f'Error processing person {person.person_id}: {str(e)}')
+                logger.error(f'Error processing person {person.person_id}: {str(e)}')
+        
+        if new_infos or changed_infos:
+            try:
+                with transaction.atomic():
+                    PatientInfo.objects.bulk_create(new_infos)
+                    PatientInfo.objects.bulk_update(changed_infos, fields=PATIENT_INFO_FIELDS)
+            except Exception as e:
+                first_id = persons[0].person_id
+                self.stderr.write(f'Error saving batch starting at person {first_id}: {str(e)}')
+                logger.error(f'Error saving batch starting at person {first_id}: {str(e)}')
+                failed = len(new_infos) + len(changed_infos)
+                return processed - failed, 0, 0, errors + failed
+        
+        return processed, len(new_infos), len(changed_infos), errors
+
+    def collect_patient_data(self, person, records=None):
+        """
+        Collect comprehensive patient data from all OMOP tables.
         
-        # Update PatientInfo with collected data
-        updated = self.update_patient_info(patient_info, patient_data)
+        records are the person's prefetched rows from fetch_patient_records;
+        they are fetched here when not supplied.
+        """
+        if records is None:
+            records = fetch_patient_records([person.person_id])[person.person_id]
         
-        return created, updated
-
-    def collect_patient_data(self, person):
-        """Collect comprehensive patient data from all OMOP tables"""
         data = {
             'demographics': self.get_demographics(person),
-            'conditions': self.get_cancer_conditions(person),
-            'measurements': self.get_measurements(person),
-            'biomarkers': self.get_biomarkers(person),
-            'genomics': self.get_genomics(person),
-            'treatments': self.get_treatments(person),
-            'procedures': self.get_procedures(person),
-            'observations': self.get_observations(person),
-            'staging': self.get_staging_info(person),
-            'episodes': self.get_episode_data(person),
-            'trials': self.get_trial_participation(person),
-            'radiation': self.get_radiation_therapy(person),
-            'transplants': self.get_transplants(person),
-            'biospecimens': self.get_biospecimens(person),
+            'conditions': self.get_cancer_conditions(records),
+            'measurements': self.get_measurements(records),
+            'biomarkers': self.get_biomarkers(records),
+            'genomics': self.get_genomics(records),
+            'treatments': self.get_treatments(records),
+            'procedures': self.get_procedures(records),
+            'observations': self.get_observations(records),
+            'staging': self.get_staging_info(records),
+            'episodes': self.get_episode_data(records),
+            'trials': self.get_trial_participation(records),
+            'radiation': self.get_radiation_therapy(records),
+            'transplants': self.get_transplants(records),
+            'biospecimens': self.get_biospecimens(records),
         }
         return data
 
@@ -149,16 +469,12 @@ class Command(BaseCommand):
             'ethnicity_concept_id': person.ethnicity_concept_id,
         }
 
-    def get_cancer_conditions(self, person):
+    def get_cancer_conditions(self, records):
         """Get primary cancer condition with enhanced staging"""
-        conditions = ConditionOccurrence.objects.filter(
-            person=person
-        ).order_by('condition_start_date')
-        
         primary_condition = None
-        for condition in conditions:
+        for condition in records['conditions']:
             # Check if this is a cancer condition
-            if self.is_cancer_condition(condition):
+            if is_cancer_condition(condition):
                 primary_condition = condition
                 break
         
@@ -180,46 +496,28 @@ class Command(BaseCommand):
             'grade': getattr(primary_condition, 'histologic_grade', None),
         }
 
-    def get_measurements(self, person):
+    def get_measurements(self, records):
         """Get enhanced measurement data with oncology biomarkers"""
-        measurements = Measurement.objects.filter(person=person).order_by('-measurement_datetime')
-        
         measurement_data = {}
         
-        # Standard lab values
-        for measurement in measurements:
-            concept_name = getattr(measurement.measurement_concept, 'concept_name', '').lower()
-            
-            # Map common lab values
-            if 'hemoglobin' in concept_name:
-                measurement_data['hemoglobin'] = measurement.value_as_number
+        # Latest standard lab values, keyed by PatientInfo field
+        for lab_field, measurement in records['latest_labs'].items():
+            measurement_data[lab_field] = measurement.value_as_number
+            if lab_field == 'hemoglobin_level':
                 measurement_data['hemoglobin_unit'] = self.get_unit_name(measurement.unit_concept)
-            elif 'hematocrit' in concept_name:
-                measurement_data['hematocrit'] = measurement.value_as_number
-            elif 'platelet' in concept_name:
-                measurement_data['platelet_count'] = measurement.value_as_number
-            elif 'white blood cell' in concept_name or 'wbc' in concept_name:
-                measurement_data['wbc_count'] = measurement.value_as_number
-            elif 'creatinine' in concept_name:
-                measurement_data['creatinine'] = measurement.value_as_number
-            elif 'bilirubin' in concept_name:
-                measurement_data['bilirubin'] = measurement.value_as_number
-            elif 'albumin' in concept_name:
-                measurement_data['albumin'] = measurement.value_as_number
         
         # Add oncology-specific biomarker measurements
-        biomarker_summary = self.get_biomarker_summary(person)
+        biomarker_summary = self.get_biomarker_summary(records)
         measurement_data.update(biomarker_summary)
         
         return measurement_data
 
-    def get_biomarkers(self, person):
+    def get_biomarkers(self, records):
         """Get comprehensive biomarker data from multiple sources"""
         biomarker_data = {}
         
         # From enhanced Measurement table with oncology extensions
-        measurements = Measurement.objects.filter(person=person)
-        for measurement in measurements:
+        for measurement in records['measurements']:
             if hasattr(measurement, 'expression_level') and measurement.expression_level:
                 biomarker_data['expression_levels'] = biomarker_data.get('expression_levels', [])
                 biomarker_data['expression_levels'].append({
@@ -249,8 +547,7 @@ class Command(BaseCommand):
                 biomarker_data['pdl1_ics'] = measurement.pdl1_immune_cell_score
         
         # From BiomarkerMeasurement table
-        biomarker_measurements = BiomarkerMeasurement.objects.filter(person=person)
-        for bm in biomarker_measurements:
+        for bm in records['biomarker_measurements']:
             biomarker_data['specialized_biomarkers'] = biomarker_data.get('specialized_biomarkers', [])
             biomarker_data['specialized_biomarkers'].append({
                 'name': bm.biomarker_name,
@@ -262,8 +559,7 @@ class Command(BaseCommand):
             })
         
         # From ClinicalTrialBiomarker table
-        trial_biomarkers = ClinicalTrialBiomarker.objects.filter(person=person)
-        for tb in trial_biomarkers:
+        for tb in records['trial_biomarkers']:
             biomarker_data['trial_biomarkers'] = biomarker_data.get('trial_biomarkers', [])
             biomarker_data['trial_biomarkers'].append({
                 'type': tb.biomarker_type,
@@ -276,14 +572,13 @@ class Command(BaseCommand):
         
         return biomarker_data
 
-    def get_genomics(self, person):
+    def get_genomics(self, records):
         """Get genomic variant and molecular test data"""
         genomic_data = {}
         
         # Genomic variants
-        variants = GenomicVariant.objects.filter(person=person)
         variant_list = []
-        for variant in variants:
+        for variant in records['genomic_variants']:
             variant_list.append({
                 'gene': variant.gene_symbol,
                 'variant_type': variant.variant_type,
@@ -297,9 +592,8 @@ class Command(BaseCommand):
         genomic_data['variants'] = variant_list
         
         # Molecular tests
-        mol_tests = MolecularTest.objects.filter(person=person)
         test_list = []
-        for test in mol_tests:
+        for test in records['molecular_tests']:
             test_list.append({
                 'name': test.test_name,
                 'type': test.test_type,
@@ -313,15 +607,14 @@ class Command(BaseCommand):
         
         return genomic_data
 
-    def get_treatments(self, person):
+    def get_treatments(self, records):
         """Get comprehensive treatment data with oncology extensions"""
         treatment_data = {}
         
         # Treatment lines
-        treatment_lines = TreatmentLine.objects.filter(person=person).order_by('line_number')
         lines_data = []
         
-        for line in treatment_lines:
+        for line in records['treatment_lines']:
             line_data = {
                 'line_number': line.line_number,
                 'start_date': line.line_start_date,
@@ -341,10 +634,9 @@ class Command(BaseCommand):
         treatment_data['treatment_lines'] = lines_data
         
         # Treatment regimens
-        regimens = TreatmentRegimen.objects.filter(person=person).order_by('regimen_start_date')
         regimen_data = []
         
-        for regimen in regimens:
+        for regimen in records['treatment_regimens']:
             regimen_data.append({
                 'name': regimen.regimen_name,
                 'line_number': regimen.line_number,
@@ -362,10 +654,9 @@ class Command(BaseCommand):
         treatment_data['regimens'] = regimen_data
         
         # Drug exposures with enhanced tracking
-        drugs = DrugExposure.objects.filter(person=person).order_by('-drug_exposure_start_datetime')
         drug_data = []
         
-        for drug in drugs:
+        for drug in records['drug_exposures']:
             drug_data.append({
                 'drug_name': getattr(drug.drug_concept, 'concept_name', ''),
                 'start_date': drug.drug_exposure_start_datetime,
@@ -384,12 +675,10 @@ class Command(BaseCommand):
         
         return treatment_data
 
-    def get_procedures(self, person):
+    def get_procedures(self, records):
         """Get procedure data with surgical oncology extensions"""
-        procedures = ProcedureOccurrence.objects.filter(person=person).order_by('-procedure_datetime')
-        
         procedure_data = []
-        for proc in procedures:
+        for proc in records['procedures']:
             proc_info = {
                 'procedure_name': getattr(proc.procedure_concept, 'concept_name', ''),
                 'date': proc.procedure_datetime,
@@ -416,10 +705,8 @@ class Command(BaseCommand):
         
         return procedure_data
 
-    def get_observations(self, person):
+    def get_observations(self, records):
         """Get comprehensive observation data including behavioral and social determinants"""
-        observations = Observation.objects.filter(person=person)
-        
         obs_data = {
             'performance_status': [],
             'behavioral_factors': {},
@@ -427,7 +714,7 @@ class Command(BaseCommand):
             'genetic_findings': [],
         }
         
-        for obs in observations:
+        for obs in records['observations']:
             # Performance status
             if hasattr(obs, 'performance_score_type') and obs.performance_score_type:
                 obs_data['performance_status'].append({
@@ -466,14 +753,13 @@ class Command(BaseCommand):
         
         return obs_data
 
-    def get_staging_info(self, person):
+    def get_staging_info(self, records):
         """Get comprehensive staging information"""
         staging_data = {}
         
         # From ConditionOccurrence with enhanced staging
-        conditions = ConditionOccurrence.objects.filter(person=person)
-        for condition in conditions:
-            if self.is_cancer_condition(condition):
+        for condition in records['conditions']:
+            if is_cancer_condition(condition):
                 staging_data.update({
                     'clinical_t': getattr(condition, 'ajcc_clinical_t', None),
                     'clinical_n': getattr(condition, 'ajcc_clinical_n', None),
@@ -489,9 +775,9 @@ class Command(BaseCommand):
                 break
         
         # From TumorAssessment
-        assessments = TumorAssessment.objects.filter(person=person).order_by('-assessment_date')
-        if assessments.exists():
-            latest_assessment = assessments.first()
+        assessments = records['tumor_assessments']
+        if assessments:
+            latest_assessment = assessments[0]
             staging_data.update({
                 'latest_assessment_date': latest_assessment.assessment_date,
                 'assessment_method': latest_assessment.assessment_method,
@@ -503,12 +789,15 @@ class Command(BaseCommand):
         
         return staging_data
 
-    def get_episode_data(self, person):
+    def get_episode_data(self, records):
         """Get episode and disease progression data"""
-        episodes = Episode.objects.filter(person=person).order_by('episode_start_date')
+        # First oncology detail of each episode
+        details = {}
+        for detail in records['episode_details']:
+            details.setdefault(detail.episode_id, detail)
         
         episode_data = []
-        for episode in episodes:
+        for episode in records['episodes']:
             ep_data = {
                 'episode_type': episode.episode_type,
                 'start_date': episode.episode_start_date,
@@ -518,9 +807,8 @@ class Command(BaseCommand):
             }
             
             # Get oncology episode details
-            details = OncologyEpisodeDetail.objects.filter(episode=episode)
-            if details.exists():
-                detail = details.first()
+            detail = details.get(episode.episode_id)
+            if detail:
                 ep_data.update({
                     'days_from_diagnosis': detail.days_from_diagnosis,
                     'disease_status_detail': detail.disease_status,
@@ -533,12 +821,10 @@ class Command(BaseCommand):
         
         return episode_data
 
-    def get_trial_participation(self, person):
+    def get_trial_participation(self, records):
         """Get clinical trial participation data"""
-        trials = ClinicalTrial.objects.filter(person=person)
-        
         trial_data = []
-        for trial in trials:
+        for trial in records['clinical_trials']:
             trial_data.append({
                 'nct_number': trial.nct_number,
                 'title': trial.trial_title,
@@ -553,12 +839,10 @@ class Command(BaseCommand):
         
         return trial_data
 
-    def get_radiation_therapy(self, person):
+    def get_radiation_therapy(self, records):
         """Get radiation therapy data"""
-        radiation = RadiationOccurrence.objects.filter(person=person)
-        
         radiation_data = []
-        for rad in radiation:
+        for rad in records['radiation']:
             radiation_data.append({
                 'radiation_type': getattr(rad.radiation_concept, 'concept_name', ''),
                 'start_date': rad.radiation_occurrence_start_date,
@@ -572,12 +856,10 @@ class Command(BaseCommand):
         
         return radiation_data
 
-    def get_transplants(self, person):
+    def get_transplants(self, records):
         """Get stem cell transplant data"""
-        transplants = StemCellTransplant.objects.filter(person=person)
-        
         transplant_data = []
-        for tx in transplants:
+        for tx in records['transplants']:
             transplant_data.append({
                 'transplant_type': tx.transplant_type,
                 'date': tx.transplant_date,
@@ -588,12 +870,10 @@ class Command(BaseCommand):
         
         return transplant_data
 
-    def get_biospecimens(self, person):
+    def get_biospecimens(self, records):
         """Get biospecimen collection data"""
-        biospecimens = BiospecimenCollection.objects.filter(person=person)
-        
         biospecimen_data = []
-        for bio in biospecimens:
+        for bio in records['biospecimens']:
             biospecimen_data.append({
                 'specimen_type': bio.specimen_type,
                 'collection_date': bio.collection_date,
@@ -607,7 +887,7 @@ class Command(BaseCommand):
         return biospecimen_data
 
     def update_patient_info(self, patient_info, data):
-        """Update PatientInfo with collected data"""
+        """Apply collected data to a PatientInfo instance (saved by the caller)"""
         demographics = data['demographics']
         conditions = data['conditions']
         measurements = data['measurements']
@@ -638,20 +918,16 @@ class Command(BaseCommand):
         
         # Update lab values
         if measurements:
-            patient_info.hemoglobin = measurements.get('hemoglobin')
+            for lab_field in PATIENT_INFO_LAB_FIELDS:
+                setattr(patient_info, lab_field, measurements.get(lab_field))
             patient_info.hemoglobin_unit = measurements.get('hemoglobin_unit', 'g/dL')
             patient_info.hematocrit = measurements.get('hematocrit')
-            patient_info.platelet_count = measurements.get('platelet_count')
-            patient_info.wbc_count = measurements.get('wbc_count')
-            patient_info.creatinine = measurements.get('creatinine')
-            patient_info.bilirubin = measurements.get('bilirubin')
-            patient_info.albumin = measurements.get('albumin')
         
         # Update biomarker information
         biomarkers = data['biomarkers']
         if biomarkers:
             # Store biomarker data as JSON
-            patient_info.biomarker_results = json.dumps(biomarkers)
+            patient_info.biomarker_results = to_json_value(biomarkers)
             
             # Extract key biomarkers for direct fields
             if 'pdl1_cps' in biomarkers:
@@ -662,7 +938,7 @@ class Command(BaseCommand):
         # Update genomic information
         genomics = data['genomics']
         if genomics and genomics.get('variants'):
-            patient_info.genetic_test_results = json.dumps(genomics)
+            patient_info.genetic_test_results = to_json_value(genomics)
         
         # Update treatment information
         if treatments:
@@ -685,71 +961,54 @@ class Command(BaseCommand):
             patient_info.prior_immunotherapy = has_immunotherapy
             patient_info.prior_targeted_therapy = has_targeted
         
-        # Store comprehensive data as JSON
-        patient_info.omop_data_json = json.dumps(data, default=str)
+        # Store the remaining sections as a versioned document
+        patient_info.omop_data_json = build_payload(data)
         
         # Update timestamps
-        patient_info.last_updated = date.today()
-        
-        patient_info.save()
-        return True
+        patient_info.updated_at = timezone.now()
 
-    def get_biomarker_summary(self, person):
+    def get_biomarker_summary(self, records):
         """Get biomarker summary for key oncology markers"""
         summary = {}
+        classifier = get_concept_classifier()
         
         # Get key biomarkers from Measurement table
-        measurements = Measurement.objects.filter(person=person)
-        
-        for measurement in measurements:
-            concept_name = getattr(measurement.measurement_concept, 'concept_name', '').lower()
+        for measurement in records['measurements']:
+            biomarker = classifier.biomarker(measurement.measurement_concept_id)
             
             # HER2 status
-            if 'her2' in concept_name:
+            if biomarker == 'her2':
                 if hasattr(measurement, 'ihc_score') and measurement.ihc_score:
                     summary['her2_ihc'] = measurement.ihc_score
                 if hasattr(measurement, 'fish_interpretation') and measurement.fish_interpretation:
                     summary['her2_fish'] = measurement.fish_interpretation
             
             # ER/PR status
-            elif 'estrogen receptor' in concept_name or 'er status' in concept_name:
+            elif biomarker == 'er':
                 if hasattr(measurement, 'expression_level') and measurement.expression_level:
                     summary['er_status'] = measurement.expression_level
                 if hasattr(measurement, 'percent_positive_cells'):
                     summary['er_percent'] = measurement.percent_positive_cells
             
-            elif 'progesterone receptor' in concept_name or 'pr status' in concept_name:
+            elif biomarker == 'pr':
                 if hasattr(measurement, 'expression_level') and measurement.expression_level:
                     summary['pr_status'] = measurement.expression_level
                 if hasattr(measurement, 'percent_positive_cells'):
                     summary['pr_percent'] = measurement.percent_positive_cells
             
             # TMB and MSI
-            elif 'tumor mutational burden' in concept_name or 'tmb' in concept_name:
+            elif biomarker == 'tmb':
                 if hasattr(measurement, 'tmb_status') and measurement.tmb_status:
                     summary['tmb_status'] = measurement.tmb_status
                 if hasattr(measurement, 'tmb_score'):
                     summary['tmb_score'] = measurement.tmb_score
             
-            elif 'microsatellite' in concept_name or 'msi' in concept_name:
+            elif biomarker == 'msi':
                 if hasattr(measurement, 'msi_status') and measurement.msi_status:
                     summary['msi_status'] = measurement.msi_status
         
         return summary
 
-    def is_cancer_condition(self, condition):
-        """Check if condition is a cancer diagnosis"""
-        if not condition.condition_concept:
-            return False
-        
-        concept_name = condition.condition_concept.concept_name.lower()
-        cancer_keywords = [
-            'cancer', 'carcinoma', 'adenocarcinoma', 'sarcoma', 'lymphoma', 
-            'leukemia', 'melanoma', 'tumor', 'neoplasm', 'malignant'
-        ]
-        
-        return any(keyword in concept_name for keyword in cancer_keywords)
-
     def get_disease_name(self, condition):
         """Extract disease name from condition"""
         if condition.condition_concept:
@@ -1,6 +1,8 @@
-from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.db.models import Q, Max
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from django.db.models import F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
 from omop.models import (
     Person, PatientInfo, ConditionOccurrence, Measurement, 
     DrugExposure, ProcedureOccurrence, Observation, Episode,
@@ -9,12 +11,34 @@ from omop.models import (
     RadiationOccurrence, StemCellTransplant, ClinicalTrial, BiospecimenCollection,
     OncologyEpisodeDetail
 )
-from datetime import date, datetime, timedelta
+from omop.change_log import (
+    CHANGE_LOG_GRACE, advance_watermark, changed_person_ids, get_watermark, prune_change_log,
+    settled_change_id
+)
+from omop.concept_classifier import PATIENT_INFO_LAB_FIELDS, cancer_concepts
+from omop.measurement_queries import latest_lab_values
+from omop.patient_payload import build_payload, to_json_value
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
 import logging
-import json
 
 logger = logging.getLogger(__name__)
 
+# PatientChangeWatermark consumer name for --since-watermark runs
+WATERMARK_CONSUMER = 'update_patient_info'
+
+
+def stored_value(field, value):
+    """Value as the PatientInfo column would store it."""
+    if value is None:
+        return None
+    value = field.to_python(value)
+    if isinstance(field, models.DecimalField):
+        return value.quantize(Decimal(1).scaleb(-field.decimal_places))
+    return value
+
+
 class Command(BaseCommand):
     help = 'Update PatientInfo records with latest data from OMOP CDM tables'
 
@@ -29,6 +53,21 @@ class Command(BaseCommand):
             type=str,
             help='Update records modified since date (YYYY-MM-DD)',
         )
+        parser.add_argument(
+            '--since-watermark',
+            action='store_true',
+            help='Update persons logged in PatientChangeLog since the last successful run. '
+                 'Only model save() and delete() are logged; QuerySet.update(), bulk_create, '
+                 'bulk_update and raw SQL send no signals, so those writes are missed unless '
+                 'the loader calls omop.change_log.log_person_changes()',
+        )
+        parser.add_argument(
+            '--watermark-grace',
+            type=int,
+            default=int(CHANGE_LOG_GRACE.total_seconds()),
+            help='With --since-watermark, leave changes logged in the last N seconds for the '
+                 'next run, so transactions still open are not skipped (default: %(default)s)',
+        )
         parser.add_argument(
             '--force-update',
             action='store_true',
@@ -58,6 +97,12 @@ class Command(BaseCommand):
         incremental = options.get('incremental')
         batch_size = options.get('batch_size')
         dry_run = options.get('dry_run')
+        since_watermark = options.get('since_watermark')
+        
+        if since_watermark and (person_id or updated_since):
+            raise CommandError('--since-watermark cannot be combined with --person-id or --updated-since')
+        if options.get('watermark_grace', 0) < 0:
+            raise CommandError('--watermark-grace must not be negative')
         
         # Parse updated_since date
         since_date = None
@@ -71,13 +116,26 @@ class Command(BaseCommand):
         self.stdout.write(f'Starting PatientInfo update ({"DRY RUN" if dry_run else "LIVE RUN"})')
         
         # Build query for persons to update
-        person_query = self.build_person_query(person_id, since_date, force_update)
+        if since_watermark:
+            # Changes logged after this point, or too recently to be surely
+            # committed, are left for the next run
+            watermark = get_watermark(WATERMARK_CONSUMER)
+            change_upto = max(watermark, settled_change_id(
+                timedelta(seconds=options.get('watermark_grace', CHANGE_LOG_GRACE.total_seconds()))
+            ))
+            person_query = self.build_changed_person_query(watermark, change_upto)
+            # The change log already shows these persons changed
+            force_update = True
+        else:
+            person_query = self.build_person_query(person_id, since_date, force_update)
         
         total_persons = person_query.count()
         self.stdout.write(f'Found {total_persons} persons to process')
         
         if total_persons == 0:
             self.stdout.write('No persons found matching criteria.')
+            if since_watermark:
+                self.finish_watermark_run({'errors': 0}, watermark, change_upto, dry_run)
             return
         
         update_stats = {
@@ -90,16 +148,45 @@ class Command(BaseCommand):
         
         # Process in batches
         for i in range(0, total_persons, batch_size):
-            batch_persons = person_query[i:i + batch_size]
+            batch_persons = list(person_query[i:i + batch_size])
+            
+            # One staleness query per batch instead of per person
+            stale_ids = None if force_update else self.get_stale_person_ids(
+                [person.person_id for person in batch_persons]
+            )
+            
+            # Existing rows for the batch in one query
+            existing = PatientInfo.objects.in_bulk(
+                [person.person_id for person in batch_persons], field_name='person_id'
+            )
+            new_infos = []
+            changed_infos = defaultdict(list)
+            
+            # Latest lab values of the persons to recompute in one query
+            lab_values = latest_lab_values(
+                [
+                    person.person_id for person in batch_persons
+                    if stale_ids is None or person.person_id in stale_ids
+                    or person.person_id not in existing
+                ],
+                PATIENT_INFO_LAB_FIELDS
+            )
             
             for person in batch_persons:
                 try:
-                    result = self.update_patient_info(
-                        person, incremental, force_update, dry_run
+                    result, patient_info, changed_fields = self.update_patient_info(
+                        person, incremental, force_update, dry_run,
+                        is_stale=stale_ids is None or person.person_id in stale_ids,
+                        patient_info=existing.get(person.person_id),
+                        lab_values=lab_values.get(person.person_id)
                     )
                     
                     update_stats['processed'] += 1
                     update_stats[result] += 1
+                    if result == 'created':
+                        new_infos.append(patient_info)
+                    elif changed_fields and not dry_run:
+                        changed_infos[tuple(changed_fields)].append(patient_info)
                     
                     if update_stats['processed'] % 50 == 0:
                         self.stdout.write(
@@ -110,8 +197,35 @@ class Command(BaseCommand):
                     update_stats['errors'] += 1
                     self.stderr.write(f'Error updating person {person.person_id}: {str(e)}')
                     logger.error(f'Error updating person {person.person_id}: {str(e)}')
+            
+            self.write_batch(new_infos, changed_infos, update_stats)
         
         self.print_update_summary(update_stats, dry_run)
+        
+        if since_watermark:
+            self.finish_watermark_run(update_stats, watermark, change_upto, dry_run)
+
+    def build_changed_person_query(self, watermark, change_upto):
+        """Persons with PatientChangeLog entries in (watermark, change_upto]"""
+        return Person.objects.filter(
+            person_id__in=changed_person_ids(watermark, change_upto)
+        ).order_by('person_id')
+
+    def finish_watermark_run(self, stats, watermark, change_upto, dry_run):
+        """Advance the change watermark after a live run without errors, then prune the log"""
+        if dry_run or change_upto == watermark:
+            return
+        if stats['errors']:
+            self.stdout.write(self.style.WARNING(
+                f'Change watermark left at {watermark} because of {stats["errors"]} errors'
+            ))
+            return
+        
+        advance_watermark(WATERMARK_CONSUMER, change_upto)
+        self.stdout.write(f'Change watermark advanced from {watermark} to {change_upto}')
+        pruned = prune_change_log()
+        if pruned:
+            self.stdout.write(f'Pruned {pruned} processed change log rows')
 
     def build_person_query(self, person_id, since_date, force_update):
         """Build query for persons to update"""
@@ -156,23 +270,29 @@ class Command(BaseCommand):
         
         return query.order_by('person_id')
 
-    def update_patient_info(self, person, incremental, force_update, dry_run):
-        """Update PatientInfo for a single person"""
-        
-        try:
-            patient_info = PatientInfo.objects.get(person=person)
-            is_new = False
-        except PatientInfo.DoesNotExist:
+    def update_patient_info(self, person, incremental, force_update, dry_run, is_stale=True,
+                            patient_info=None, lab_values=None):
+        """
+        Recompute PatientInfo for a single person without saving it.
+        
+        patient_info is the person's existing row, or None to build a new one.
+        lab_values is the person's slice of a batch latest_lab_values() call,
+        or None to query it here. is_stale comes from get_stale_person_ids; existing records that are
+        not stale are skipped unless force_update is set. A stale row whose
+        recompute changes nothing is 'skipped' with only updated_at changed,
+        so it is not found stale again. Returns
+        (result, patient_info, changed_fields) for write_batch.
+        """
+        is_new = patient_info is None
+        if is_new:
             patient_info = PatientInfo(person=person)
-            is_new = True
         
         # Check if update is needed
-        if not is_new and not force_update:
-            if self.should_skip_update(patient_info, person):
-                return 'skipped'
+        if not is_new and not force_update and not is_stale:
+            return 'skipped', patient_info, []
         
         # Store original values for comparison
-        original_data = self.get_patient_info_snapshot(patient_info) if not is_new else {}
+        original_data = self.get_patient_info_snapshot(patient_info)
         
         # Update demographics
         self.update_demographics(patient_info, person, incremental)
@@ -184,7 +304,7 @@ class Command(BaseCommand):
         self.update_staging(patient_info, person, incremental)
         
         # Update laboratory values
-        self.update_lab_values(patient_info, person, incremental)
+        self.update_lab_values(patient_info, person, incremental, lab_values)
         
         # Update biomarker data
         self.update_biomarkers(patient_info, person, incremental)
@@ -198,81 +318,101 @@ class Command(BaseCommand):
         # Update comprehensive OMOP data
         self.update_comprehensive_data(patient_info, person, incremental)
         
-        # Check if any changes were made
+        # Columns whose stored value would change
         current_data = self.get_patient_info_snapshot(patient_info)
-        has_changes = original_data != current_data or is_new
+        changed_fields = [
+            name for name, value in current_data.items() if value != original_data[name]
+        ]
+        has_changes = bool(changed_fields) or is_new
         
         if dry_run:
             if has_changes:
                 self.stdout.write(f'DRY RUN: Would {"create" if is_new else "update"} PatientInfo for person {person.person_id}')
-            return 'updated' if has_changes else 'skipped'
+            return ('updated' if has_changes else 'skipped'), patient_info, changed_fields
         
         if has_changes:
-            patient_info.updated_at = datetime.now()
-            patient_info.save()
-            return 'created' if is_new else 'updated'
+            patient_info.updated_at = timezone.now()
+            return ('created' if is_new else 'updated'), patient_info, changed_fields + ['updated_at']
+        elif not force_update:
+            # Found stale but up to date: stamp it so the next run skips it
+            patient_info.updated_at = timezone.now()
+            return 'skipped', patient_info, ['updated_at']
         else:
-            return 'skipped'
+            return 'skipped', patient_info, []
 
-    def should_skip_update(self, patient_info, person):
-        """Determine if update should be skipped"""
-        
-        # Get latest modification dates from OMOP data
-        latest_condition = ConditionOccurrence.objects.filter(person=person).aggregate(
-            max_date=Max('condition_start_date')
-        )['max_date']
-        
-        latest_measurement = Measurement.objects.filter(person=person).aggregate(
-            max_date=Max('measurement_date')
-        )['max_date']
-        
-        latest_drug = DrugExposure.objects.filter(person=person).aggregate(
-            max_date=Max('drug_exposure_start_date')
-        )['max_date']
-        
-        latest_procedure = ProcedureOccurrence.objects.filter(person=person).aggregate(
-            max_date=Max('procedure_date')
-        )['max_date']
-        
-        # Find the most recent OMOP modification
-        omop_dates = [d for d in [latest_condition, latest_measurement, latest_drug, latest_procedure] if d]
-        
-        if not omop_dates:
-            return True  # No OMOP data, skip update
-        
-        latest_omop_date = max(omop_dates)
+    def write_batch(self, new_infos, changed_infos, stats):
+        """
+        Write a batch in one transaction.
+        
+        New rows use bulk_create. Changed rows are grouped by the fields that
+        changed, and each group gets one bulk_update of only those columns;
+        skipped rows that are only re-stamped form the ('updated_at',) group.
+        """
+        if not new_infos and not changed_infos:
+            return
         
-        # Compare with PatientInfo update date
-        if patient_info.updated_at and patient_info.updated_at.date() >= latest_omop_date:
-            return True  # PatientInfo is newer or same age
+        try:
+            with transaction.atomic():
+                PatientInfo.objects.bulk_create(new_infos)
+                for fields, patient_infos in changed_infos.items():
+                    PatientInfo.objects.bulk_update(patient_infos, fields=list(fields))
+        except Exception as e:
+            failed_stamps = len(changed_infos.get(('updated_at',), []))
+            failed_updates = sum(len(patient_infos) for patient_infos in changed_infos.values()) - failed_stamps
+            stats['created'] -= len(new_infos)
+            stats['updated'] -= failed_updates
+            stats['skipped'] -= failed_stamps
+            stats['errors'] += len(new_infos) + failed_updates + failed_stamps
+            self.stderr.write(f'Error saving batch: {str(e)}')
+            logger.error(f'Error saving batch: {str(e)}')
+
+    def get_stale_person_ids(self, person_ids):
+        """
+        Return the IDs of persons whose PatientInfo is older than their OMOP data.
+        
+        One query: each PatientInfo row is annotated with the latest entry in
+        each OMOP table and kept if any is after it was last written (or it
+        was never stamped). Tables with datetimes are compared with
+        updated_at itself; conditions only have a date and are compared with
+        the day it was written. Persons without OMOP data are not stale.
+        Persons without a PatientInfo row are not returned; they are new.
+        """
+        latest_values = {
+            'latest_condition': (ConditionOccurrence, Max('condition_start_date'), 'updated_day'),
+            'latest_measurement': (Measurement, Max('measurement_datetime'), 'written_at'),
+            'latest_drug': (DrugExposure, Max('drug_exposure_start_datetime'), 'written_at'),
+            'latest_procedure': (ProcedureOccurrence, Max('procedure_datetime'), 'written_at'),
+        }
         
-        return False
+        # Rows never stamped count as written before any OMOP data
+        patient_infos = PatientInfo.objects.filter(person_id__in=person_ids).annotate(
+            written_at=Coalesce(
+                'updated_at', Value(datetime.min.replace(tzinfo=dt_timezone.utc)),
+                output_field=models.DateTimeField()
+            ),
+            updated_day=Coalesce(TruncDate('updated_at'), Value(date.min)),
+        )
+        newer_omop_data = Q()
+        for name, (model, latest, written) in latest_values.items():
+            patient_infos = patient_infos.annotate(**{name: Subquery(
+                model.objects.filter(person_id=OuterRef('person_id'))
+                .order_by().values('person_id').annotate(latest=latest).values('latest')
+            )})
+            newer_omop_data |= Q(**{f'{name}__gt': F(written)})
+        
+        return set(patient_infos.filter(newer_omop_data).values_list('person_id', flat=True))
 
     def get_patient_info_snapshot(self, patient_info):
-        """Get a snapshot of PatientInfo data for comparison"""
+        """
+        Get a snapshot of PatientInfo columns for comparison.
         
+        Values are normalized as the column stores them, so that e.g. a float
+        lab value equal to the stored Decimal is not reported as a change.
+        """
         return {
-            'patient_age': patient_info.patient_age,
-            'gender': patient_info.gender,
-            'disease': patient_info.disease,
-            'diagnosis_date': patient_info.diagnosis_date,
-            'hemoglobin': patient_info.hemoglobin,
-            'hematocrit': patient_info.hematocrit,
-            'platelet_count': patient_info.platelet_count,
-            'wbc_count': patient_info.wbc_count,
-            'creatinine': patient_info.creatinine,
-            'bilirubin': patient_info.bilirubin,
-            'albumin': patient_info.albumin,
-            'prior_lines_therapy': patient_info.prior_lines_therapy,
-            'current_line_therapy': patient_info.current_line_therapy,
-            'prior_platinum_therapy': patient_info.prior_platinum_therapy,
-            'prior_immunotherapy': patient_info.prior_immunotherapy,
-            'prior_targeted_therapy': patient_info.prior_targeted_therapy,
-            'pdl1_cps_score': patient_info.pdl1_cps_score,
-            'pdl1_tps_score': patient_info.pdl1_tps_score,
-            'biomarker_results': patient_info.biomarker_results,
-            'genetic_test_results': patient_info.genetic_test_results,
-            'omop_data_json': patient_info.omop_data_json,
+            field.name: stored_value(field, getattr(patient_info, field.attname))
+            for field in PatientInfo._meta.concrete_fields
+            if not field.primary_key and field.name != 'updated_at'
         }
 
     def update_demographics(self, patient_info, person, incremental):
@@ -329,34 +469,17 @@ class Command(BaseCommand):
                     if omop_value and (not incremental or not getattr(patient_info, field, None)):
                         setattr(patient_info, field, omop_value)
 
-    def update_lab_values(self, patient_info, person, incremental):
+    def update_lab_values(self, patient_info, person, incremental, lab_values=None):
         """Update laboratory values with latest results"""
         
-        # Get latest measurements
-        latest_measurements = Measurement.objects.filter(
-            person=person
-        ).order_by('measurement_concept_id', '-measurement_datetime').distinct('measurement_concept_id')
-        
-        lab_mappings = {
-            'hemoglobin': ['hemoglobin', 'hgb'],
-            'hematocrit': ['hematocrit', 'hct'],
-            'platelet_count': ['platelet', 'plt'],
-            'wbc_count': ['white blood cell', 'wbc', 'leukocyte'],
-            'creatinine': ['creatinine'],
-            'bilirubin': ['bilirubin'],
-            'albumin': ['albumin']
-        }
+        # Latest numeric result per lab, selected in the database
+        if lab_values is None:
+            lab_values = latest_lab_values([person.person_id], PATIENT_INFO_LAB_FIELDS)[person.person_id]
         
-        for pi_field, keywords in lab_mappings.items():
+        for pi_field, measurement in lab_values.items():
             if incremental and getattr(patient_info, pi_field):
                 continue  # Skip if value exists and incremental update
-            
-            for measurement in latest_measurements:
-                if measurement.measurement_concept and measurement.value_as_number:
-                    concept_name = measurement.measurement_concept.concept_name.lower()
-                    if any(keyword in concept_name for keyword in keywords):
-                        setattr(patient_info, pi_field, measurement.value_as_number)
-                        break
+            setattr(patient_info, pi_field, measurement.value_as_number)
 
     def update_biomarkers(self, patient_info, person, incremental):
         """Update biomarker information"""
@@ -378,7 +501,7 @@ class Command(BaseCommand):
         if not incremental or not patient_info.biomarker_results:
             biomarker_data = self.collect_biomarker_data(person)
             if biomarker_data:
-                patient_info.biomarker_results = json.dumps(biomarker_data)
+                patient_info.biomarker_results = to_json_value(biomarker_data)
 
     def update_treatments(self, patient_info, person, incremental):
         """Update treatment information"""
@@ -417,7 +540,7 @@ class Command(BaseCommand):
         if not incremental or not patient_info.genetic_test_results:
             genomic_data = self.collect_genomic_data(person)
             if genomic_data:
-                patient_info.genetic_test_results = json.dumps(genomic_data)
+                patient_info.genetic_test_results = to_json_value(genomic_data)
 
     def update_comprehensive_data(self, patient_info, person, incremental):
         """Update comprehensive OMOP data JSON"""
@@ -425,7 +548,7 @@ class Command(BaseCommand):
         if not incremental or not patient_info.omop_data_json:
             comprehensive_data = self.collect_comprehensive_data(person)
             if comprehensive_data:
-                patient_info.omop_data_json = json.dumps(comprehensive_data)
+                patient_info.omop_data_json = build_payload(comprehensive_data)
 
     def collect_biomarker_data(self, person):
         """Collect biomarker data from various sources"""
@@ -493,26 +616,10 @@ class Command(BaseCommand):
 
     def get_primary_cancer_condition(self, person):
         """Get primary cancer condition for a person"""
-        conditions = ConditionOccurrence.objects.filter(person=person)
-        
-        for condition in conditions:
-            if self.is_cancer_condition(condition):
-                return condition
-        
-        return None
-
-    def is_cancer_condition(self, condition):
-        """Check if condition is a cancer diagnosis"""
-        if not condition.condition_concept:
-            return False
-        
-        concept_name = condition.condition_concept.concept_name.lower()
-        cancer_keywords = [
-            'cancer', 'carcinoma', 'adenocarcinoma', 'sarcoma', 'lymphoma', 
-            'leukemia', 'melanoma', 'tumor', 'neoplasm', 'malignant'
-        ]
-        
-        return any(keyword in concept_name for keyword in cancer_keywords)
+        return ConditionOccurrence.objects.filter(
+            person=person,
+            condition_concept_id__in=cancer_concepts()
+        ).select_related('condition_concept').order_by('pk').first()
 
     def print_update_summary(self, stats, dry_run):
         """Print update summary"""
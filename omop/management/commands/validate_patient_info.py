@@ -9,9 +9,10 @@ from omop.models import (
     RadiationOccurrence, StemCellTransplant, ClinicalTrial, BiospecimenCollection,
     OncologyEpisodeDetail
 )
+from omop.concept_classifier import cancer_concepts
+from omop.patient_payload import read_payload
 from datetime import date, datetime
 import logging
-import json
 
 logger = logging.getLogger(__name__)
 
@@ -173,13 +174,7 @@ class Command(BaseCommand):
         person = patient_info.person
         
         # Get primary cancer condition from OMOP
-        cancer_conditions = ConditionOccurrence.objects.filter(person=person)
-        primary_condition = None
-        
-        for condition in cancer_conditions:
-            if self.is_cancer_condition(condition):
-                primary_condition = condition
-                break
+        primary_condition = self.get_primary_cancer_condition(person)
         
         if not primary_condition and patient_info.disease:
             warnings.append('PatientInfo has disease but no cancer condition found in OMOP')
@@ -308,13 +303,9 @@ class Command(BaseCommand):
         
         # Validate biomarker JSON data
         if patient_info.biomarker_results:
-            try:
-                biomarker_data = json.loads(patient_info.biomarker_results)
-                # Validate structure
-                if not isinstance(biomarker_data, dict):
-                    errors.append('Biomarker results JSON is not a valid dictionary')
-            except json.JSONDecodeError:
-                errors.append('Invalid JSON in biomarker_results field')
+            # Validate structure
+            if not isinstance(patient_info.biomarker_results, dict):
+                errors.append('Biomarker results JSON is not a valid dictionary')
         
         # Check for missing key biomarkers
         key_biomarkers = ['HER2', 'ER', 'PR', 'TMB', 'MSI']
@@ -395,12 +386,8 @@ class Command(BaseCommand):
         
         # Validate genetic test results JSON
         if patient_info.genetic_test_results:
-            try:
-                genetic_data = json.loads(patient_info.genetic_test_results)
-                if not isinstance(genetic_data, dict):
-                    errors.append('Genetic test results JSON is not a valid dictionary')
-            except json.JSONDecodeError:
-                errors.append('Invalid JSON in genetic_test_results field')
+            if not isinstance(patient_info.genetic_test_results, dict):
+                errors.append('Genetic test results JSON is not a valid dictionary')
         
         # Check for genomic data consistency
         if genomic_variants.exists() and not patient_info.genetic_test_results:
@@ -425,10 +412,10 @@ class Command(BaseCommand):
                 warnings.append('Radiation therapy exists but not captured in comprehensive data')
             else:
                 try:
-                    omop_data = json.loads(patient_info.omop_data_json)
+                    omop_data = read_payload(patient_info.omop_data_json)
                     if 'radiation' not in omop_data or not omop_data['radiation']:
                         warnings.append('Radiation therapy data missing from comprehensive JSON')
-                except json.JSONDecodeError:
+                except ValueError:
                     errors.append('Invalid JSON in omop_data_json field')
         
         # Check stem cell transplants
@@ -498,26 +485,10 @@ class Command(BaseCommand):
 
     def get_primary_cancer_condition(self, person):
         """Get primary cancer condition for a person"""
-        conditions = ConditionOccurrence.objects.filter(person=person)
-        
-        for condition in conditions:
-            if self.is_cancer_condition(condition):
-                return condition
-        
-        return None
-
-    def is_cancer_condition(self, condition):
-        """Check if condition is a cancer diagnosis"""
-        if not condition.condition_concept:
-            return False
-        
-        concept_name = condition.condition_concept.concept_name.lower()
-        cancer_keywords = [
-            'cancer', 'carcinoma', 'adenocarcinoma', 'sarcoma', 'lymphoma', 
-            'leukemia', 'melanoma', 'tumor', 'neoplasm', 'malignant'
-        ]
-        
-        return any(keyword in concept_name for keyword in cancer_keywords)
+        return ConditionOccurrence.objects.filter(
+            person=person,
+            condition_concept_id__in=cancer_concepts()
+        ).select_related('condition_concept').order_by('pk').first()
 
     def print_validation_summary(self, results, detailed_report):
         """Print validation summary"""
@@ -0,0 +1,87 @@
+"""
+Measurement Queries for EXACTOMOP
+Selects the latest measurement (or other OMOP row) per (person, concept) in the
+database, so lab values are read from one row per concept instead of every
+historical result.
+"""
+
+from django.db import connections
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from .concept_classifier import get_concept_classifier, lab_concepts
+from .models import Measurement
+
+
+def _recency_ordering(datetime_field):
+    """Most recent first; undated rows last, ties broken by the newest row."""
+    return [F(datetime_field).desc(nulls_last=True), F('pk').desc()]
+
+
+def latest_per_concept(rows, concept_field, datetime_field):
+    """
+    Latest row of a person-keyed queryset per (person, concept), as a queryset.
+
+    Uses DISTINCT ON where the database supports it (PostgreSQL) and a
+    ROW_NUMBER() window otherwise. The queryset is already ordered; do not
+    re-order it. Use .values('pk') of it as a subquery to aggregate the rows.
+    """
+    if connections[rows.db].features.can_distinct_on_fields:
+        return rows.order_by(
+            'person_id', concept_field, *_recency_ordering(datetime_field)
+        ).distinct('person_id', concept_field)
+
+    return rows.annotate(
+        recency_rank=Window(
+            RowNumber(),
+            partition_by=[F('person_id'), F(concept_field)],
+            order_by=_recency_ordering(datetime_field),
+        )
+    ).filter(recency_rank=1).order_by('person_id', concept_field)
+
+
+def latest_measurements(person_ids, concept_ids, numeric_only=False):
+    """
+    Latest Measurement per (person, measurement concept), as a queryset.
+
+    With numeric_only, rows without a value_as_number are ignored, so an
+    empty later result does not hide an earlier value.
+    """
+    measurements = Measurement.objects.filter(
+        person_id__in=person_ids, measurement_concept_id__in=concept_ids
+    )
+    if numeric_only:
+        measurements = measurements.filter(value_as_number__isnull=False)
+    return latest_per_concept(measurements, 'measurement_concept_id', 'measurement_datetime')
+
+
+def latest_lab_values(person_ids, lab_fields=None):
+    """
+    Latest numeric Measurement for each lab field of each person.
+
+    Returns {person_id: {lab field: Measurement}} using the concept
+    classifier's lab mappings, limited to lab_fields when given. The lab
+    concepts are selected by a subquery rather than sent as an ID list. When
+    several concepts populate the same field, the most recent of their latest
+    measurements wins.
+    """
+    classifier = get_concept_classifier()
+    lab_values = {person_id: {} for person_id in person_ids}
+
+    rows = latest_measurements(
+        person_ids, lab_concepts(lab_fields), numeric_only=True
+    ).select_related('unit_concept')
+    for measurement in rows:
+        lab_field = classifier.lab_field(measurement.measurement_concept_id)
+        if lab_field is None or (lab_fields is not None and lab_field not in lab_fields):
+            continue
+        current = lab_values[measurement.person_id].get(lab_field)
+        if current is None or _recency_key(measurement) > _recency_key(current):
+            lab_values[measurement.person_id][lab_field] = measurement
+    return lab_values
+
+
+def _recency_key(measurement):
+    """Sort key matching _recency_ordering, ascending."""
+    dated = measurement.measurement_datetime is not None
+    return (dated, measurement.measurement_datetime if dated else None, measurement.measurement_id)
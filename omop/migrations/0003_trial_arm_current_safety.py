@@ -0,0 +1,58 @@
+# Current safety snapshot columns on TrialArm
+
+from django.db import migrations, models
+
+from omop.models_safety import current_safety_snapshot
+
+
+def backfill_current_safety(apps, schema_editor):
+    """
+    Populate the snapshot columns from existing safety metrics history, with
+    the same rules as TrialArm.objects.refresh_current_safety().
+    """
+    TrialArm = apps.get_model('omop', 'TrialArm')
+    TrialArmSafetyMetrics = apps.get_model('omop', 'TrialArmSafetyMetrics')
+
+    TrialArm.objects.filter(
+        trial_arm_id__in=TrialArmSafetyMetrics.objects.values('trial_arm_id')
+    ).update(**current_safety_snapshot(TrialArmSafetyMetrics))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omop', '0002_safety_scoring_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trialarm',
+            name='current_data_cut_date',
+            field=models.DateField(blank=True, help_text='Data cut date of the latest safety metrics', null=True),
+        ),
+        migrations.AddField(
+            model_name='trialarm',
+            name='current_safety_score',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='Safety score from the latest safety metrics', max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='trialarm',
+            name='current_web',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='WEB from the latest safety metrics', max_digits=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='trialarm',
+            name='current_eair',
+            field=models.DecimalField(blank=True, decimal_places=4, help_text='EAIR from the latest safety metrics', max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='trialarm',
+            name='current_safety_category',
+            field=models.CharField(blank=True, choices=[('LOW_RISK', 'Low Risk'), ('MODERATE_RISK', 'Moderate Risk'), ('ELEVATED_RISK', 'Elevated Risk'), ('HIGH_RISK', 'High Risk')], help_text='Risk category from the latest safety metrics', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='trialarm',
+            index=models.Index(fields=['current_safety_score'], name='trial_arm_current_score_idx'),
+        ),
+        migrations.RunPython(backfill_current_safety, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Composite indexes for adverse event API filters and keyset pagination
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omop', '0003_trial_arm_current_safety'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='adverseevent',
+            index=models.Index(fields=['event_date', 'adverse_event_id'], name='adverse_event_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adverseevent',
+            index=models.Index(fields=['trial_arm', 'event_date', 'adverse_event_id'], name='adverse_event_arm_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adverseevent',
+            index=models.Index(fields=['person', 'event_date', 'adverse_event_id'], name='adverse_event_person_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adverseevent',
+            index=models.Index(fields=['grade', 'serious'], name='adverse_event_grade_sae_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Composite index for latest measurement per (person, concept) lookups
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omop', '0004_adverse_event_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='measurement',
+            index=models.Index(
+                fields=['person', 'measurement_concept', '-measurement_datetime'],
+                name='measurement_person_concept_dt',
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# OMOP source data columns for PatientInfo
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omop', '0005_measurement_latest_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientinfo',
+            name='biomarker_results',
+            field=models.JSONField(blank=True, help_text='Biomarker results from OMOP tables', null=True),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='genetic_test_results',
+            field=models.JSONField(blank=True, help_text='Genomic variants and molecular tests', null=True),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='omop_data_json',
+            field=models.JSONField(blank=True, help_text='Versioned OMOP data document, see omop.patient_payload', null=True),
+        ),
+    ]
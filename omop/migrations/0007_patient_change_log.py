@@ -0,0 +1,36 @@
+# Change log and consumer watermarks for person-keyed OMOP tables
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omop', '0006_patient_info_omop_payload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientChangeLog',
+            fields=[
+                ('change_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('person_id', models.BigIntegerField(help_text='Person whose OMOP data changed (not a FK, deletions are logged too)')),
+                ('table_name', models.CharField(help_text='OMOP table that changed', max_length=100)),
+                ('changed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'patient_change_log',
+            },
+        ),
+        migrations.CreateModel(
+            name='PatientChangeWatermark',
+            fields=[
+                ('consumer', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('last_change_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'patient_change_watermark',
+            },
+        ),
+    ]
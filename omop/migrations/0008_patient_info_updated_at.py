@@ -0,0 +1,18 @@
+# Write timestamp for PatientInfo staleness checks
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omop', '0007_patient_change_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientinfo',
+            name='updated_at',
+            field=models.DateTimeField(blank=True, help_text='When a PatientInfo command last wrote this row', null=True),
+        ),
+    ]
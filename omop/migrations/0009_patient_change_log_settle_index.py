@@ -0,0 +1,17 @@
+# Index for finding the newest settled change log row
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('omop', '0008_patient_info_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patientchangelog',
+            index=models.Index(fields=['changed_at', 'change_id'], name='patient_change_log_settle_idx'),
+        ),
+    ]
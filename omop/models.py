@@ -1101,6 +1101,11 @@ class Measurement(models.Model):
             models.Index(fields=["tmb_status"]),
             models.Index(fields=["msi_status"]),
             models.Index(fields=["hrd_status"]),
+            # Latest measurement per (person, concept)
+            models.Index(
+                fields=["person", "measurement_concept", "-measurement_datetime"],
+                name="measurement_person_concept_dt",
+            ),
         ]
     def __str__(self):
         return f"Measurement {self.measurement_id}"
@@ -3284,6 +3289,13 @@ class PatientInfo(models.Model):
     # Genetic mutations
     genetic_mutations = models.JSONField(blank=True, null=False, default=list)
 
+    # OMOP source data collected by the PatientInfo commands
+    biomarker_results = models.JSONField(blank=True, null=True, help_text="Biomarker results from OMOP tables")
+    genetic_test_results = models.JSONField(blank=True, null=True, help_text="Genomic variants and molecular tests")
+    omop_data_json = models.JSONField(blank=True, null=True,
+                                      help_text="Versioned OMOP data document, see omop.patient_payload")
+    updated_at = models.DateTimeField(blank=True, null=True,
+                                      help_text="When a PatientInfo command last wrote this row")
 
     # PD-L1 and biomarkers
     pd_l1_tumor_cels = models.IntegerField(blank=True, null=True)
@@ -3305,6 +3317,44 @@ class PatientInfo(models.Model):
         return f"PatientInfo for Person {self.person.person_id} (age={self.patient_age}, gender={self.gender})"
 
 
+class PatientChangeLog(models.Model):
+    """
+    One row per saved or deleted row of a person-keyed OMOP table.
+
+    Written by the handlers in omop.change_log. change_id is monotonic, so
+    consumers read new changes as change_id > their PatientChangeWatermark,
+    up to omop.change_log.settled_change_id() (ids are assigned at insert,
+    not in commit order).
+    """
+    change_id = models.BigAutoField(primary_key=True)
+    person_id = models.BigIntegerField(help_text="Person whose OMOP data changed (not a FK, deletions are logged too)")
+    table_name = models.CharField(max_length=100, help_text="OMOP table that changed")
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "patient_change_log"
+        indexes = [
+            # settled_change_id(): newest change logged before a cutoff
+            models.Index(fields=["changed_at", "change_id"], name="patient_change_log_settle_idx"),
+        ]
+
+    def __str__(self):
+        return f"Change {self.change_id} to {self.table_name} for Person {self.person_id}"
+
+
+class PatientChangeWatermark(models.Model):
+    """Last PatientChangeLog.change_id processed by a consumer."""
+    consumer = models.CharField(max_length=100, primary_key=True)
+    last_change_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "patient_change_watermark"
+
+    def __str__(self):
+        return f"{self.consumer} at change {self.last_change_id}"
+
+
 # ===========================================
 # OMOP ONCOLOGY EXTENSION TABLES
 # ===========================================
@@ -4,9 +4,136 @@ This module contains models for trial arm safety analysis and adverse event trac
 """
 
 from django.db import models
+from django.db.models import (
+    Case, Count, F, Max, OuterRef, Prefetch, Q, Subquery, Value, When
+)
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import GreaterThanOrEqual
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 from .models import Person, Concept
 
 
+# Risk categories for a safety score, highest threshold first
+SAFETY_CATEGORY_THRESHOLDS = [
+    (80, 'LOW_RISK'),
+    (60, 'MODERATE_RISK'),
+    (40, 'ELEVATED_RISK'),
+]
+SAFETY_CATEGORY_CHOICES = [
+    ('LOW_RISK', 'Low Risk'),
+    ('MODERATE_RISK', 'Moderate Risk'),
+    ('ELEVATED_RISK', 'Elevated Risk'),
+    ('HIGH_RISK', 'High Risk'),
+]
+
+
+def categorize_safety_score(score):
+    """Map a safety score (0-100) to its risk category."""
+    if score is None:
+        return None
+    for threshold, category in SAFETY_CATEGORY_THRESHOLDS:
+        if float(score) >= threshold:
+            return category
+    return 'HIGH_RISK'
+
+
+def current_safety_snapshot(metrics_model):
+    """
+    Update expressions copying an arm's latest metrics row up to today into
+    its current_* columns, for TrialArm.objects.update(**...). Takes the
+    metrics model so the 0003 migration backfills with the same rules.
+    """
+    latest = metrics_model.objects.filter(
+        trial_arm=OuterRef('pk'), data_cut_date__lte=timezone.now().date()
+    ).order_by('-data_cut_date')
+    latest_score = Subquery(latest.values('safety_score')[:1])
+
+    return {
+        'current_data_cut_date': Subquery(latest.values('data_cut_date')[:1]),
+        'current_safety_score': latest_score,
+        'current_web': Subquery(latest.values('web')[:1]),
+        'current_eair': Subquery(latest.values('eair')[:1]),
+        'current_safety_category': Case(
+            *[
+                When(GreaterThanOrEqual(latest_score, threshold), then=Value(category))
+                for threshold, category in SAFETY_CATEGORY_THRESHOLDS
+            ],
+            When(GreaterThanOrEqual(latest_score, 0), then=Value('HIGH_RISK')),
+            default=Value(''),
+        ),
+    }
+
+
+class TrialArmQuerySet(models.QuerySet):
+    """
+    QuerySet for trial arms with helpers for attaching safety metrics
+    """
+
+    def with_latest_metrics(self):
+        """
+        Attach the TrialArmSafetyMetrics row the arm's current_* snapshot was
+        taken from to each arm with a single prefetch query, exposed via
+        TrialArm.latest_metrics, so both always report the same values.
+        """
+        return self.prefetch_related(
+            Prefetch(
+                'safety_metrics',
+                queryset=TrialArmSafetyMetrics.objects.filter(
+                    data_cut_date=F('trial_arm__current_data_cut_date')
+                ),
+                to_attr='_latest_metrics',
+            )
+        )
+
+    def refresh_current_safety(self):
+        """
+        Copy the latest TrialArmSafetyMetrics row of each arm into its current_*
+        snapshot columns with a single UPDATE. Rows with a data cut in the
+        future are ignored. Returns the number of arms updated.
+        """
+        return self.update(**current_safety_snapshot(TrialArmSafetyMetrics))
+
+    def needs_safety_recompute(self):
+        """
+        Filter to arms whose safety metrics are missing or out of date: the arm
+        itself or one of its adverse events was saved after the metrics were
+        last computed, or adverse events were removed (the event count up to
+        the latest data cut no longer matches the stored total).
+        """
+        metrics = TrialArmSafetyMetrics.objects.filter(trial_arm=OuterRef('pk'))
+        latest = metrics.order_by('-data_cut_date')
+        arm_events = AdverseEvent.objects.filter(trial_arm=OuterRef('pk')).order_by()
+
+        return self.annotate(
+            safety_computed_at=Subquery(
+                metrics.order_by().values('trial_arm').annotate(
+                    last=Max('updated_at')
+                ).values('last')
+            ),
+            safety_cut_date=Subquery(latest.values('data_cut_date')[:1]),
+            safety_ae_total=Subquery(latest.values('total_ae_count')[:1]),
+            ae_changed_at=Subquery(
+                arm_events.values('trial_arm').annotate(
+                    last=Max('updated_at')
+                ).values('last')
+            ),
+            ae_total_at_cut=Coalesce(
+                Subquery(
+                    arm_events.filter(
+                        event_date__lte=OuterRef('safety_cut_date')
+                    ).values('trial_arm').annotate(total=Count('pk')).values('total')
+                ),
+                0,
+            ),
+        ).filter(
+            Q(safety_computed_at__isnull=True)
+            | Q(updated_at__gt=F('safety_computed_at'))
+            | Q(ae_changed_at__gt=F('safety_computed_at'))
+            | ~Q(ae_total_at_cut=F('safety_ae_total'))
+        )
+
+
 class TrialArm(models.Model):
     """
     Clinical Trial Arm Model - represents different treatment arms within a clinical trial
@@ -94,10 +221,47 @@ class TrialArm(models.Model):
         help_text="Average follow-up duration in months"
     )
     
+    # Current safety snapshot (latest TrialArmSafetyMetrics row, maintained by
+    # TrialArm.objects.refresh_current_safety() on every metrics write)
+    current_data_cut_date = models.DateField(
+        null=True,
+        blank=True,
+        help_text="Data cut date of the latest safety metrics"
+    )
+    current_safety_score = models.DecimalField(
+        max_digits=6,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        help_text="Safety score from the latest safety metrics"
+    )
+    current_web = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        help_text="WEB from the latest safety metrics"
+    )
+    current_eair = models.DecimalField(
+        max_digits=10,
+        decimal_places=4,
+        null=True,
+        blank=True,
+        help_text="EAIR from the latest safety metrics"
+    )
+    current_safety_category = models.CharField(
+        max_length=20,
+        choices=SAFETY_CATEGORY_CHOICES,
+        blank=True,
+        help_text="Risk category from the latest safety metrics"
+    )
+    
     # Metadata
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = TrialArmQuerySet.as_manager()
+    
     class Meta:
         db_table = "trial_arm"
         indexes = [
@@ -105,11 +269,24 @@ class TrialArm(models.Model):
             models.Index(fields=["status"]),
             models.Index(fields=["arm_code"]),
             models.Index(fields=["clinical_trial"]),
+            models.Index(fields=["current_safety_score"], name="trial_arm_current_score_idx"),
         ]
         unique_together = [['nct_number', 'arm_code']]
     
     def __str__(self):
         return f"{self.arm_name} ({self.arm_code})"
+    
+    @property
+    def latest_metrics(self):
+        """
+        Safety metrics at the current snapshot's data cut, or None.
+        Uses the row attached by with_latest_metrics() when available.
+        """
+        if hasattr(self, '_latest_metrics'):
+            return self._latest_metrics[0] if self._latest_metrics else None
+        if self.current_data_cut_date is None:
+            return None
+        return self.safety_metrics.filter(data_cut_date=self.current_data_cut_date).first()
 
 
 class AdverseEvent(models.Model):
@@ -226,6 +403,11 @@ class AdverseEvent(models.Model):
             models.Index(fields=["event_date"]),
             models.Index(fields=["grade"]),
             models.Index(fields=["serious"]),
+            # Composite indexes for the API filters and keyset pagination
+            models.Index(fields=["event_date", "adverse_event_id"], name="adverse_event_date_id_idx"),
+            models.Index(fields=["trial_arm", "event_date", "adverse_event_id"], name="adverse_event_arm_date_idx"),
+            models.Index(fields=["person", "event_date", "adverse_event_id"], name="adverse_event_person_date_idx"),
+            models.Index(fields=["grade", "serious"], name="adverse_event_grade_sae_idx"),
         ]
     
     def __str__(self):
@@ -368,3 +550,21 @@ class TrialArmSafetyMetrics(models.Model):
     def __str__(self):
         return f"Safety Metrics for {self.trial_arm.arm_name} - Score: {self.safety_score}"
 
+
+def refresh_arm_current_safety(sender, instance, **kwargs):
+    """
+    Refresh the arm's current_* snapshot after a metrics row is saved or
+    deleted (admin, API, shell). Bulk writes send no signals; callers such as
+    compute_safety_scores refresh the snapshot themselves.
+    """
+    TrialArm.objects.filter(pk=instance.trial_arm_id).refresh_current_safety()
+
+
+post_save.connect(
+    refresh_arm_current_safety, sender=TrialArmSafetyMetrics,
+    dispatch_uid='refresh_arm_current_safety_save'
+)
+post_delete.connect(
+    refresh_arm_current_safety, sender=TrialArmSafetyMetrics,
+    dispatch_uid='refresh_arm_current_safety_delete'
+)
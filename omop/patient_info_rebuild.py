@@ -0,0 +1,226 @@
+"""
+PatientInfo Rebuild for EXACTOMOP
+Replaces every PatientInfo row while readers keep seeing the previous rows
+until the new ones are complete.
+
+On PostgreSQL the rows are bulk-loaded into a shadow table created without
+keys or indexes; these are built once loading is done and the shadow table is
+then renamed over the live one. The whole rebuild runs in one transaction
+holding a write lock on the live table. Other databases upsert the rows in
+chunks and delete the rows the rebuild did not write.
+"""
+
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.transaction import TransactionManagementError
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import PatientInfo
+
+
+# PostgreSQL's limit on bind parameters per statement
+MAX_QUERY_PARAMS = 65535
+
+# CREATE [UNIQUE] INDEX <name> ON [ONLY] <table> USING ..., as pg_get_indexdef() returns it
+_INDEX_DEF = re.compile(r'^(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+( USING .*)$')
+
+
+def shadow_index_sql(indexdef, index_name, table):
+    """Rewrite a pg_get_indexdef() statement to create index_name on table."""
+    sql, count = _INDEX_DEF.subn(
+        lambda match: f'{match.group(1)}{index_name}{match.group(2)}{table}{match.group(3)}',
+        indexdef
+    )
+    if count != 1:
+        raise ValueError(f'Unrecognized index definition: {indexdef}')
+    return sql
+
+
+class ShadowTableRebuild:
+    """
+    Rebuild a model's table as <table>_shadow and swap it in (PostgreSQL).
+
+    Inside one transaction.atomic() block, call start(), load() new unsaved
+    instances, then finish() to swap; on failure, leave the block and call
+    discard(). start() locks the live table IN EXCLUSIVE MODE until the
+    transaction ends, so other writers wait for the swap instead of having
+    their changes dropped with the live table; readers are not blocked.
+
+    The shadow table gets a new identity sequence, so primary keys are
+    renumbered from 1. Only columns, keys and indexes are carried over:
+    grants, triggers, row-level security policies and replication settings
+    (publication membership, replica identity) of the live table are not.
+    """
+
+    def __init__(self, model=PatientInfo, using=DEFAULT_DB_ALIAS):
+        self.model = model
+        self.using = using
+        self.connection = connections[using]
+        self.table = model._meta.db_table
+        self.shadow = f'{self.table}_shadow'
+        self.fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+
+    def _execute(self, sql, params=None):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _fetchall(self, sql, params=None):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def start(self):
+        """
+        Lock the live table against writes and create an empty shadow table
+        with its columns.
+
+        Defaults, the identity column, NOT NULL and CHECK constraints are
+        copied; keys and indexes are not.
+        """
+        if not self.connection.in_atomic_block:
+            raise TransactionManagementError(
+                'ShadowTableRebuild must run inside transaction.atomic() to hold the live table lock'
+            )
+        qn = self.connection.ops.quote_name
+        self._execute(f'LOCK TABLE {qn(self.table)} IN EXCLUSIVE MODE')
+        self._execute(f'DROP TABLE IF EXISTS {qn(self.shadow)}')
+        self._execute(
+            f'CREATE TABLE {qn(self.shadow)} (LIKE {qn(self.table)} '
+            'INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS)'
+        )
+
+    def load(self, objs):
+        """Insert unsaved instances into the shadow table with multi-row INSERTs."""
+        if not objs:
+            return
+        qn = self.connection.ops.quote_name
+        columns = ', '.join(qn(field.column) for field in self.fields)
+        row = '(' + ', '.join(['%s'] * len(self.fields)) + ')'
+        chunk_size = max(1, MAX_QUERY_PARAMS // len(self.fields))
+
+        for start in range(0, len(objs), chunk_size):
+            chunk = objs[start:start + chunk_size]
+            params = [
+                field.get_db_prep_save(field.pre_save(obj, True), self.connection)
+                for obj in chunk
+                for field in self.fields
+            ]
+            self._execute(
+                f'INSERT INTO {qn(self.shadow)} ({columns}) VALUES {", ".join([row] * len(chunk))}',
+                params
+            )
+
+    def build_keys_and_indexes(self):
+        """
+        Recreate the live table's keys and indexes on the loaded shadow table.
+
+        Primary key, unique constraint and index names are unique per schema,
+        so they are built under temporary names. Returns the statements that
+        restore the live names once the live table is dropped.
+        """
+        qn = self.connection.ops.quote_name
+        pk_column = self.model._meta.pk.column
+        constraints = self._fetchall(
+            "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f') ORDER BY contype",
+            [qn(self.table)]
+        )
+        indexes = self._fetchall(
+            "SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE i.indrelid = %s::regclass AND NOT EXISTS ("
+            "SELECT 1 FROM pg_constraint WHERE conrelid = i.indrelid AND conindid = i.indexrelid"
+            ") ORDER BY c.relname",
+            [qn(self.table)]
+        )
+        renames = []
+
+        for number, (name, contype, definition) in enumerate(constraints):
+            if contype == 'f':
+                # Foreign key names are per table and need no index
+                self._execute(f'ALTER TABLE {qn(self.shadow)} ADD CONSTRAINT {qn(name)} {definition}')
+                continue
+            temporary = f'{self.shadow}_key{number}'
+            self._execute(f'ALTER TABLE {qn(self.shadow)} ADD CONSTRAINT {qn(temporary)} {definition}')
+            renames.append(f'ALTER TABLE {qn(self.table)} RENAME CONSTRAINT {qn(temporary)} TO {qn(name)}')
+
+        for number, (name, definition) in enumerate(indexes):
+            temporary = f'{self.shadow}_idx{number}'
+            self._execute(shadow_index_sql(definition, qn(temporary), qn(self.shadow)))
+            renames.append(f'ALTER INDEX {qn(temporary)} RENAME TO {qn(name)}')
+
+        # Keep the identity sequence name stable across rebuilds
+        (live_sequence, shadow_sequence), = self._fetchall(
+            'SELECT pg_get_serial_sequence(%s, %s), pg_get_serial_sequence(%s, %s)',
+            [qn(self.table), pk_column, qn(self.shadow), pk_column]
+        )
+        if live_sequence and shadow_sequence:
+            renames.append(
+                f'ALTER SEQUENCE {shadow_sequence} RENAME TO {live_sequence.rsplit(".", 1)[-1]}'
+            )
+
+        self._execute(f'ANALYZE {qn(self.shadow)}')
+        return renames
+
+    def finish(self):
+        """Build keys and indexes, then swap the shadow table in atomically."""
+        qn = self.connection.ops.quote_name
+        renames = self.build_keys_and_indexes()
+        retired = f'{self.table}_old'
+
+        with transaction.atomic(using=self.using):
+            self._execute(f'ALTER TABLE {qn(self.table)} RENAME TO {qn(retired)}')
+            self._execute(f'ALTER TABLE {qn(self.shadow)} RENAME TO {qn(self.table)}')
+            self._execute(f'DROP TABLE {qn(retired)}')
+            for statement in renames:
+                self._execute(statement)
+
+    def discard(self):
+        """Drop the shadow table, leaving the live table untouched."""
+        self._execute(f'DROP TABLE IF EXISTS {self.connection.ops.quote_name(self.shadow)}')
+
+
+class UpsertRebuild:
+    """
+    Rebuild PatientInfo in place with chunked upserts (non-PostgreSQL).
+
+    Each load() inserts or fully overwrites its persons' rows; finish()
+    deletes the rows not written since start(). Loaded rows must carry a
+    current updated_at.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.started = None
+        self.update_fields = [
+            field.name for field in PatientInfo._meta.concrete_fields
+            if not field.primary_key and field.name != 'person'
+        ]
+
+    def start(self):
+        """Remember when the rebuild began."""
+        self.started = timezone.now()
+
+    def load(self, objs):
+        """Insert or overwrite the rows of the given unsaved instances."""
+        PatientInfo.objects.using(self.using).bulk_create(
+            objs, update_conflicts=True, unique_fields=['person'], update_fields=self.update_fields
+        )
+
+    def finish(self):
+        """Delete rows of persons this rebuild did not write."""
+        PatientInfo.objects.using(self.using).filter(
+            Q(updated_at__lt=self.started) | Q(updated_at__isnull=True)
+        ).delete()
+
+    def discard(self):
+        """Leave rows written so far in place; nothing is deleted."""
+
+
+def patient_info_rebuild(using=DEFAULT_DB_ALIAS):
+    """Return the rebuild strategy for the database: shadow table swap on PostgreSQL, upsert otherwise."""
+    if connections[using].vendor == 'postgresql':
+        return ShadowTableRebuild(PatientInfo, using)
+    return UpsertRebuild(using)
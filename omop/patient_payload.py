@@ -0,0 +1,114 @@
+"""
+PatientInfo OMOP Payload for EXACTOMOP
+Encodes the OMOP data collected for a patient into the versioned document
+stored in PatientInfo.omop_data_json, and decodes it back.
+
+Stored format:
+    {'v': 1, 'data': {section: ...}}
+    {'v': 1, 'encoding': 'zlib', 'data': '<base64 of zlib-compressed JSON>'}
+
+Sections kept in their own PatientInfo columns (COLUMN_SECTIONS) are left out
+of the document. Large documents are compressed.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal
+import base64
+import json
+import zlib
+
+from django.db import models
+
+try:
+    import orjson
+except ImportError:  # Optional; the standard library encoder is used instead
+    orjson = None
+
+
+PAYLOAD_SCHEMA_VERSION = 1
+
+# Collected sections stored in dedicated PatientInfo columns: section -> column
+COLUMN_SECTIONS = {
+    'biomarkers': 'biomarker_results',
+    'genomics': 'genetic_test_results',
+}
+
+# Serialized size above which the document is zlib-compressed
+COMPRESS_THRESHOLD = 16 * 1024
+
+
+def _default(value):
+    """Encode the non-JSON values the collectors produce."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, models.Model):
+        return value.pk
+    return str(value)
+
+
+def dumps(value):
+    """Serialize to compact JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=_default, separators=(',', ':')).encode()
+
+
+def loads(data):
+    """Parse JSON bytes or text."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def to_json_value(value):
+    """Convert collected data to plain JSON types for a JSONField."""
+    return loads(dumps(value))
+
+
+def build_payload(data, compress_threshold=COMPRESS_THRESHOLD):
+    """
+    Build the omop_data_json document for the collected data.
+
+    compress_threshold=None disables compression.
+    """
+    encoded = dumps({
+        section: value for section, value in data.items()
+        if section not in COLUMN_SECTIONS
+    })
+    if compress_threshold is not None and len(encoded) > compress_threshold:
+        return {
+            'v': PAYLOAD_SCHEMA_VERSION,
+            'encoding': 'zlib',
+            'data': base64.b64encode(zlib.compress(encoded)).decode('ascii'),
+        }
+    return {'v': PAYLOAD_SCHEMA_VERSION, 'data': loads(encoded)}
+
+
+def read_payload(payload):
+    """
+    Return the sections of an omop_data_json document.
+
+    Accepts the unversioned JSON text written by earlier releases. Raises
+    ValueError for invalid JSON or an unknown schema version or encoding.
+    """
+    if not payload:
+        return {}
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+        if 'v' not in payload:
+            return payload  # Unversioned legacy document
+
+    if payload.get('v') != PAYLOAD_SCHEMA_VERSION:
+        raise ValueError(f"Unsupported omop_data_json version: {payload.get('v')}")
+
+    encoding = payload.get('encoding')
+    if encoding is None:
+        return payload['data']
+    if encoding == 'zlib':
+        try:
+            return loads(zlib.decompress(base64.b64decode(payload['data'])))
+        except zlib.error as e:
+            raise ValueError(f'Corrupt omop_data_json data: {e}')
+    raise ValueError(f'Unsupported omop_data_json encoding: {encoding}')
@@ -0,0 +1,131 @@
+"""
+Vectorized Safety Scoring Engine for EXACTOMOP
+Evaluates safety scores for many trial arms across a range of WEB thresholds (H)
+and grade weightings at once, for sensitivity ("what-if") analysis.
+"""
+
+import numpy as np
+from django.db.models import F
+
+from .models_safety import (
+    SAFETY_CATEGORY_THRESHOLDS, TrialArm, TrialArmSafetyMetrics
+)
+
+
+# Default grade weights for WEB = 1*e1_2 + 10*e3_4 + 100*e5
+DEFAULT_GRADE_WEIGHTS = (1, 10, 100)
+
+# Category labels ordered by ascending score band, for np.digitize
+_CATEGORY_BOUNDS = np.array(sorted(t for t, _ in SAFETY_CATEGORY_THRESHOLDS), dtype=float)
+_CATEGORY_LABELS = np.array(
+    ['HIGH_RISK'] + [c for _, c in sorted(SAFETY_CATEGORY_THRESHOLDS)]
+)
+
+
+def load_grade_counts(trial_arms=None):
+    """
+    Load the per-grade patient counts of each arm's current safety metrics.
+
+    Returns (trial_arm_ids, counts) where counts has shape (n_arms, 3) holding
+    the e1_2, e3_4 and e5 counts. Arms without metrics are omitted.
+    """
+    if trial_arms is None:
+        trial_arms = TrialArm.objects.all()
+
+    rows = list(
+        TrialArmSafetyMetrics.objects.filter(
+            trial_arm__in=trial_arms.values('trial_arm_id'),
+            data_cut_date=F('trial_arm__current_data_cut_date'),
+        ).order_by('trial_arm_id').values_list(
+            'trial_arm_id', 'e1_2_count', 'e3_4_count', 'e5_count'
+        )
+    )
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=float)
+
+    data = np.array(rows, dtype=np.int64)
+    return data[:, 0], data[:, 1:].astype(float)
+
+
+class SafetyScoreSweep:
+    """
+    Safety scores for every (grade weights, H, arm) combination.
+
+    Arrays are indexed [weights, h, arm]:
+    - web: Weighted Event Burden, shape (n_weights, n_arms)
+    - scores: 100 / (1 + WEB/H)
+    - categories: risk category labels
+    - ranks: 1 = safest arm for that weighting and H
+    """
+
+    def __init__(self, trial_arm_ids, counts, h_values, grade_weights=(DEFAULT_GRADE_WEIGHTS,)):
+        self.trial_arm_ids = np.asarray(trial_arm_ids)
+        self.counts = np.asarray(counts, dtype=float).reshape(-1, 3)
+        self.h_values = np.asarray(h_values, dtype=float).reshape(-1)
+        self.grade_weights = np.asarray(grade_weights, dtype=float).reshape(-1, 3)
+
+        # NaN fails every comparison and inf passes > 0, so check finiteness too
+        if self.h_values.size == 0 or not np.all(np.isfinite(self.h_values) & (self.h_values > 0)):
+            raise ValueError("H values must be finite and positive")
+        if not np.all(np.isfinite(self.grade_weights) & (self.grade_weights >= 0)):
+            raise ValueError("Grade weights must be finite and non-negative")
+
+        self.web = self.grade_weights @ self.counts.T
+        self.scores = 100.0 / (1.0 + self.web[:, None, :] / self.h_values[None, :, None])
+        self.categories = _CATEGORY_LABELS[np.digitize(self.scores, _CATEGORY_BOUNDS)]
+
+        # Rank arms by descending score; ties keep trial_arm_id order
+        order = np.argsort(-self.scores, axis=-1, kind='stable')
+        self.ranks = np.empty_like(order)
+        np.put_along_axis(
+            self.ranks, order, np.arange(1, self.counts.shape[0] + 1), axis=-1
+        )
+
+    def to_dict(self):
+        """Nested, JSON-serializable representation grouped by arm."""
+        arms = []
+        for a, trial_arm_id in enumerate(self.trial_arm_ids):
+            results = []
+            for w, weights in enumerate(self.grade_weights):
+                for h, h_value in enumerate(self.h_values):
+                    results.append({
+                        'grade_weights': weights.tolist(),
+                        'h': float(h_value),
+                        'web': float(self.web[w, a]),
+                        'safety_score': round(float(self.scores[w, h, a]), 2),
+                        'safety_category': str(self.categories[w, h, a]),
+                        'rank': int(self.ranks[w, h, a]),
+                    })
+            arms.append({
+                'trial_arm_id': int(trial_arm_id),
+                'e1_2_count': int(self.counts[a, 0]),
+                'e3_4_count': int(self.counts[a, 1]),
+                'e5_count': int(self.counts[a, 2]),
+                'results': results,
+            })
+
+        return {
+            'h_values': self.h_values.tolist(),
+            'grade_weights': self.grade_weights.tolist(),
+            'arms': arms,
+        }
+
+
+def parse_h_values(text):
+    """Parse a comma-separated list of H values (e.g. '10,15,20')."""
+    return [float(value) for value in text.split(',') if value.strip()]
+
+
+def parse_grade_weights(text):
+    """Parse comma-separated weight triples (e.g. '1:10:100,1:5:50')."""
+    weights = []
+    for triple in text.split(','):
+        if not triple.strip():
+            continue
+        values = [float(value) for value in triple.split(':')]
+        if len(values) != 3:
+            raise ValueError(f"Grade weights must have 3 values, got '{triple}'")
+        if not np.all(np.isfinite(values) & (np.asarray(values) >= 0)):
+            raise ValueError(f"Grade weights must be finite and non-negative, got '{triple}'")
+        weights.append(values)
+    return weights
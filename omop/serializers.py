@@ -2,9 +2,12 @@
 Django REST Framework serializers for EXACTOMOP Safety Scoring
 """
 
+from django.db import transaction
 from rest_framework import serializers
 from .models import Person
-from .models_safety import TrialArm, AdverseEvent, TrialArmSafetyMetrics
+from .models_safety import (
+    TrialArm, AdverseEvent, TrialArmSafetyMetrics, categorize_safety_score
+)
 
 
 class AdverseEventSerializer(serializers.ModelSerializer):
@@ -22,6 +25,75 @@ class AdverseEventSerializer(serializers.ModelSerializer):
         read_only_fields = ['adverse_event_id', 'created_at', 'updated_at']
 
 
+class AdverseEventBulkListSerializer(serializers.ListSerializer):
+    """
+    Validate and insert many adverse events at once.
+    
+    Person and trial arm IDs are resolved with one in_bulk query each rather
+    than one lookup per row, and rows are inserted with chunked bulk_create
+    inside a single transaction. Errors are keyed by row index.
+    """
+    
+    chunk_size = 1000
+    
+    def to_internal_value(self, data):
+        """Validate every row, then resolve foreign keys for the whole batch."""
+        if not isinstance(data, list):
+            raise serializers.ValidationError({
+                'non_field_errors': ['Expected a list of adverse events.']
+            })
+        
+        rows = {}
+        errors = {}
+        for index, item in enumerate(data):
+            try:
+                rows[index] = self.run_child_validation(item)
+            except serializers.ValidationError as exc:
+                errors[index] = exc.detail
+        
+        persons = Person.objects.in_bulk(
+            {row['person_id'] for row in rows.values()}
+        )
+        trial_arms = TrialArm.objects.in_bulk(
+            {row['trial_arm_id'] for row in rows.values() if row.get('trial_arm_id') is not None}
+        )
+        for index, row in rows.items():
+            if row['person_id'] not in persons:
+                errors.setdefault(index, {})['person'] = [
+                    f"Invalid pk \"{row['person_id']}\" - object does not exist."
+                ]
+            trial_arm_id = row.get('trial_arm_id')
+            if trial_arm_id is not None and trial_arm_id not in trial_arms:
+                errors.setdefault(index, {})['trial_arm'] = [
+                    f"Invalid pk \"{trial_arm_id}\" - object does not exist."
+                ]
+        
+        if errors:
+            raise serializers.ValidationError(errors)
+        
+        return [rows[index] for index in range(len(data))]
+    
+    def create(self, validated_data):
+        """Insert all rows in chunks within one transaction."""
+        events = [AdverseEvent(**row) for row in validated_data]
+        with transaction.atomic():
+            for start in range(0, len(events), self.chunk_size):
+                AdverseEvent.objects.bulk_create(events[start:start + self.chunk_size])
+        return events
+
+
+class AdverseEventBulkSerializer(AdverseEventSerializer):
+    """Adverse event row for bulk ingestion; FKs are validated per batch."""
+    
+    person = serializers.IntegerField(source='person_id')
+    trial_arm = serializers.IntegerField(
+        source='trial_arm_id', required=False, allow_null=True
+    )
+    
+    class Meta(AdverseEventSerializer.Meta):
+        list_serializer_class = AdverseEventBulkListSerializer
+
+
 class TrialArmSafetyMetricsSerializer(serializers.ModelSerializer):
     """Serializer for trial arm safety metrics."""
     
@@ -58,15 +130,7 @@ class TrialArmSafetyMetricsSerializer(serializers.ModelSerializer):
     
     def get_safety_category(self, obj):
         """Categorize safety score into risk levels."""
-        score = float(obj.safety_score)
-        if score >= 80:
-            return "LOW_RISK"
-        elif score >= 60:
-            return "MODERATE_RISK"
-        elif score >= 40:
-            return "ELEVATED_RISK"
-        else:
-            return "HIGH_RISK"
+        return categorize_safety_score(obj.safety_score)
 
 
 class TrialArmSerializer(serializers.ModelSerializer):
@@ -92,46 +156,32 @@ class TrialArmSerializer(serializers.ModelSerializer):
     
     def get_latest_safety_metrics(self, obj):
         """Get the most recent safety metrics for this trial arm."""
-        latest_metrics = obj.safety_metrics.order_by('-data_cut_date').first()
+        latest_metrics = obj.latest_metrics
         if latest_metrics:
             return TrialArmSafetyMetricsSerializer(latest_metrics).data
         return None
     
     def get_safety_score(self, obj):
-        """Get safety score from latest metrics."""
-        latest_metrics = obj.safety_metrics.order_by('-data_cut_date').first()
-        if latest_metrics:
-            return float(latest_metrics.safety_score)
+        """Get safety score from the current safety snapshot."""
+        if obj.current_safety_score is not None:
+            return float(obj.current_safety_score)
         return None
     
     def get_web(self, obj):
-        """Get WEB from latest metrics."""
-        latest_metrics = obj.safety_metrics.order_by('-data_cut_date').first()
-        if latest_metrics:
-            return float(latest_metrics.web)
+        """Get WEB from the current safety snapshot."""
+        if obj.current_web is not None:
+            return float(obj.current_web)
         return None
     
     def get_eair(self, obj):
-        """Get EAIR from latest metrics."""
-        latest_metrics = obj.safety_metrics.order_by('-data_cut_date').first()
-        if latest_metrics and latest_metrics.eair:
-            return float(latest_metrics.eair)
+        """Get EAIR from the current safety snapshot."""
+        if obj.current_eair:
+            return float(obj.current_eair)
         return None
     
     def get_safety_category(self, obj):
-        """Get safety risk category."""
-        latest_metrics = obj.safety_metrics.order_by('-data_cut_date').first()
-        if latest_metrics:
-            score = float(latest_metrics.safety_score)
-            if score >= 80:
-                return "LOW_RISK"
-            elif score >= 60:
-                return "MODERATE_RISK"
-            elif score >= 40:
-                return "ELEVATED_RISK"
-            else:
-                return "HIGH_RISK"
-        return None
+        """Get safety risk category from the current safety snapshot."""
+        return obj.current_safety_category or None
 
 
 class TrialMatchingResponseSerializer(serializers.Serializer):
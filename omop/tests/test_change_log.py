@@ -0,0 +1,169 @@
+"""
+Tests for the PatientChangeLog change capture.
+
+Tests cover:
+- Change rows for saves and deletes of person-keyed OMOP rows
+- PatientInfo writes not being logged
+- Changed person lookup between watermarks
+- Settled change id excluding changes that may still be uncommitted
+- Pruning rows at or below the lowest consumer watermark
+- update_patient_info --since-watermark selection, watermark advancement and pruning
+"""
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+from datetime import date, timedelta
+from io import StringIO
+
+from omop.change_log import (
+    CHANGE_LOG_GRACE, advance_watermark, changed_person_ids, get_watermark, latest_change_id,
+    prune_change_log, settled_change_id
+)
+from omop.management.commands.update_patient_info import WATERMARK_CONSUMER
+from omop.models import ConditionOccurrence, PatientChangeLog, PatientInfo, Person
+
+
+class ChangeLogTests(TestCase):
+    """Test change capture signal handlers."""
+
+    def setUp(self):
+        """Set up a person."""
+        self.person = Person.objects.create(person_id=9801, gender_concept_id=8532, year_of_birth=1970)
+
+    def logged(self):
+        """(person_id, table_name) of all change rows."""
+        return list(PatientChangeLog.objects.order_by('change_id').values_list('person_id', 'table_name'))
+
+    def test_saves_and_deletes_are_logged(self):
+        """Test that OMOP row saves and deletes record the person."""
+        condition = ConditionOccurrence.objects.create(
+            person=self.person, condition_start_date=date(2024, 1, 1)
+        )
+        condition.condition_end_date = date(2024, 2, 1)
+        condition.save()
+        condition.delete()
+
+        self.assertEqual(self.logged(), [
+            (9801, 'person'),
+            (9801, 'condition_occurrence'),
+            (9801, 'condition_occurrence'),
+            (9801, 'condition_occurrence'),
+        ])
+
+    def test_patient_info_writes_are_not_logged(self):
+        """Test that the PatientInfo target table does not feed the log."""
+        PatientChangeLog.objects.all().delete()
+
+        PatientInfo.objects.create(person=self.person)
+
+        self.assertEqual(self.logged(), [])
+
+    def test_changed_person_ids_between_watermarks(self):
+        """Test the (after, upto] change range."""
+        other = Person.objects.create(person_id=9802, gender_concept_id=8507, year_of_birth=1960)
+        watermark = latest_change_id()
+        ConditionOccurrence.objects.create(person=other, condition_start_date=date(2024, 1, 1))
+
+        self.assertEqual(
+            set(changed_person_ids(0, latest_change_id()).values_list('person_id', flat=True)),
+            {9801, 9802}
+        )
+        self.assertEqual(
+            list(changed_person_ids(watermark, latest_change_id()).values_list('person_id', flat=True)),
+            [9802]
+        )
+
+    def test_settled_change_id_skips_recent_changes(self):
+        """Test that changes within the grace period are not yet settled."""
+        first = latest_change_id()
+        ConditionOccurrence.objects.create(person=self.person, condition_start_date=date(2024, 1, 1))
+        self.assertEqual(settled_change_id(), 0)
+
+        PatientChangeLog.objects.filter(change_id=first).update(
+            changed_at=timezone.now() - CHANGE_LOG_GRACE - timedelta(seconds=1)
+        )
+
+        self.assertEqual(settled_change_id(), first)
+        self.assertEqual(settled_change_id(timedelta(0)), latest_change_id())
+
+
+    def test_prune_keeps_rows_after_lowest_watermark(self):
+        """Test that only rows every consumer has processed are deleted."""
+        self.assertEqual(prune_change_log(), 0)
+        first = latest_change_id()
+        ConditionOccurrence.objects.create(person=self.person, condition_start_date=date(2024, 1, 1))
+        advance_watermark('fast', latest_change_id())
+        advance_watermark('slow', first)
+
+        self.assertEqual(prune_change_log(), 1)
+        self.assertEqual(self.logged(), [(9801, 'condition_occurrence')])
+
+        advance_watermark('slow', latest_change_id())
+        self.assertEqual(prune_change_log(), 1)
+        self.assertEqual(self.logged(), [])
+
+
+class UpdateSinceWatermarkTests(TestCase):
+    """Test update_patient_info --since-watermark."""
+
+    def setUp(self):
+        """Set up two persons and a watermark covering them."""
+        self.person = Person.objects.create(person_id=9811, gender_concept_id=8532, year_of_birth=1970)
+        Person.objects.create(person_id=9812, gender_concept_id=8507, year_of_birth=1960)
+        advance_watermark(WATERMARK_CONSUMER, latest_change_id())
+
+    def test_selects_only_changed_persons(self):
+        """Test that only persons changed after the watermark are processed."""
+        ConditionOccurrence.objects.create(person=self.person, condition_start_date=date(2024, 1, 1))
+        watermark = get_watermark(WATERMARK_CONSUMER)
+        out = StringIO()
+
+        call_command(
+            'update_patient_info', since_watermark=True, watermark_grace=0, dry_run=True,
+            stdout=out, stderr=StringIO()
+        )
+
+        self.assertIn('Found 1 persons to process', out.getvalue())
+        self.assertEqual(get_watermark(WATERMARK_CONSUMER), watermark)
+
+    def test_watermark_advances_after_successful_run(self):
+        """Test that a live run moves the watermark to the last change it saw."""
+        Person.objects.create(person_id=9813, gender_concept_id=8507, year_of_birth=1955).delete()
+        last_change = latest_change_id()
+        out = StringIO()
+
+        call_command('update_patient_info', since_watermark=True, watermark_grace=0, stdout=out)
+
+        self.assertIn('Found 0 persons to process', out.getvalue())
+        self.assertEqual(get_watermark(WATERMARK_CONSUMER), last_change)
+
+    def test_live_run_updates_changed_persons(self):
+        """Test that a live run writes PatientInfo and advances the watermark."""
+        ConditionOccurrence.objects.create(person=self.person, condition_start_date=date(2024, 1, 1))
+        last_change = latest_change_id()
+
+        call_command('update_patient_info', since_watermark=True, watermark_grace=0, stdout=StringIO())
+
+        self.assertEqual(list(PatientInfo.objects.values_list('person_id', flat=True)), [9811])
+        self.assertEqual(get_watermark(WATERMARK_CONSUMER), last_change)
+        # Processed rows are pruned once the only consumer has passed them
+        self.assertFalse(PatientChangeLog.objects.exists())
+
+    def test_recent_changes_left_for_next_run(self):
+        """Test that changes within the grace period keep the watermark in place."""
+        watermark = get_watermark(WATERMARK_CONSUMER)
+        ConditionOccurrence.objects.create(person=self.person, condition_start_date=date(2024, 1, 1))
+        out = StringIO()
+
+        call_command('update_patient_info', since_watermark=True, stdout=out)
+
+        self.assertIn('Found 0 persons to process', out.getvalue())
+        self.assertEqual(get_watermark(WATERMARK_CONSUMER), watermark)
+        self.assertFalse(PatientInfo.objects.exists())
+
+    def test_rejects_person_id(self):
+        """Test that --since-watermark cannot target a specific person."""
+        with self.assertRaises(CommandError):
+            call_command('update_patient_info', since_watermark=True, person_id=9811, stdout=StringIO())
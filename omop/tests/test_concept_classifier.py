@@ -0,0 +1,202 @@
+"""
+Tests for the measurement and cancer concept classifier.
+
+Tests cover:
+- Keyword rule priority for lab fields and biomarkers
+- Explicit MeasurementConcept mappings
+- Name rules limited to Measurement-domain concepts
+- Process-wide caching and invalidation on vocabulary changes
+- Cancer concept set from keywords and ICD-O morphology, in memory and as a subquery
+"""
+
+from django.test import TestCase
+from datetime import date
+
+from omop.concept_classifier import (
+    ConceptClassifier, cancer_concepts, get_cancer_concept_ids, get_concept_classifier,
+    invalidate_concept_classifier, is_cancer_condition
+)
+from omop.management.commands.update_patient_info import Command as UpdateCommand
+from omop.models import (
+    Concept, ConditionOccurrence, ICDOMorphologyConcept, MeasurementConcept, Person
+)
+
+
+def create_concept(concept_id, concept_name, domain_id='Measurement'):
+    """Create a concept with placeholder vocabulary fields."""
+    return Concept.objects.create(
+        concept_id=concept_id,
+        concept_name=concept_name,
+        domain_id=domain_id,
+        vocabulary_id='LOINC',
+        concept_class_id='Lab Test',
+        concept_code=str(concept_id),
+        valid_start_date=date(1970, 1, 1),
+        valid_end_date=date(2099, 12, 31)
+    )
+
+
+class ConceptClassifierTests(TestCase):
+    """Test ConceptClassifier rules."""
+
+    def test_keyword_rules(self):
+        """Test lab and biomarker classification from concept names."""
+        classifier = ConceptClassifier([
+            (1, 'Hemoglobin [Mass/volume] in Blood'),
+            (2, 'Platelets [#/volume] in Blood'),
+            (3, 'Leukocytes (WBC) [#/volume]'),
+            (4, 'HER2/neu receptor'),
+            (5, 'Estrogen receptor Ag'),
+            (6, 'Glucose'),
+        ])
+
+        self.assertEqual(classifier.lab_field(1), 'hemoglobin_level')
+        self.assertEqual(classifier.lab_field(2), 'platelet_count')
+        self.assertEqual(classifier.lab_field(3), 'white_blood_cell_count')
+        self.assertEqual(classifier.biomarker(4), 'her2')
+        self.assertEqual(classifier.biomarker(5), 'er')
+        self.assertIsNone(classifier.lab_field(6))
+        self.assertIsNone(classifier.biomarker(6))
+        self.assertIsNone(classifier.lab_field(999))
+
+    def test_abbreviation_synonyms(self):
+        """Test the hgb, hct, plt and leukocyte synonyms."""
+        classifier = ConceptClassifier([
+            (1, 'Hgb [Mass/volume] in Blood'),
+            (2, 'Hct [Volume Fraction] of Blood'),
+            (3, 'PLT [#/volume] in Blood'),
+            (4, 'Leukocytes [#/volume] in Blood'),
+        ])
+
+        self.assertEqual(classifier.lab_field(1), 'hemoglobin_level')
+        self.assertEqual(classifier.lab_field(2), 'hematocrit')
+        self.assertEqual(classifier.lab_field(3), 'platelet_count')
+        self.assertEqual(classifier.lab_field(4), 'white_blood_cell_count')
+
+    def test_explicit_mappings_take_precedence(self):
+        """Test that MeasurementConcept-style mappings override keyword rules."""
+        classifier = ConceptClassifier(
+            [(1, 'Albumin [Mass/volume] in Urine')], {1: 'urine_albumin', 2: 'weight'}
+        )
+
+        self.assertEqual(classifier.lab_field(1), 'urine_albumin')
+        self.assertEqual(classifier.lab_field(2), 'weight')
+        self.assertEqual(classifier.concept_ids_for(['weight']), [2])
+
+
+class ConceptClassifierCacheTests(TestCase):
+    """Test the process-wide classifier cache."""
+
+    def setUp(self):
+        """Start every test with an empty cache."""
+        invalidate_concept_classifier()
+        self.addCleanup(invalidate_concept_classifier)
+
+    def test_built_once_from_matching_concepts(self):
+        """Test that the classifier is loaded once and reused."""
+        create_concept(3000963, 'Hemoglobin')
+        create_concept(4112853, 'Malignant neoplasm of breast', domain_id='Condition')
+
+        with self.assertNumQueries(2):
+            classifier = get_concept_classifier()
+        with self.assertNumQueries(0):
+            self.assertIs(get_concept_classifier(), classifier)
+
+        self.assertEqual(classifier.lab_fields, {3000963: 'hemoglobin_level'})
+
+    def test_non_measurement_concepts_ignored(self):
+        """Test that concepts outside the Measurement domain are not mapped by name."""
+        create_concept(3009542, 'Hct [Volume Fraction] of Blood')
+        create_concept(4301351, 'Hct procedure kit', domain_id='Procedure')
+        create_concept(1112807, 'Platelet aggregation inhibitor', domain_id='Drug')
+        create_concept(4310000, 'MSI-high colorectal neoplasm', domain_id='Condition')
+
+        classifier = get_concept_classifier()
+
+        self.assertEqual(classifier.lab_fields, {3009542: 'hematocrit'})
+        self.assertEqual(classifier.biomarkers, {})
+
+    def test_explicit_mapping_outside_measurement_domain(self):
+        """Test that a MeasurementConcept mapping applies whatever the concept's domain."""
+        concept = create_concept(3025315, 'Body weight', domain_id='Observation')
+        MeasurementConcept.objects.create(concept=concept, patient_info_field='weight')
+
+        self.assertEqual(get_concept_classifier().lab_field(3025315), 'weight')
+
+    def test_vocabulary_changes_invalidate(self):
+        """Test that concept and mapping saves rebuild the classifier."""
+        concept = create_concept(3024929, 'Serum creatinine')
+        self.assertEqual(get_concept_classifier().lab_field(3024929), 'serum_creatinine_level')
+
+        concept.concept_name = 'Platelet count'
+        concept.save()
+        self.assertEqual(get_concept_classifier().lab_field(3024929), 'platelet_count')
+
+        MeasurementConcept.objects.create(concept=concept, patient_info_field='platelet_count_manual')
+        self.assertEqual(get_concept_classifier().lab_field(3024929), 'platelet_count_manual')
+
+
+class CancerConceptTests(TestCase):
+    """Test the shared cancer concept set."""
+
+    def setUp(self):
+        """Set up cancer and non-cancer condition concepts."""
+        invalidate_concept_classifier()
+        self.addCleanup(invalidate_concept_classifier)
+
+        self.breast_cancer = create_concept(4112853, 'Malignant neoplasm of breast', 'Condition')
+        self.hypertension = create_concept(320128, 'Essential hypertension', 'Condition')
+        self.morphology = create_concept(4029475, 'Infiltrating duct carcinoma NOS', 'Observation')
+        self.lobular = create_concept(44499685, 'Lobular, NOS', 'Observation')
+        ICDOMorphologyConcept.objects.create(
+            concept=self.lobular,
+            icdo_morphology_code='8520/3',
+            icdo_morphology_name='Lobular carcinoma, NOS',
+            histologic_type='Lobular',
+            behavior_code='3',
+            behavior_description='MALIGNANT',
+            major_category='Ductal and lobular neoplasms'
+        )
+        self.person = Person.objects.create(
+            person_id=9601, gender_concept_id=8532, year_of_birth=1970
+        )
+
+    def test_cancer_concept_ids(self):
+        """Test keyword and ICD-O malignant morphology matches."""
+        with self.assertNumQueries(1):
+            cancer_ids = get_cancer_concept_ids()
+        with self.assertNumQueries(0):
+            get_cancer_concept_ids()
+
+        self.assertEqual(cancer_ids, {4112853, 4029475, 44499685})
+
+    def test_is_cancer_condition_is_a_set_lookup(self):
+        """Test that classifying a condition needs no concept fetch."""
+        for concept in (self.hypertension, self.breast_cancer):
+            ConditionOccurrence.objects.create(
+                person=self.person, condition_concept=concept,
+                condition_start_date=date(2023, 1, 1)
+            )
+        get_cancer_concept_ids()
+        conditions = list(ConditionOccurrence.objects.order_by('pk'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual([is_cancer_condition(c) for c in conditions], [False, True])
+
+    def test_primary_cancer_condition_pushed_into_sql(self):
+        """Test that the first cancer condition is found with one query."""
+        ConditionOccurrence.objects.create(
+            person=self.person, condition_concept=self.hypertension,
+            condition_start_date=date(2022, 1, 1)
+        )
+        cancer = ConditionOccurrence.objects.create(
+            person=self.person, condition_concept=self.breast_cancer,
+            condition_start_date=date(2023, 1, 1)
+        )
+
+        with self.assertNumQueries(1):
+            primary = UpdateCommand().get_primary_cancer_condition(self.person)
+            self.assertEqual(primary.condition_concept.concept_name, 'Malignant neoplasm of breast')
+
+        self.assertEqual(primary, cancer)
+        self.assertFalse(cancer_concepts().filter(concept_id=320128).exists())
@@ -0,0 +1,123 @@
+"""
+Tests for latest measurement queries.
+
+Tests cover:
+- Latest measurement per (person, concept), undated rows last
+- Ignoring rows without a numeric value
+- Latest lab value per PatientInfo field across concepts, concepts as a subquery
+- populate_patient_info keeping the latest lab value
+"""
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import date, datetime
+
+from omop.concept_classifier import get_concept_classifier, invalidate_concept_classifier
+from omop.management.commands.populate_patient_info import Command as PopulateCommand
+from omop.measurement_queries import latest_lab_values, latest_measurements
+from omop.models import Concept, Measurement, Person
+
+
+def create_concept(concept_id, concept_name):
+    """Create a measurement concept with placeholder vocabulary fields."""
+    return Concept.objects.create(
+        concept_id=concept_id,
+        concept_name=concept_name,
+        domain_id='Measurement',
+        vocabulary_id='LOINC',
+        concept_class_id='Lab Test',
+        concept_code=str(concept_id),
+        valid_start_date=date(1970, 1, 1),
+        valid_end_date=date(2099, 12, 31)
+    )
+
+
+class LatestMeasurementTests(TestCase):
+    """Test latest measurement selection."""
+
+    def setUp(self):
+        """Set up two persons with several hemoglobin and platelet results."""
+        invalidate_concept_classifier()
+        self.addCleanup(invalidate_concept_classifier)
+
+        self.hemoglobin = create_concept(3000963, 'Hemoglobin [Mass/volume] in Blood')
+        self.hemoglobin_arterial = create_concept(3027484, 'Hemoglobin in Arterial blood')
+        self.platelets = create_concept(3024929, 'Platelets [#/volume] in Blood')
+        self.alice = Person.objects.create(person_id=9701, gender_concept_id=8532, year_of_birth=1970)
+        self.bob = Person.objects.create(person_id=9702, gender_concept_id=8507, year_of_birth=1965)
+
+        self.measure(self.alice, self.hemoglobin, 11.0, datetime(2024, 1, 1))
+        self.measure(self.alice, self.hemoglobin, 12.5, datetime(2024, 6, 1))
+        self.measure(self.alice, self.hemoglobin, 9.0, None)
+        self.measure(self.alice, self.hemoglobin, None, datetime(2024, 9, 1))
+        self.measure(self.alice, self.hemoglobin_arterial, 13.1, datetime(2024, 7, 1))
+        self.measure(self.alice, self.platelets, 250, datetime(2024, 2, 1))
+        self.measure(self.bob, self.hemoglobin, 14.0, datetime(2023, 3, 1))
+
+    def measure(self, person, concept, value, measured_at):
+        """Record a measurement."""
+        return Measurement.objects.create(
+            person=person,
+            measurement_concept=concept,
+            value_as_number=value,
+            measurement_datetime=timezone.make_aware(measured_at) if measured_at else None
+        )
+
+    def test_latest_per_person_and_concept(self):
+        """Test one row per (person, concept) holding the most recent result."""
+        rows = latest_measurements(
+            [self.alice.person_id, self.bob.person_id], [self.hemoglobin.concept_id]
+        )
+
+        self.assertEqual(
+            [(m.person_id, m.value_as_number) for m in rows],
+            [(self.alice.person_id, None), (self.bob.person_id, 14.0)]
+        )
+
+    def test_numeric_only_skips_empty_results(self):
+        """Test that a later empty result does not hide an earlier value."""
+        rows = latest_measurements(
+            [self.alice.person_id], [self.hemoglobin.concept_id, self.platelets.concept_id],
+            numeric_only=True
+        )
+
+        self.assertEqual(
+            {m.measurement_concept_id: m.value_as_number for m in rows},
+            {self.hemoglobin.concept_id: 12.5, self.platelets.concept_id: 250}
+        )
+
+    def test_latest_lab_values_across_concepts(self):
+        """Test that the newest result wins when several concepts map to one field."""
+        with self.assertNumQueries(3):
+            lab_values = latest_lab_values([self.alice.person_id, self.bob.person_id])
+
+        alice = lab_values[self.alice.person_id]
+        self.assertEqual(alice['hemoglobin_level'].value_as_number, 13.1)
+        self.assertEqual(alice['platelet_count'].value_as_number, 250)
+        self.assertEqual(
+            {field: m.value_as_number for field, m in lab_values[self.bob.person_id].items()},
+            {'hemoglobin_level': 14.0}
+        )
+
+    def test_latest_lab_values_for_fields(self):
+        """Test restricting to lab fields, with lab concepts selected by a subquery."""
+        get_concept_classifier()
+        with CaptureQueriesContext(connection) as queries:
+            lab_values = latest_lab_values([self.alice.person_id], ['platelet_count'])
+
+        self.assertEqual(
+            {field: m.value_as_number for field, m in lab_values[self.alice.person_id].items()},
+            {'platelet_count': 250}
+        )
+        self.assertEqual(len(queries), 1)
+        self.assertIn('FROM "concept"', queries[0]['sql'])
+        self.assertNotIn(str(self.platelets.concept_id), queries[0]['sql'])
+
+    def test_populate_keeps_latest_lab_value(self):
+        """Test that populate_patient_info no longer keeps the oldest value."""
+        measurements = PopulateCommand().collect_patient_data(self.alice)['measurements']
+
+        self.assertEqual(measurements['hemoglobin_level'], 13.1)
+        self.assertEqual(measurements['platelet_count'], 250)
@@ -0,0 +1,782 @@
+"""
+Tests for the PatientInfo management commands.
+
+Tests cover:
+- Per-table batch prefetch of OMOP rows in populate_patient_info
+- Batched and single-person builders pinned to the pre-prefetch per-person output
+- Bulk create/update of PatientInfo per batch
+- Keyset batching, --start-after and checkpoint resume, held at failed batches
+- Person-id range sharding for --workers
+- Forked --workers runs matching one process, and resume from the default checkpoint
+- Set-wise staleness check in update_patient_info
+- Changed-field tracking and grouped partial updates in update_patient_info
+- Stale rows re-stamped when their recompute changes nothing
+- One lab value query per update_patient_info batch
+- Per-batch concept pivots and bulk writes in migrate_omop_to_patientinfo
+"""
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import date, datetime, timedelta
+from io import StringIO
+import json
+import os
+import re
+import tempfile
+
+from omop.concept_classifier import get_cancer_concept_ids, get_concept_classifier
+from omop.management.commands.populate_patient_info import (
+    PATIENT_DATA_TABLES, PATIENT_INFO_FIELDS, Command as PopulateCommand, default_checkpoint_file,
+    fetch_patient_records, _populate_range, iter_person_batches, person_id_ranges, read_checkpoint, write_checkpoint
+)
+from omop.management.commands.migrate_omop_to_patientinfo import Command as MigrateCommand
+from omop.management.commands.update_patient_info import Command as UpdateCommand
+from omop.models import (
+    ConditionOccurrence, DrugExposure, Measurement, Observation, PatientInfo, Person,
+    ProcedureOccurrence
+)
+from omop.tests.test_concept_classifier import create_concept
+
+
+def failing_populate_command(failing_id):
+    """populate_patient_info command whose data collection fails for one person."""
+    class FailingCommand(PopulateCommand):
+        def collect_patient_data(self, person, records=None):
+            if person.person_id == failing_id:
+                raise RuntimeError('source unavailable')
+            return super().collect_patient_data(person, records)
+
+    return FailingCommand()
+
+
+# Output of the per-person builders before the batch prefetch refactor for
+# person 2002 with the history added in PopulatePatientInfoBaselineTests.
+# Lab keys follow the PatientInfo field names adopted later (the baseline
+# keyed hemoglobin as 'hemoglobin'); demographics['age'] is checked separately.
+BASELINE_PERSON_2002 = {
+    'biomarkers': {},
+    'biospecimens': [],
+    'conditions': {
+        'ajcc_clinical_stage': '',
+        'ajcc_pathologic_stage': '',
+        'diagnosis_date': '2023-01-11',
+        'disease': 'Malignant neoplasm of breast',
+        'grade': '',
+        'histology': None,
+        'laterality': '',
+        'morphology': None,
+        'primary_condition': 'Condition 3002 for Person 2002',
+        'stage': 'Unknown',
+        'staging_system': '',
+        'topography': None
+    },
+    'demographics': {
+        'ethnicity_concept_id': 38003564,
+        'gender': 'F',
+        'race_concept_id': 8527
+    },
+    'episodes': [],
+    'genomics': {
+        'molecular_tests': [],
+        'variants': []
+    },
+    'measurements': {
+        'er_percent': None,
+        'hemoglobin_level': 11.8,
+        'hemoglobin_unit': 'gram per deciliter',
+        'platelet_count': 240.0,
+        'pr_percent': None
+    },
+    'observations': {
+        'behavioral_factors': {},
+        'genetic_findings': [],
+        'performance_status': [],
+        'social_determinants': {}
+    },
+    'procedures': [
+        {
+            'date': '2024-04-10 08:00:00+00:00',
+            'laterality': '',
+            'location': '',
+            'outcome': '',
+            'procedure_name': 'Mastectomy'
+        }
+    ],
+    'radiation': [],
+    'staging': {
+        'clinical_m': '',
+        'clinical_n': '',
+        'clinical_stage_group': '',
+        'clinical_t': '',
+        'pathologic_m': '',
+        'pathologic_n': '',
+        'pathologic_stage_group': '',
+        'pathologic_t': '',
+        'staging_system': '',
+        'staging_system_version': ''
+    },
+    'transplants': [],
+    'treatments': {
+        'drugs': [
+            {
+                'classification': '',
+                'cycle_number': None,
+                'drug_name': 'Paclitaxel',
+                'end_date': '2023-08-25 13:00:00+00:00',
+                'is_immunotherapy': False,
+                'is_platinum': False,
+                'is_targeted': False,
+                'line_of_therapy': None,
+                'regimen_role': '',
+                'start_date': '2023-08-25 09:00:00+00:00',
+                'trial_drug': False
+            },
+            {
+                'classification': '',
+                'cycle_number': None,
+                'drug_name': 'Cyclophosphamide',
+                'end_date': '2023-02-15 12:00:00+00:00',
+                'is_immunotherapy': False,
+                'is_platinum': False,
+                'is_targeted': False,
+                'line_of_therapy': None,
+                'regimen_role': '',
+                'start_date': '2023-02-15 09:00:00+00:00',
+                'trial_drug': False
+            }
+        ],
+        'regimens': [
+            {
+                'best_response': 'PR',
+                'cycles_completed': 7,
+                'cycles_planned': 7,
+                'discontinuation_reason': 'COMPLETED',
+                'discontinued': False,
+                'end_date': '2023-07-12',
+                'intent': 'NEOADJUVANT',
+                'line_number': 1,
+                'name': 'FEC-T',
+                'start_date': '2023-02-15',
+                'type': 'CHEMOTHERAPY'
+            },
+            {
+                'best_response': 'PR',
+                'cycles_completed': 8,
+                'cycles_planned': 9,
+                'discontinuation_reason': 'COMPLETED',
+                'discontinued': False,
+                'end_date': '2024-02-09',
+                'intent': 'NEOADJUVANT',
+                'line_number': 2,
+                'name': 'AC-T',
+                'start_date': '2023-08-25',
+                'type': 'CHEMOTHERAPY'
+            },
+            {
+                'best_response': 'CR',
+                'cycles_completed': 2,
+                'cycles_planned': 4,
+                'discontinuation_reason': 'PROGRESSION',
+                'discontinued': True,
+                'end_date': '2024-03-28',
+                'intent': 'NEOADJUVANT',
+                'line_number': 3,
+                'name': 'FEC-T',
+                'start_date': '2024-02-15',
+                'type': 'CHEMOTHERAPY'
+            }
+        ],
+        'treatment_lines': [
+            {
+                'end_date': None,
+                'immunotherapy_based': False,
+                'intent': 'PALLIATIVE',
+                'line_number': 1,
+                'outcome': '',
+                'pfs_days': None,
+                'platinum_based': False,
+                'regimen_name': '',
+                'response': '',
+                'start_date': '2023-02-19',
+                'targeted_therapy_based': False,
+                'trial_context': False
+            },
+            {
+                'end_date': '2024-02-14',
+                'immunotherapy_based': False,
+                'intent': 'NEOADJUVANT',
+                'line_number': 2,
+                'outcome': '',
+                'pfs_days': None,
+                'platinum_based': False,
+                'regimen_name': '',
+                'response': '',
+                'start_date': '2023-08-26',
+                'targeted_therapy_based': False,
+                'trial_context': False
+            },
+            {
+                'end_date': None,
+                'immunotherapy_based': False,
+                'intent': 'ADJUVANT',
+                'line_number': 3,
+                'outcome': '',
+                'pfs_days': None,
+                'platinum_based': False,
+                'regimen_name': '',
+                'response': '',
+                'start_date': '2024-02-18',
+                'targeted_therapy_based': False,
+                'trial_context': False
+            }
+        ]
+    },
+    'trials': []
+}
+
+
+class PopulatePatientInfoBatchTests(TestCase):
+    """Test batch prefetching in populate_patient_info."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Set up the command and the fixture persons."""
+        self.command = PopulateCommand()
+        self.persons = list(Person.objects.order_by('person_id'))
+        # Build the process-wide concept caches outside measured blocks
+        get_concept_classifier()
+        get_cancer_concept_ids()
+
+    def test_one_query_per_table_for_a_batch(self):
+        """Test that prefetching a batch does not scale with the number of persons."""
+        person_ids = [person.person_id for person in self.persons]
+
+        with CaptureQueriesContext(connection) as queries:
+            records = fetch_patient_records(person_ids)
+
+        # One query per table plus one for the latest lab values
+        self.assertEqual(len(queries), len(PATIENT_DATA_TABLES) + 1)
+        self.assertEqual(set(records), set(person_ids))
+
+    def test_builders_use_prefetched_records(self):
+        """Test that building from records matches per-person fetching without queries."""
+        records = fetch_patient_records([person.person_id for person in self.persons])
+
+        for person in self.persons:
+            with CaptureQueriesContext(connection) as queries:
+                batched = self.command.collect_patient_data(person, records[person.person_id])
+            self.assertEqual(len(queries), 0)
+
+            single = self.command.collect_patient_data(person)
+            self.assertEqual(
+                json.dumps(batched, default=str, sort_keys=True),
+                json.dumps(single, default=str, sort_keys=True)
+            )
+
+        self.assertEqual(
+            self.command.collect_patient_data(self.persons[0])['conditions']['disease'],
+            'Malignant neoplasm of breast'
+        )
+
+    def test_command_processes_all_persons(self):
+        """Test a full run across several batches."""
+        call_command('populate_patient_info', batch_size=4, stdout=StringIO())
+
+        self.assertEqual(PatientInfo.objects.count(), len(self.persons))
+
+
+class PopulatePatientInfoBaselineTests(TestCase):
+    """Test batched builders against the pre-prefetch per-person output."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Give one fixture person labs, drugs and a procedure to build from."""
+        self.person = Person.objects.get(person_id=2002)
+        g_dl = create_concept(8713, 'gram per deciliter', 'Unit')
+        hemoglobin = create_concept(3027484, 'Hemoglobin [Mass/volume] in Blood')
+        platelets = create_concept(3024929, 'Platelets [#/volume] in Blood')
+        weight = create_concept(3025315, 'Body weight')
+        paclitaxel = create_concept(1378382, 'Paclitaxel', 'Drug')
+        cyclophosphamide = create_concept(1310317, 'Cyclophosphamide', 'Drug')
+        mastectomy = create_concept(4286804, 'Mastectomy', 'Procedure')
+
+        Measurement.objects.create(
+            person=self.person, measurement_concept=hemoglobin, value_as_number=11.8,
+            unit_concept=g_dl, measurement_datetime=self._at(2024, 1, 5, 10)
+        )
+        Measurement.objects.create(
+            person=self.person, measurement_concept=platelets, value_as_number=240,
+            measurement_datetime=self._at(2024, 1, 5, 10)
+        )
+        Measurement.objects.create(
+            person=self.person, measurement_concept=weight, value_as_number=68,
+            measurement_datetime=self._at(2024, 1, 6, 9)
+        )
+        DrugExposure.objects.create(
+            person=self.person, drug_concept=cyclophosphamide,
+            drug_exposure_start_datetime=self._at(2023, 2, 15, 9),
+            drug_exposure_end_datetime=self._at(2023, 2, 15, 12)
+        )
+        DrugExposure.objects.create(
+            person=self.person, drug_concept=paclitaxel,
+            drug_exposure_start_datetime=self._at(2023, 8, 25, 9),
+            drug_exposure_end_datetime=self._at(2023, 8, 25, 13)
+        )
+        ProcedureOccurrence.objects.create(
+            person=self.person, procedure_concept=mastectomy,
+            procedure_datetime=self._at(2024, 4, 10, 8)
+        )
+
+    @staticmethod
+    def _at(*args):
+        """Return an aware datetime."""
+        return timezone.make_aware(datetime(*args))
+
+    def _built(self, records=None):
+        """Build the person's data and round-trip it through JSON like the writer does."""
+        data = PopulateCommand().collect_patient_data(self.person, records)
+        return json.loads(json.dumps(data, default=str))
+
+    def test_batched_output_matches_baseline(self):
+        """Test that building from a prefetched batch reproduces the baseline output."""
+        records = fetch_patient_records(list(Person.objects.values_list('person_id', flat=True)))
+        built = self._built(records[self.person.person_id])
+
+        self.assertEqual(
+            built['demographics'].pop('age'),
+            date.today().year - self.person.year_of_birth
+        )
+        self.assertEqual(built, BASELINE_PERSON_2002)
+
+    def test_single_person_output_matches_baseline(self):
+        """Test that the single-person path reproduces the baseline output."""
+        built = self._built()
+
+        built['demographics'].pop('age')
+        self.assertEqual(built, BASELINE_PERSON_2002)
+
+
+class PopulatePatientInfoBulkWriteTests(TestCase):
+    """Test bulk PatientInfo writes in populate_patient_info."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Set up the command and the fixture persons."""
+        self.command = PopulateCommand()
+        self.command.stdout = StringIO()
+        self.persons = list(Person.objects.order_by('person_id'))
+        get_concept_classifier()
+        get_cancer_concept_ids()
+
+    def test_batch_writes_use_constant_queries(self):
+        """Test that a batch costs the same number of queries for any size."""
+        query_counts = []
+        # Small batches so each fits in one INSERT under SQLite's variable limit
+        for batch in (self.persons[:1], self.persons[1:4]):
+            with CaptureQueriesContext(connection) as queries:
+                counts = self.command.process_batch(batch)
+            self.assertEqual(counts, (len(batch), len(batch), 0, 0))
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(PatientInfo.objects.count(), 4)
+
+    def test_existing_rows_skipped_unless_forced(self):
+        """Test skip and forced bulk_update of existing rows."""
+        person = self.persons[0]
+        PatientInfo.objects.create(person=person, disease='placeholder')
+
+        self.assertEqual(self.command.process_batch([person]), (1, 0, 0, 0))
+        self.assertEqual(PatientInfo.objects.get(person=person).disease, 'placeholder')
+
+        self.assertEqual(self.command.process_batch([person], force_update=True), (1, 0, 1, 0))
+        self.assertEqual(
+            PatientInfo.objects.get(person=person).disease, 'Malignant neoplasm of breast'
+        )
+
+    def test_dry_run_writes_nothing(self):
+        """Test that dry runs do not create PatientInfo rows."""
+        self.command.process_batch(self.persons, dry_run=True)
+
+        self.assertEqual(PatientInfo.objects.count(), 0)
+
+
+class PopulatePatientInfoResumeTests(TestCase):
+    """Test keyset batching and checkpoint resume in populate_patient_info."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Set up a temporary checkpoint path."""
+        self.person_ids = list(Person.objects.order_by('person_id').values_list('person_id', flat=True))
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.checkpoint = os.path.join(temp_dir.name, 'populate.checkpoint')
+
+    def test_keyset_batches_cover_all_persons_in_order(self):
+        """Test that batches are ordered, complete and non-overlapping."""
+        batches = list(iter_person_batches(Person.objects.all(), 4))
+
+        self.assertEqual(
+            [person.person_id for batch in batches for person in batch], self.person_ids
+        )
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 4, 3])
+
+    def test_start_after(self):
+        """Test that --start-after skips persons up to and including the ID."""
+        call_command(
+            'populate_patient_info', start_after=self.person_ids[9],
+            checkpoint_file=self.checkpoint, stdout=StringIO()
+        )
+
+        self.assertEqual(
+            list(PatientInfo.objects.order_by('person_id').values_list('person_id', flat=True)),
+            self.person_ids[10:]
+        )
+
+    def test_resume_from_checkpoint(self):
+        """Test that --resume continues after the checkpoint and clears it when done."""
+        write_checkpoint(self.checkpoint, self.person_ids[4])
+        out = StringIO()
+
+        call_command(
+            'populate_patient_info', resume=True, batch_size=5,
+            checkpoint_file=self.checkpoint, stdout=out
+        )
+
+        self.assertEqual(PatientInfo.objects.count(), len(self.person_ids) - 5)
+        self.assertIn('Processed 10/10 persons', out.getvalue())
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_checkpoint_held_at_failed_batch(self):
+        """Test that a failed batch stops the checkpoint so --resume retries it."""
+        failing_id = self.person_ids[7]
+
+        call_command(
+            failing_populate_command(failing_id), batch_size=5, checkpoint_file=self.checkpoint,
+            stdout=StringIO(), stderr=StringIO()
+        )
+
+        self.assertEqual(read_checkpoint(self.checkpoint), self.person_ids[4])
+        self.assertFalse(PatientInfo.objects.filter(person_id=failing_id).exists())
+
+        call_command(
+            'populate_patient_info', resume=True, batch_size=5,
+            checkpoint_file=self.checkpoint, stdout=StringIO()
+        )
+
+        self.assertEqual(PatientInfo.objects.count(), len(self.person_ids))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class PopulatePatientInfoWorkersTests(TestCase):
+    """Test person-id range sharding for populate_patient_info --workers."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def test_person_id_ranges(self):
+        """Test contiguous ranges of near-equal size."""
+        self.assertEqual(
+            person_id_ranges([2, 3, 5, 8, 13, 21, 34], 3), [(2, 5), (8, 13), (21, 34)]
+        )
+        self.assertEqual(person_id_ranges([7, 9], 4), [(7, 7), (9, 9)])
+        self.assertEqual(person_id_ranges([], 2), [])
+
+    def test_populate_range_covers_only_its_range(self):
+        """Test that a worker processes exactly the persons in its range."""
+        person_ids = list(Person.objects.order_by('person_id').values_list('person_id', flat=True))
+
+        result = _populate_range(person_ids[3], person_ids[7], 2, False, False)
+
+        self.assertEqual(
+            result['totals'], {'processed': 5, 'created': 5, 'updated': 0, 'errors': 0}
+        )
+        self.assertEqual(result['error_lines'], [])
+        self.assertEqual(
+            sorted(PatientInfo.objects.values_list('person_id', flat=True)), person_ids[3:8]
+        )
+
+    def test_command_rejects_invalid_workers(self):
+        """Test that non-positive worker counts and --resume are rejected."""
+        with self.assertRaises(CommandError):
+            call_command('populate_patient_info', workers=0, stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('populate_patient_info', workers=2, resume=True, stdout=StringIO())
+
+
+class PopulatePatientInfoProcessTests(TransactionTestCase):
+    """Run populate_patient_info across forked workers and committed batches."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Point the default checkpoint directory at a temporary directory."""
+        self.person_ids = list(Person.objects.order_by('person_id').values_list('person_id', flat=True))
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        settings_override = override_settings(PATIENT_INFO_CHECKPOINT_DIR=temp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.checkpoint = default_checkpoint_file()
+
+    def populated(self):
+        """PatientInfo column values except the write timestamp, by person."""
+        fields = [field for field in PATIENT_INFO_FIELDS if field != 'updated_at']
+        return list(PatientInfo.objects.order_by('person_id').values_list('person_id', *fields))
+
+    def test_workers_match_single_process(self):
+        """Test that two worker processes write the same rows as one process."""
+        call_command('populate_patient_info', batch_size=4, stdout=StringIO())
+        single = self.populated()
+        PatientInfo.objects.all().delete()
+        out = StringIO()
+
+        call_command('populate_patient_info', batch_size=4, workers=2, stdout=out)
+
+        self.assertEqual(len(single), len(self.person_ids))
+        self.assertEqual(self.populated(), single)
+        workers = re.findall(r'^Worker (\d+):', out.getvalue(), re.MULTILINE)
+        self.assertEqual(len(workers), 2)
+        self.assertNotIn(str(os.getpid()), workers)
+        self.assertIn('Errors: 0', out.getvalue())
+
+    def test_resume_after_failed_batch(self):
+        """Test resuming from the default checkpoint after a committed run with a failed batch."""
+        failing_id = self.person_ids[7]
+
+        call_command(
+            failing_populate_command(failing_id), batch_size=5, stdout=StringIO(), stderr=StringIO()
+        )
+
+        self.assertEqual(read_checkpoint(self.checkpoint), self.person_ids[4])
+        self.assertEqual(PatientInfo.objects.count(), len(self.person_ids) - 1)
+
+        out = StringIO()
+        call_command('populate_patient_info', resume=True, batch_size=5, stdout=out)
+
+        self.assertIn(f'Starting after person {self.person_ids[4]}', out.getvalue())
+        self.assertEqual(PatientInfo.objects.count(), len(self.person_ids))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class UpdatePatientInfoStalenessTests(TestCase):
+    """Test get_stale_person_ids in update_patient_info."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Stamp a PatientInfo row for every fixture person as written now."""
+        self.person_ids = list(Person.objects.order_by('person_id').values_list('person_id', flat=True))
+        PatientInfo.objects.bulk_create([
+            PatientInfo(person_id=person_id, updated_at=timezone.now())
+            for person_id in self.person_ids
+        ])
+
+    def test_stale_persons(self):
+        """Test newer OMOP data, unstamped rows and persons without OMOP data."""
+        newer, unstamped, fresh = self.person_ids[:3]
+        Measurement.objects.create(
+            person_id=newer, measurement_datetime=timezone.now() + timedelta(days=2)
+        )
+        PatientInfo.objects.filter(person_id=unstamped).update(updated_at=None)
+        no_data = Person.objects.create(person_id=9901, gender_concept_id=8532, year_of_birth=1970)
+        PatientInfo.objects.create(person=no_data)
+
+        stale = UpdateCommand().get_stale_person_ids(self.person_ids + [no_data.person_id])
+
+        self.assertEqual(stale, {newer, unstamped})
+        self.assertNotIn(fresh, stale)
+
+    def test_same_day_data_compared_by_time(self):
+        """Test that data timed later on the day of the last update is stale."""
+        later_today, earlier_today = self.person_ids[:2]
+        written_at = timezone.make_aware(datetime(2024, 5, 1, 9, 0))
+        PatientInfo.objects.update(updated_at=written_at)
+        Measurement.objects.filter(person_id__in=self.person_ids).delete()
+        DrugExposure.objects.filter(person_id__in=self.person_ids).delete()
+        ProcedureOccurrence.objects.filter(person_id__in=self.person_ids).delete()
+        ConditionOccurrence.objects.filter(person_id__in=self.person_ids).update(
+            condition_start_date=written_at.date()
+        )
+        Measurement.objects.create(person_id=later_today, measurement_datetime=written_at + timedelta(hours=3))
+        Measurement.objects.create(person_id=earlier_today, measurement_datetime=written_at - timedelta(hours=3))
+
+        stale = UpdateCommand().get_stale_person_ids(self.person_ids)
+
+        # Same-day conditions have no time and do not make a row stale
+        self.assertEqual(stale, {later_today})
+
+    def test_one_query_per_batch(self):
+        """Test that the check does not scale with the number of persons."""
+        PatientInfo.objects.update(updated_at=timezone.make_aware(datetime(2000, 1, 1)))
+
+        for batch in (self.person_ids[:1], self.person_ids):
+            with self.assertNumQueries(1):
+                stale = UpdateCommand().get_stale_person_ids(batch)
+            self.assertEqual(stale, set(batch))
+
+
+class UpdatePatientInfoDirtyFieldTests(TestCase):
+    """Test changed-field tracking in update_patient_info."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Bring every fixture person's PatientInfo up to date."""
+        self.person_ids = list(Person.objects.order_by('person_id').values_list('person_id', flat=True))
+        call_command('update_patient_info', stdout=StringIO())
+
+    def test_only_changed_fields_reported(self):
+        """Test that recomputing an unchanged row reports no changes."""
+        command = UpdateCommand()
+        command.stdout = StringIO()
+        person = Person.objects.get(person_id=self.person_ids[0])
+        patient_info = PatientInfo.objects.get(person=person)
+
+        result, _, changed = command.update_patient_info(person, False, True, False, patient_info=patient_info)
+        self.assertEqual((result, changed), ('skipped', []))
+
+        patient_info.disease = 'placeholder'
+        result, _, changed = command.update_patient_info(person, False, True, False, patient_info=patient_info)
+        self.assertEqual((result, changed), ('updated', ['disease', 'updated_at']))
+
+    def test_updates_grouped_by_changed_fields(self):
+        """Test one UPDATE per changed-field signature, writing only those columns."""
+        PatientInfo.objects.filter(person_id__in=self.person_ids[:2]).update(disease='placeholder')
+        PatientInfo.objects.filter(person_id=self.person_ids[2]).update(patient_age=1)
+        out = StringIO()
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('update_patient_info', force_update=True, stdout=out)
+
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "patient_info"')]
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(all('"gender"' not in sql for sql in updates))
+        self.assertIn('Records updated: 3', out.getvalue())
+        self.assertEqual(
+            PatientInfo.objects.filter(disease='Malignant neoplasm of breast').count(), len(self.person_ids)
+        )
+
+    def test_stale_noop_recompute_is_stamped(self):
+        """Test that a stale row with nothing to change is stamped and skipped next time."""
+        person_id = self.person_ids[0]
+        written_at = timezone.make_aware(datetime(2024, 1, 1))
+        PatientInfo.objects.update(updated_at=timezone.now())
+        PatientInfo.objects.filter(person_id=person_id).update(updated_at=written_at)
+        create_concept(3025315, 'Body weight')
+        Measurement.objects.create(
+            person_id=person_id, measurement_concept_id=3025315, value_as_number=70,
+            measurement_datetime=written_at + timedelta(days=30)
+        )
+
+        out = StringIO()
+        call_command('update_patient_info', stdout=out)
+
+        self.assertIn('Records updated: 0', out.getvalue())
+        self.assertGreater(PatientInfo.objects.get(person_id=person_id).updated_at, written_at)
+        self.assertEqual(UpdateCommand().get_stale_person_ids(self.person_ids), set())
+        with CaptureQueriesContext(connection) as queries:
+            call_command('update_patient_info', stdout=StringIO())
+        self.assertFalse([q for q in queries if q['sql'].startswith('UPDATE "patient_info"')])
+
+    def test_one_lab_query_per_batch(self):
+        """Test that lab values are read once per batch, with lab concepts as a subquery."""
+        with CaptureQueriesContext(connection) as queries:
+            call_command('update_patient_info', force_update=True, batch_size=100, stdout=StringIO())
+
+        lab_queries = [
+            q['sql'] for q in queries
+            if q['sql'].startswith('SELECT') and '"measurement"."value_as_number" IS NOT NULL' in q['sql']
+        ]
+        self.assertEqual(len(lab_queries), 1)
+        self.assertIn('FROM "concept"', lab_queries[0])
+
+
+class MigrateOmopToPatientInfoTests(TestCase):
+    """Test the batched concept pivots in migrate_omop_to_patientinfo."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def setUp(self):
+        """Give the first fixture person repeated hormone, lab and observation results."""
+        self.person_ids = list(Person.objects.order_by('person_id').values_list('person_id', flat=True))
+        self.person_id = self.person_ids[0]
+        older = timezone.make_aware(datetime(2023, 1, 1))
+        newer = timezone.make_aware(datetime(2023, 6, 1))
+        create_concept(4268518, 'Estrogen receptor status')
+        for concept_id, concept_name in [(4161279, 'ECOG'), (1635579, 'T stage'), (1634444, 'M stage')]:
+            create_concept(concept_id, concept_name, domain_id='Observation')
+
+        Measurement.objects.bulk_create([
+            Measurement(person_id=self.person_id, measurement_concept_id=4268518,
+                        measurement_source_value='Negative', measurement_datetime=older),
+            Measurement(person_id=self.person_id, measurement_concept_id=4268518,
+                        measurement_source_value='', value_source_value='Positive',
+                        measurement_datetime=newer),
+            Measurement(person_id=self.person_id, measurement_concept_id=3000963,
+                        value_as_number=10.5, measurement_datetime=older),
+            Measurement(person_id=self.person_id, measurement_concept_id=3000963,
+                        value_as_number=12.5, measurement_datetime=newer),
+            Measurement(person_id=self.person_id, measurement_concept_id=3000963,
+                        measurement_datetime=newer + timedelta(days=1)),
+        ])
+        Observation.objects.bulk_create([
+            Observation(person_id=self.person_id, observation_concept_id=4161279,
+                        value_as_number=2, observation_datetime=older),
+            Observation(person_id=self.person_id, observation_concept_id=4161279,
+                        value_as_number=1, observation_datetime=newer),
+            Observation(person_id=self.person_id, observation_concept_id=1635579,
+                        value_as_string='T2', observation_datetime=older),
+            Observation(person_id=self.person_id, observation_concept_id=1634444,
+                        value_as_string='M0', observation_datetime=older),
+        ])
+
+    def test_latest_value_per_concept(self):
+        """Test that each column is filled from the latest usable result."""
+        call_command('migrate_omop_to_patientinfo', batch_size=4, stdout=StringIO())
+
+        patient_info = PatientInfo.objects.get(person_id=self.person_id)
+        self.assertEqual(patient_info.estrogen_receptor_status, 'Positive')
+        self.assertEqual(float(patient_info.hemoglobin_level), 12.5)
+        self.assertEqual(patient_info.hemoglobin_level_units, 'G/DL')
+        self.assertEqual(patient_info.ecog_performance_status, 1)
+        self.assertEqual(patient_info.stage, 'T2 M0')
+        self.assertEqual(
+            (patient_info.tumor_stage, patient_info.nodes_stage, patient_info.distant_metastasis_stage),
+            ('T2', None, 'M0')
+        )
+        self.assertEqual(PatientInfo.objects.count(), len(self.person_ids))
+
+    def test_one_pivot_query_per_table(self):
+        """Test that the pivots do not scale with the number of persons."""
+        command = MigrateCommand()
+
+        for batch in (self.person_ids[:1], self.person_ids):
+            with self.assertNumQueries(1):
+                measurements = command.pivot_measurements(batch)
+            with self.assertNumQueries(1):
+                observations = command.pivot_observations(batch)
+
+        self.assertEqual(measurements[self.person_id][4268518], 'Positive')
+        self.assertEqual(observations[self.person_id]['ecog'], 1)
+
+    def test_rerun_updates_existing_rows(self):
+        """Test that a second run updates rows in place."""
+        call_command('migrate_omop_to_patientinfo', stdout=StringIO())
+        PatientInfo.objects.filter(person_id=self.person_id).update(estrogen_receptor_status='stale')
+        out = StringIO()
+
+        call_command('migrate_omop_to_patientinfo', stdout=out)
+
+        self.assertIn('Successfully migrated: %d' % len(self.person_ids), out.getvalue())
+        self.assertEqual(PatientInfo.objects.count(), len(self.person_ids))
+        self.assertEqual(
+            PatientInfo.objects.get(person_id=self.person_id).estrogen_receptor_status, 'Positive'
+        )
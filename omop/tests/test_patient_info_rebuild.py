@@ -0,0 +1,265 @@
+"""
+Tests for rebuilding PatientInfo without an empty-table window.
+
+Tests cover:
+- Rewriting PostgreSQL index definitions for the shadow table
+- Shadow table rebuild SQL: live table lock, keys and indexes under temporary names, atomic swap
+- A real shadow table swap keeping indexes and constraints (PostgreSQL only)
+- Strategy selection by database vendor
+- Chunked upsert rebuild: rows overwritten in place, unwritten rows deleted last
+- migrate_omop_to_patientinfo --rebuild never deleting all rows up front
+"""
+
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from io import StringIO
+from unittest import skipUnless
+
+from omop.models import PatientInfo, Person
+from omop.patient_info_rebuild import (
+    ShadowTableRebuild, UpsertRebuild, patient_info_rebuild, shadow_index_sql
+)
+
+
+class RecordingShadowTableRebuild(ShadowTableRebuild):
+    """
+    ShadowTableRebuild that records its SQL instead of running it and answers
+    the PostgreSQL catalog queries with canned rows.
+    """
+
+    def __init__(self, constraints=(), indexes=(), sequences=(None, None)):
+        super().__init__(PatientInfo)
+        self.constraints = list(constraints)
+        self.indexes = list(indexes)
+        self.sequences = sequences
+        self.statements = []
+
+    def _execute(self, sql, params=None):
+        self.statements.append(sql)
+
+    def _fetchall(self, sql, params=None):
+        if sql.startswith('SELECT conname'):
+            return self.constraints
+        if sql.startswith('SELECT c.relname'):
+            return self.indexes
+        return [self.sequences]
+
+
+# Catalog rows as PostgreSQL returns them for patient_info, ordered by contype
+PATIENT_INFO_CONSTRAINTS = [
+    ('patient_info_person_id_fk', 'f',
+     'FOREIGN KEY (person_id) REFERENCES person(person_id) DEFERRABLE INITIALLY DEFERRED'),
+    ('patient_info_pkey', 'p', 'PRIMARY KEY (id)'),
+    ('patient_info_person_id_key', 'u', 'UNIQUE (person_id)'),
+]
+PATIENT_INFO_INDEXES = [
+    ('patient_inf_disease_1b7c9e_idx',
+     'CREATE INDEX patient_inf_disease_1b7c9e_idx ON public.patient_info USING btree (disease)'),
+]
+PATIENT_INFO_SEQUENCES = ('public.patient_info_id_seq', 'public.patient_info_shadow_id_seq')
+
+
+class ShadowIndexSqlTests(TestCase):
+    """Test shadow_index_sql."""
+
+    def test_rewrites_name_and_table(self):
+        """Test plain, unique and ONLY index definitions."""
+        self.assertEqual(
+            shadow_index_sql(
+                'CREATE INDEX patient_inf_disease_1b7c9e_idx ON public.patient_info USING btree (disease)',
+                '"patient_info_shadow_idx0"', '"patient_info_shadow"'
+            ),
+            'CREATE INDEX "patient_info_shadow_idx0" ON "patient_info_shadow" USING btree (disease)'
+        )
+        self.assertEqual(
+            shadow_index_sql(
+                'CREATE UNIQUE INDEX person_key ON ONLY public.patient_info USING btree (person_id)',
+                'tmp', 'shadow'
+            ),
+            'CREATE UNIQUE INDEX tmp ON ONLY shadow USING btree (person_id)'
+        )
+
+    def test_unrecognized_definition(self):
+        """Test that an unexpected definition is rejected rather than mangled."""
+        with self.assertRaises(ValueError):
+            shadow_index_sql('CREATE TABLE patient_info (id bigint)', 'tmp', 'shadow')
+
+
+class ShadowTableRebuildTests(TestCase):
+    """Test the SQL issued by the PostgreSQL shadow table rebuild."""
+
+    def setUp(self):
+        """Set up a rebuild answering catalog queries for patient_info."""
+        self.rebuild = RecordingShadowTableRebuild(
+            PATIENT_INFO_CONSTRAINTS, PATIENT_INFO_INDEXES, PATIENT_INFO_SEQUENCES
+        )
+
+    def test_start_creates_bare_shadow_table(self):
+        """Test that start() locks the live table and replaces any leftover shadow table."""
+        self.rebuild.start()
+        self.assertEqual(self.rebuild.statements, [
+            'LOCK TABLE "patient_info" IN EXCLUSIVE MODE',
+            'DROP TABLE IF EXISTS "patient_info_shadow"',
+            'CREATE TABLE "patient_info_shadow" (LIKE "patient_info" '
+            'INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS)',
+        ])
+
+    def test_build_keys_and_indexes(self):
+        """Test keys and indexes built under temporary names, with live-name renames returned."""
+        renames = self.rebuild.build_keys_and_indexes()
+
+        self.assertEqual(self.rebuild.statements, [
+            'ALTER TABLE "patient_info_shadow" ADD CONSTRAINT "patient_info_person_id_fk" '
+            'FOREIGN KEY (person_id) REFERENCES person(person_id) DEFERRABLE INITIALLY DEFERRED',
+            'ALTER TABLE "patient_info_shadow" ADD CONSTRAINT "patient_info_shadow_key1" PRIMARY KEY (id)',
+            'ALTER TABLE "patient_info_shadow" ADD CONSTRAINT "patient_info_shadow_key2" UNIQUE (person_id)',
+            'CREATE INDEX "patient_info_shadow_idx0" ON "patient_info_shadow" USING btree (disease)',
+            'ANALYZE "patient_info_shadow"',
+        ])
+        self.assertEqual(renames, [
+            'ALTER TABLE "patient_info" RENAME CONSTRAINT "patient_info_shadow_key1" TO "patient_info_pkey"',
+            'ALTER TABLE "patient_info" RENAME CONSTRAINT "patient_info_shadow_key2" '
+            'TO "patient_info_person_id_key"',
+            'ALTER INDEX "patient_info_shadow_idx0" RENAME TO "patient_inf_disease_1b7c9e_idx"',
+            'ALTER SEQUENCE public.patient_info_shadow_id_seq RENAME TO patient_info_id_seq',
+        ])
+
+    def test_build_without_identity_sequence(self):
+        """Test that no sequence rename is issued when the table has no identity sequence."""
+        rebuild = RecordingShadowTableRebuild(PATIENT_INFO_CONSTRAINTS[1:2])
+        self.assertEqual(rebuild.build_keys_and_indexes(), [
+            'ALTER TABLE "patient_info" RENAME CONSTRAINT "patient_info_shadow_key0" TO "patient_info_pkey"',
+        ])
+
+    def test_finish_swaps_after_indexes_are_built(self):
+        """Test that finish() builds keys and indexes, then swaps and restores live names."""
+        self.rebuild.finish()
+
+        analyze = self.rebuild.statements.index('ANALYZE "patient_info_shadow"')
+        self.assertEqual(self.rebuild.statements[analyze + 1:], [
+            'ALTER TABLE "patient_info" RENAME TO "patient_info_old"',
+            'ALTER TABLE "patient_info_shadow" RENAME TO "patient_info"',
+            'DROP TABLE "patient_info_old"',
+            'ALTER TABLE "patient_info" RENAME CONSTRAINT "patient_info_shadow_key1" TO "patient_info_pkey"',
+            'ALTER TABLE "patient_info" RENAME CONSTRAINT "patient_info_shadow_key2" '
+            'TO "patient_info_person_id_key"',
+            'ALTER INDEX "patient_info_shadow_idx0" RENAME TO "patient_inf_disease_1b7c9e_idx"',
+            'ALTER SEQUENCE public.patient_info_shadow_id_seq RENAME TO patient_info_id_seq',
+        ])
+
+    def test_discard_drops_shadow_table(self):
+        """Test that discard() only drops the shadow table."""
+        self.rebuild.discard()
+        self.assertEqual(self.rebuild.statements, ['DROP TABLE IF EXISTS "patient_info_shadow"'])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'shadow table swap needs PostgreSQL')
+class ShadowTableSwapTests(TestCase):
+    """Run a real shadow table rebuild against PostgreSQL."""
+
+    def catalog(self):
+        """Index and constraint names of the live patient_info table."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename = 'patient_info' ORDER BY indexname"
+            )
+            indexes = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                "SELECT conname FROM pg_constraint WHERE conrelid = 'patient_info'::regclass ORDER BY conname"
+            )
+            constraints = [row[0] for row in cursor.fetchall()]
+        return indexes, constraints
+
+    def test_swap_keeps_indexes_and_constraints(self):
+        """Test that the rebuilt table has the live names and enforces uniqueness."""
+        persons = [
+            Person.objects.create(person_id=9750 + i, gender_concept_id=8532, year_of_birth=1970)
+            for i in range(2)
+        ]
+        PatientInfo.objects.create(person=persons[0], disease='old')
+        before = self.catalog()
+
+        with transaction.atomic():
+            rebuild = ShadowTableRebuild()
+            rebuild.start()
+            rebuild.load([
+                PatientInfo(person=person, disease='new', updated_at=timezone.now())
+                for person in persons
+            ])
+            rebuild.finish()
+
+        self.assertEqual(self.catalog(), before)
+        self.assertEqual(
+            sorted(PatientInfo.objects.values_list('disease', flat=True)), ['new', 'new']
+        )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PatientInfo.objects.create(person=persons[0])
+        self.assertIsNotNone(PatientInfo.objects.create(person=Person.objects.create(
+            person_id=9760, gender_concept_id=8532, year_of_birth=1970
+        )).pk)
+
+
+class UpsertRebuildTests(TestCase):
+    """Test the chunked upsert rebuild used outside PostgreSQL."""
+
+    def setUp(self):
+        """Create three persons, two with existing PatientInfo rows."""
+        self.persons = [
+            Person.objects.create(person_id=9700 + i, gender_concept_id=8532, year_of_birth=1970)
+            for i in range(3)
+        ]
+        PatientInfo.objects.create(person=self.persons[0], disease='old', patient_age=40)
+        PatientInfo.objects.create(person=self.persons[1], disease='dropped')
+
+    def test_strategy_for_sqlite(self):
+        """Test that SQLite gets the upsert strategy."""
+        self.assertIsInstance(patient_info_rebuild(), UpsertRebuild)
+
+    def test_rows_replaced_then_unwritten_rows_deleted(self):
+        """Test overwrite in place, insert, and deletion only at finish()."""
+        existing_pk = PatientInfo.objects.get(person=self.persons[0]).pk
+        rebuild = UpsertRebuild()
+        rebuild.start()
+
+        rebuild.load([
+            PatientInfo(person=self.persons[0], disease='new', updated_at=timezone.now()),
+            PatientInfo(person=self.persons[2], disease='added', updated_at=timezone.now()),
+        ])
+        self.assertEqual(PatientInfo.objects.count(), 3)
+
+        rebuild.finish()
+
+        rebuilt = {info.person_id: info for info in PatientInfo.objects.all()}
+        self.assertEqual(set(rebuilt), {self.persons[0].person_id, self.persons[2].person_id})
+        self.assertEqual(rebuilt[self.persons[0].person_id].pk, existing_pk)
+        self.assertEqual(rebuilt[self.persons[0].person_id].disease, 'new')
+        self.assertIsNone(rebuilt[self.persons[0].person_id].patient_age)
+
+
+class MigrateRebuildTests(TestCase):
+    """Test migrate_omop_to_patientinfo --rebuild."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def test_rebuild_keeps_rows_until_replaced(self):
+        """Test that only rows the rebuild did not write are deleted."""
+        call_command('migrate_omop_to_patientinfo', stdout=StringIO())
+        person_ids = list(Person.objects.order_by('person_id').values_list('person_id', flat=True))
+        PatientInfo.objects.filter(person_id=person_ids[0]).update(disease='stale')
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command(
+                'migrate_omop_to_patientinfo', rebuild=True, batch_size=4,
+                person_ids=','.join(map(str, person_ids[:5])), stdout=StringIO()
+            )
+
+        deletes = [q['sql'] for q in queries if q['sql'].startswith('DELETE FROM "patient_info"')]
+        self.assertEqual(len(deletes), 1)
+        self.assertIn('"updated_at" <', deletes[0])
+        self.assertEqual(
+            sorted(PatientInfo.objects.values_list('person_id', flat=True)), person_ids[:5]
+        )
+        self.assertEqual(PatientInfo.objects.get(person_id=person_ids[0]).disease, 'breast cancer')
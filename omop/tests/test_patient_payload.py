@@ -0,0 +1,86 @@
+"""
+Tests for the PatientInfo OMOP payload format.
+
+Tests cover:
+- Versioned documents without the column-backed sections
+- zlib compression of large documents
+- Unversioned legacy documents and unknown versions
+- populate_patient_info storing the payload and JSON columns
+"""
+
+from django.core.management import call_command
+from django.test import TestCase
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+import json
+
+from omop.models import PatientInfo, Person
+from omop.patient_payload import (
+    PAYLOAD_SCHEMA_VERSION, build_payload, read_payload, to_json_value
+)
+
+
+class PatientPayloadTests(TestCase):
+    """Test building and reading omop_data_json documents."""
+
+    def setUp(self):
+        """Set up collected data with non-JSON values."""
+        self.data = {
+            'conditions': {'disease': 'Malignant neoplasm of breast', 'diagnosis_date': date(2023, 5, 2)},
+            'measurements': {'hemoglobin_level': Decimal('12.5')},
+            'biomarkers': {'her2_status': 'positive'},
+            'genomics': {'variants': [{'gene': 'BRCA1'}]},
+        }
+
+    def test_payload_is_versioned_and_deduplicated(self):
+        """Test that the document is plain JSON without the column-backed sections."""
+        payload = build_payload(self.data)
+
+        self.assertEqual(payload['v'], PAYLOAD_SCHEMA_VERSION)
+        self.assertNotIn('encoding', payload)
+        self.assertEqual(read_payload(payload), {
+            'conditions': {'disease': 'Malignant neoplasm of breast', 'diagnosis_date': '2023-05-02'},
+            'measurements': {'hemoglobin_level': 12.5},
+        })
+        self.assertEqual(json.loads(json.dumps(payload)), payload)
+
+    def test_large_payload_is_compressed(self):
+        """Test zlib compression above the threshold."""
+        self.data['procedures'] = [{'name': 'Mastectomy', 'date': date(2023, 6, 1)}] * 500
+
+        payload = build_payload(self.data)
+
+        self.assertEqual(payload['encoding'], 'zlib')
+        self.assertLess(len(payload['data']), len(json.dumps(to_json_value(self.data))))
+        self.assertEqual(read_payload(payload)['procedures'][0]['date'], '2023-06-01')
+        self.assertNotIn('encoding', build_payload(self.data, compress_threshold=None))
+
+    def test_legacy_and_unknown_documents(self):
+        """Test unversioned JSON text and rejection of unknown versions."""
+        self.assertEqual(read_payload('{"conditions": {}}'), {'conditions': {}})
+        self.assertEqual(read_payload(None), {})
+        with self.assertRaises(ValueError):
+            read_payload({'v': PAYLOAD_SCHEMA_VERSION + 1, 'data': {}})
+        with self.assertRaises(ValueError):
+            read_payload({'v': PAYLOAD_SCHEMA_VERSION, 'encoding': 'zlib', 'data': 'bm90IHpsaWI='})
+
+
+class PopulatePatientPayloadTests(TestCase):
+    """Test the payload written by populate_patient_info."""
+
+    fixtures = ['synthetic_breast_cancer_patients.json']
+
+    def test_populate_stores_payload(self):
+        """Test that biomarkers live in their column and not in omop_data_json."""
+        call_command('populate_patient_info', stdout=StringIO())
+
+        person = Person.objects.order_by('person_id').first()
+        patient_info = PatientInfo.objects.get(person=person)
+        sections = read_payload(patient_info.omop_data_json)
+
+        self.assertEqual(patient_info.omop_data_json['v'], PAYLOAD_SCHEMA_VERSION)
+        self.assertEqual(sections['conditions']['disease'], 'Malignant neoplasm of breast')
+        self.assertIsInstance(sections['conditions']['primary_condition'], int)
+        self.assertNotIn('biomarkers', sections)
+        self.assertNotIn('genomics', sections)
@@ -0,0 +1,474 @@
+"""
+Tests for the safety scoring API.
+
+Tests cover:
+- Latest safety metrics attached to trial arm querysets
+- Current safety snapshot refreshed on metrics writes and deletes
+- Migration backfill of the snapshot matching refresh_current_safety()
+- Constant query counts for trial arm list and trial matching endpoints
+- Database-side min_safety_score filtering and safety_score ordering
+- Keyset pagination for adverse events
+- Streaming NDJSON/CSV adverse event export
+- Bulk adverse event ingestion from JSON arrays and NDJSON
+"""
+
+from django.apps import apps as django_apps
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from decimal import Decimal
+from datetime import date
+from importlib import import_module
+import csv
+import json
+
+from omop.models import Person
+from omop.models_safety import TrialArm, AdverseEvent, TrialArmSafetyMetrics
+
+
+def create_arm_with_metrics(index, scores):
+    """Create a trial arm with one metrics row per (data_cut_date, score) pair."""
+    arm = TrialArm.objects.create(
+        nct_number=f'NCT{10000000 + index}',
+        arm_name=f'Arm {index}',
+        arm_code=f'ARM_{index}',
+        arm_type='EXPERIMENTAL',
+        status='ACTIVE',
+        enrollment_start_date=date(2023, 1, 1),
+        last_data_cut=date(2024, 1, 1),
+        n_patients=100,
+        follow_up_months=Decimal('12.0')
+    )
+    for data_cut_date, score in scores:
+        TrialArmSafetyMetrics.objects.create(
+            trial_arm=arm,
+            data_cut_date=data_cut_date,
+            person_years=Decimal('100.0'),
+            n_patients=100,
+            e1_2_count=5,
+            e3_4_count=1,
+            e5_count=0,
+            eair=Decimal('0.06'),
+            web=Decimal('15.0'),
+            safety_score=Decimal(score),
+            web_threshold_h=Decimal('15.0')
+        )
+    TrialArm.objects.filter(pk=arm.pk).refresh_current_safety()
+    arm.refresh_from_db()
+    return arm
+
+
+class LatestSafetyMetricsTests(TestCase):
+    """Test TrialArm.objects.with_latest_metrics()."""
+
+    def setUp(self):
+        """Set up arms with metric history."""
+        self.arm = create_arm_with_metrics(1, [
+            (date(2023, 6, 1), '90.00'),
+            (date(2024, 1, 1), '55.00'),
+            (date(2023, 9, 1), '70.00'),
+        ])
+        self.arm_without_metrics = create_arm_with_metrics(2, [])
+
+    def test_latest_metrics_attached(self):
+        """Test that only the most recent data cut is attached."""
+        arms = {
+            arm.trial_arm_id: arm
+            for arm in TrialArm.objects.with_latest_metrics()
+        }
+
+        latest = arms[self.arm.trial_arm_id].latest_metrics
+        self.assertEqual(latest.data_cut_date, date(2024, 1, 1))
+        self.assertEqual(latest.safety_score, Decimal('55.00'))
+        self.assertIsNone(arms[self.arm_without_metrics.trial_arm_id].latest_metrics)
+
+    def test_latest_metrics_single_prefetch_query(self):
+        """Test that attaching latest metrics costs one extra query."""
+        with self.assertNumQueries(2):
+            arms = list(TrialArm.objects.with_latest_metrics())
+            for arm in arms:
+                arm.latest_metrics
+
+    def test_latest_metrics_without_prefetch(self):
+        """Test the fallback lookup on a plain instance."""
+        arm = TrialArm.objects.get(pk=self.arm.pk)
+        self.assertEqual(arm.latest_metrics.data_cut_date, date(2024, 1, 1))
+
+    def test_metrics_writes_refresh_snapshot(self):
+        """Test that saving or deleting a metrics row refreshes current_*."""
+        metrics = TrialArmSafetyMetrics.objects.get(trial_arm=self.arm, data_cut_date=date(2024, 1, 1))
+        metrics.safety_score = Decimal('40.00')
+        metrics.save()
+        self.arm.refresh_from_db()
+        self.assertEqual(self.arm.current_safety_score, Decimal('40.00'))
+
+        metrics.delete()
+        self.arm.refresh_from_db()
+        self.assertEqual(self.arm.current_data_cut_date, date(2023, 9, 1))
+        self.assertEqual(self.arm.current_safety_score, Decimal('70.00'))
+
+    def test_future_cut_not_served(self):
+        """Test that a future data cut is served neither as snapshot nor as latest metrics."""
+        future = create_arm_with_metrics(3, [(date(2024, 1, 1), '55.00'), (date(9999, 1, 1), '20.00')])
+
+        response = self.client.get(reverse('trial-arm-detail', args=[future.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['safety_score'], 55.0)
+        self.assertEqual(response.data['latest_safety_metrics']['data_cut_date'], '2024-01-01')
+
+
+class SafetyApiQueryCountTests(TestCase):
+    """Test that list endpoints use a constant number of queries."""
+
+    def setUp(self):
+        """Set up a page worth of trial arms."""
+        for i in range(25):
+            create_arm_with_metrics(i, [
+                (date(2023, 6, 1), '80.00'),
+                (date(2024, 1, 1), '65.00'),
+            ])
+
+    def test_trial_arm_list_query_count(self):
+        """Test that a page of trial arms costs count + arms + metrics."""
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('trial-arm-list'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 25)
+        for result in response.data['results']:
+            self.assertEqual(result['safety_score'], 65.0)
+            self.assertEqual(result['latest_safety_metrics']['data_cut_date'], '2024-01-01')
+
+    def test_trial_matching_get_query_count(self):
+        """Test that trial matching GET costs arms + metrics."""
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('trial-matching'), {'max_results': 50})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 25)
+
+    def test_trial_matching_post_query_count(self):
+        """Test that trial matching POST costs arms + metrics."""
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                reverse('trial-matching'),
+                {'person_id': 1, 'max_results': 50},
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 25)
+
+
+class CurrentSafetyBackfillTests(TestCase):
+    """Test that the 0003 migration backfill matches refresh_current_safety()."""
+
+    SNAPSHOT_FIELDS = [
+        'current_data_cut_date', 'current_safety_score', 'current_web',
+        'current_eair', 'current_safety_category',
+    ]
+
+    def test_backfill_agrees_with_refresh(self):
+        """Test past, future-only and low-score arms snapshot identically both ways."""
+        create_arm_with_metrics(1, [(date(2024, 1, 1), '85.00'), (date(9999, 1, 1), '20.00')])
+        create_arm_with_metrics(2, [(date(9999, 1, 1), '20.00')])
+        create_arm_with_metrics(3, [(date(2023, 6, 1), '12.00')])
+        backfill = import_module('omop.migrations.0003_trial_arm_current_safety').backfill_current_safety
+
+        TrialArm.objects.update(current_safety_category='', current_data_cut_date=None)
+        backfill(django_apps, None)
+        backfilled = list(TrialArm.objects.order_by('pk').values_list(*self.SNAPSHOT_FIELDS))
+        TrialArm.objects.all().refresh_current_safety()
+        refreshed = list(TrialArm.objects.order_by('pk').values_list(*self.SNAPSHOT_FIELDS))
+
+        self.assertEqual(backfilled, refreshed)
+        self.assertEqual(
+            [(row[0], row[4]) for row in backfilled],
+            [(date(2024, 1, 1), 'LOW_RISK'), (None, ''), (date(2023, 6, 1), 'HIGH_RISK')]
+        )
+
+
+class TrialArmSafetyScoreFilterTests(TestCase):
+    """Test min_safety_score filtering and safety_score ordering."""
+
+    def setUp(self):
+        """Set up arms whose latest score differs from their earlier scores."""
+        self.low = create_arm_with_metrics(1, [
+            (date(2023, 6, 1), '90.00'),
+            (date(2024, 1, 1), '40.00'),
+        ])
+        self.high = create_arm_with_metrics(2, [
+            (date(2023, 6, 1), '30.00'),
+            (date(2024, 1, 1), '85.00'),
+        ])
+        self.mid = create_arm_with_metrics(3, [
+            (date(2024, 1, 1), '65.00'),
+        ])
+        self.unscored = create_arm_with_metrics(4, [])
+
+    def result_ids(self, response):
+        """Trial arm IDs on the returned page, in order."""
+        return [result['trial_arm_id'] for result in response.data['results']]
+
+    def test_min_safety_score_uses_latest_metrics(self):
+        """Test that only the latest data cut is compared to the threshold."""
+        response = self.client.get(reverse('trial-arm-list'), {'min_safety_score': '60'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(self.result_ids(response)),
+            sorted([self.high.trial_arm_id, self.mid.trial_arm_id])
+        )
+
+    def test_min_safety_score_query_count(self):
+        """Test that filtering does not add per-arm queries."""
+        for i in range(5, 30):
+            create_arm_with_metrics(i, [(date(2024, 1, 1), '75.00')])
+
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse('trial-arm-list'), {'min_safety_score': '60', 'page_size': 10}
+            )
+
+        self.assertEqual(response.data['count'], 27)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_ordering_by_safety_score(self):
+        """Test ascending and descending safety score ordering."""
+        response = self.client.get(reverse('trial-arm-list'), {'ordering': 'safety_score'})
+        self.assertEqual(self.result_ids(response), [
+            self.low.trial_arm_id, self.mid.trial_arm_id,
+            self.high.trial_arm_id, self.unscored.trial_arm_id,
+        ])
+
+        response = self.client.get(reverse('trial-arm-list'), {'ordering': '-safety_score'})
+        self.assertEqual(self.result_ids(response), [
+            self.high.trial_arm_id, self.mid.trial_arm_id,
+            self.low.trial_arm_id, self.unscored.trial_arm_id,
+        ])
+
+
+class AdverseEventKeysetPaginationTests(TestCase):
+    """Test opt-in keyset pagination on the adverse event list."""
+
+    def setUp(self):
+        """Set up events with several per date so ties need the ID tiebreak."""
+        self.arm = create_arm_with_metrics(1, [])
+        self.person = Person.objects.create(
+            person_id=9501,
+            gender_concept_id=8507,
+            year_of_birth=1970,
+            month_of_birth=1,
+            day_of_birth=1
+        )
+        self.events = [
+            AdverseEvent.objects.create(
+                person=self.person,
+                trial_arm=self.arm,
+                event_name=f'Event {i}',
+                event_date=date(2023, 1 + i % 4, 1),
+                grade=1 + i % 5
+            )
+            for i in range(11)
+        ]
+
+    def fetch_all_pages(self, params):
+        """Follow next links and return (ids, number of pages)."""
+        ids = []
+        pages = 0
+        url = reverse('adverse-event-list')
+        while url:
+            response = self.client.get(url, params if pages == 0 else None)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            ids.extend(result['adverse_event_id'] for result in response.data['results'])
+            url = response.data['next']
+            pages += 1
+        return ids, pages
+
+    def test_pages_cover_all_events_newest_first(self):
+        """Test that pages are ordered by (event_date, id) descending without gaps."""
+        ids, pages = self.fetch_all_pages({'pagination': 'keyset', 'page_size': 4})
+
+        expected = [
+            event.adverse_event_id
+            for event in sorted(
+                self.events,
+                key=lambda event: (event.event_date, event.adverse_event_id),
+                reverse=True
+            )
+        ]
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 3)
+
+    def test_keyset_composes_with_filters(self):
+        """Test keyset pagination together with the grade filter."""
+        ids, _ = self.fetch_all_pages({'pagination': 'keyset', 'page_size': 1, 'grade': '2'})
+
+        self.assertEqual(
+            sorted(ids),
+            sorted(event.adverse_event_id for event in self.events if event.grade == 2)
+        )
+
+    def test_no_count_query(self):
+        """Test that a keyset page is a single query."""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('adverse-event-list'), {'pagination': 'keyset'})
+
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('COUNT(', queries[0]['sql'].upper())
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor returns 404."""
+        response = self.client.get(
+            reverse('adverse-event-list'), {'pagination': 'keyset', 'cursor': 'bogus'}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_default_pagination_unchanged(self):
+        """Test that page-number pagination remains the default."""
+        response = self.client.get(reverse('adverse-event-list'))
+        self.assertEqual(response.data['count'], 11)
+
+
+class AdverseEventExportTests(TestCase):
+    """Test the streaming adverse event export."""
+
+    def setUp(self):
+        """Set up a handful of events across grades."""
+        self.arm = create_arm_with_metrics(1, [])
+        self.person = Person.objects.create(
+            person_id=9502,
+            gender_concept_id=8532,
+            year_of_birth=1965,
+            month_of_birth=1,
+            day_of_birth=1
+        )
+        self.events = [
+            AdverseEvent.objects.create(
+                person=self.person,
+                trial_arm=self.arm,
+                event_name=f'Event, {i}',
+                event_date=date(2023, 1, 1 + i),
+                grade=1 + i % 3,
+                serious=(i % 2 == 0)
+            )
+            for i in range(5)
+        ]
+
+    def test_ndjson_export(self):
+        """Test one JSON object per event, in ID order, with FK IDs."""
+        url = reverse('adverse-event-export')
+        response = self.client.get(url, {'grade': '1'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).decode().splitlines()
+        ]
+        expected = [event for event in self.events if event.grade == 1]
+        self.assertEqual(
+            [row['adverse_event_id'] for row in rows],
+            [event.adverse_event_id for event in expected]
+        )
+        self.assertEqual(rows[0]['person'], 9502)
+        self.assertEqual(rows[0]['trial_arm'], self.arm.trial_arm_id)
+        self.assertEqual(rows[0]['event_date'], '2023-01-01')
+
+    def test_csv_export(self):
+        """Test CSV header, quoting and the serious filter."""
+        response = self.client.get(
+            reverse('adverse-event-export'), {'export_format': 'csv', 'serious': 'true'}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(
+            b''.join(response.streaming_content).decode().splitlines()
+        ))
+        self.assertEqual(rows[0][:3], ['adverse_event_id', 'person', 'trial_arm'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][3], 'Event, 0')
+
+    def test_invalid_export_format(self):
+        """Test that unknown formats return 400."""
+        response = self.client.get(reverse('adverse-event-export'), {'export_format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+
+class AdverseEventBulkCreateTests(TestCase):
+    """Test bulk adverse event ingestion."""
+
+    def setUp(self):
+        """Set up an arm and a person to attach events to."""
+        self.arm = create_arm_with_metrics(1, [])
+        self.person = Person.objects.create(
+            person_id=9503,
+            gender_concept_id=8507,
+            year_of_birth=1958,
+            month_of_birth=1,
+            day_of_birth=1
+        )
+        self.url = reverse('adverse-event-bulk')
+
+    def event(self, i, **overrides):
+        """Build one event payload."""
+        payload = {
+            'person': self.person.person_id,
+            'trial_arm': self.arm.trial_arm_id,
+            'event_name': f'Event {i}',
+            'event_date': '2023-03-01',
+            'grade': 1 + i % 5,
+        }
+        payload.update(overrides)
+        return payload
+
+    def test_json_array_uses_constant_queries(self):
+        """Test that FK resolution and inserts do not scale with row count."""
+        payload = [self.event(i) for i in range(50)]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, payload, content_type='application/json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 50)
+        self.assertEqual(AdverseEvent.objects.count(), 50)
+        self.assertLessEqual(len(queries), 6)
+
+    def test_ndjson_body(self):
+        """Test one event per line, ignoring blank lines."""
+        body = '\n'.join(json.dumps(self.event(i)) for i in range(3)) + '\n\n'
+
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            sorted(response.data['adverse_event_ids']),
+            list(AdverseEvent.objects.order_by('pk').values_list('pk', flat=True))
+        )
+
+    def test_invalid_rows_reject_the_batch(self):
+        """Test per-row errors for field and FK problems with nothing saved."""
+        payload = [
+            self.event(0),
+            self.event(1, grade=9),
+            self.event(2, person=424242),
+            self.event(3, trial_arm=None),
+        ]
+
+        response = self.client.post(self.url, payload, content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['row'] for error in response.data['errors']], [1, 2])
+        self.assertIn('grade', response.data['errors'][0]['errors'])
+        self.assertIn('person', response.data['errors'][1]['errors'])
+        self.assertEqual(AdverseEvent.objects.count(), 0)
+
+    def test_non_list_body(self):
+        """Test that a single object is rejected."""
+        response = self.client.post(self.url, self.event(0), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
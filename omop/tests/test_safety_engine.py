@@ -0,0 +1,156 @@
+"""
+Tests for the vectorized safety scoring engine.
+
+Tests cover:
+- Vectorized scores matching the per-arm Decimal computation
+- Categories and rankings across H values and grade weights
+- Loading latest grade counts and the safety sweep API endpoint
+"""
+
+from django.test import TestCase
+from django.urls import reverse
+from decimal import Decimal
+from datetime import date
+
+import numpy as np
+
+from omop.models_safety import TrialArm, TrialArmSafetyMetrics
+from omop.safety_engine import (
+    SafetyScoreSweep, load_grade_counts, parse_grade_weights, parse_h_values
+)
+
+
+class SafetyScoreSweepTests(TestCase):
+    """Test SafetyScoreSweep arithmetic."""
+
+    def setUp(self):
+        """Set up grade counts for three arms."""
+        self.arm_ids = [1, 2, 3]
+        # WEB at default weights: 12, 135, 0
+        self.counts = [[2, 1, 0], [5, 3, 1], [0, 0, 0]]
+
+    def test_scores_match_formula(self):
+        """Test safety_score = 100 / (1 + WEB/H) for every arm and H."""
+        sweep = SafetyScoreSweep(self.arm_ids, self.counts, [10, 15, 20])
+
+        self.assertEqual(sweep.scores.shape, (1, 3, 3))
+        np.testing.assert_array_equal(sweep.web[0], [12, 135, 0])
+        for h_index, h in enumerate([10, 15, 20]):
+            for arm_index, web in enumerate([12, 135, 0]):
+                expected = Decimal('100') / (Decimal('1') + Decimal(web) / Decimal(h))
+                self.assertAlmostEqual(
+                    sweep.scores[0, h_index, arm_index], float(expected), places=6
+                )
+
+    def test_categories_and_ranks(self):
+        """Test risk categories and descending-score ranks."""
+        sweep = SafetyScoreSweep(self.arm_ids, self.counts, [15])
+
+        # Scores: 55.56, 10.0, 100.0
+        self.assertEqual(
+            sweep.categories[0, 0].tolist(), ['ELEVATED_RISK', 'HIGH_RISK', 'LOW_RISK']
+        )
+        self.assertEqual(sweep.ranks[0, 0].tolist(), [2, 3, 1])
+
+    def test_alternate_grade_weights(self):
+        """Test that each weighting is evaluated independently."""
+        sweep = SafetyScoreSweep(
+            self.arm_ids, self.counts, [15], [[1, 10, 100], [1, 1, 1]]
+        )
+
+        self.assertEqual(sweep.scores.shape, (2, 1, 3))
+        np.testing.assert_array_equal(sweep.web[1], [3, 9, 0])
+
+    def test_rejects_non_positive_h(self):
+        """Test that H must be positive."""
+        with self.assertRaises(ValueError):
+            SafetyScoreSweep(self.arm_ids, self.counts, [0, 15])
+        for h in (float('nan'), float('inf')):
+            with self.assertRaises(ValueError):
+                SafetyScoreSweep(self.arm_ids, self.counts, [h])
+
+    def test_parse_helpers(self):
+        """Test parsing H lists and weight triples."""
+        self.assertEqual(parse_h_values('10, 15,20'), [10.0, 15.0, 20.0])
+        self.assertEqual(parse_grade_weights('1:10:100,1:5:50'), [[1, 10, 100], [1, 5, 50]])
+        for text in ('1:10', '1:-10:100', '1:nan:100'):
+            with self.assertRaises(ValueError):
+                parse_grade_weights(text)
+
+
+class SafetySweepApiTests(TestCase):
+    """Test loading grade counts and the safety sweep endpoint."""
+
+    def setUp(self):
+        """Set up arms with metric history."""
+        self.arms = []
+        for index, history in enumerate([
+            [(date(2023, 6, 1), 0, 0, 0), (date(2024, 1, 1), 2, 1, 0)],
+            [(date(2024, 1, 1), 0, 0, 1)],
+        ]):
+            arm = TrialArm.objects.create(
+                nct_number='NCT44444444',
+                arm_name=f'Arm {index}',
+                arm_code=f'ARM_{index}',
+                arm_type='EXPERIMENTAL',
+                status='ACTIVE',
+                n_patients=100,
+                follow_up_months=Decimal('12.0')
+            )
+            for data_cut_date, e1_2, e3_4, e5 in history:
+                TrialArmSafetyMetrics.objects.create(
+                    trial_arm=arm,
+                    data_cut_date=data_cut_date,
+                    person_years=Decimal('100.0'),
+                    n_patients=100,
+                    e1_2_count=e1_2,
+                    e3_4_count=e3_4,
+                    e5_count=e5,
+                    web=Decimal(e1_2 + 10 * e3_4 + 100 * e5),
+                    safety_score=Decimal('50.0')
+                )
+            self.arms.append(arm)
+
+    def test_load_grade_counts_uses_latest_metrics(self):
+        """Test that counts come from each arm's latest data cut."""
+        trial_arm_ids, counts = load_grade_counts()
+
+        self.assertEqual(trial_arm_ids.tolist(), [arm.trial_arm_id for arm in self.arms])
+        self.assertEqual(counts.tolist(), [[2, 1, 0], [0, 0, 1]])
+
+    def test_safety_sweep_endpoint(self):
+        """Test the what-if endpoint response."""
+        response = self.client.get(
+            reverse('safety-sweep'), {'h': '10,15', 'weights': '1:10:100,1:5:50'}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['h_values'], [10.0, 15.0])
+        arm = response.data['arms'][0]
+        self.assertEqual(arm['arm_code'], 'ARM_0')
+        self.assertEqual(len(arm['results']), 4)
+        self.assertEqual(arm['results'][1], {
+            'grade_weights': [1.0, 10.0, 100.0],
+            'h': 15.0,
+            'web': 12.0,
+            'safety_score': 55.56,
+            'safety_category': 'ELEVATED_RISK',
+            'rank': 1,
+        })
+
+    def test_safety_sweep_invalid_h(self):
+        """Test that invalid thresholds return 400."""
+        response = self.client.get(reverse('safety-sweep'), {'h': '0'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_safety_sweep_non_finite_h(self):
+        """Test that NaN and infinite thresholds return 400."""
+        for h in ('nan', 'inf', '10,-inf'):
+            response = self.client.get(reverse('safety-sweep'), {'h': h})
+            self.assertEqual(response.status_code, 400, h)
+
+    def test_safety_sweep_invalid_weights(self):
+        """Test that negative and non-finite grade weights return 400."""
+        for weights in ('1:-10:100', '1:nan:100', '1:10:inf'):
+            response = self.client.get(reverse('safety-sweep'), {'weights': weights})
+            self.assertEqual(response.status_code, 400, weights)
@@ -7,18 +7,32 @@ Tests cover:
 - EAIR computation
 - WEB computation
 - Safety score computation
+- Current safety snapshot on TrialArm
+- Set-based aggregation matching the per-arm reference implementation
+- Chunked bulk upsert of computed metrics
+- Partitioning arms across worker processes, and forked workers matching one process
+- Historical data cut backfill, capped at each arm's data cut, with prorated person-years
+- Incremental recomputation of changed arms
 - Edge cases and error handling
 """
 
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
 from django.conf import settings
 from decimal import Decimal
 from datetime import date, timedelta
+from io import StringIO
+import os
+import re
 
 from omop.models import Person
 from omop.models_safety import TrialArm, AdverseEvent, TrialArmSafetyMetrics
-from omop.management.commands.compute_safety_scores import Command
+from omop.management.commands.compute_safety_scores import (
+    Command, EMPTY_AE_COUNTS, _add_months, _compute_partition, parse_data_cuts,
+    partition_trial_arm_ids
+)
 
 
 class SafetyScoreCalculationTests(TestCase):
@@ -523,3 +537,538 @@ class TrialArmSafetyMetricsModelTests(TestCase):
                 safety_score=Decimal('60.0')
             )
 
+
+
+class CurrentSafetySnapshotTests(TestCase):
+    """Test the denormalized current safety snapshot on TrialArm."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.person = Person.objects.create(
+            person_id=7001,
+            gender_concept_id=8507,
+            year_of_birth=1970,
+            month_of_birth=1,
+            day_of_birth=1
+        )
+        self.trial_arm = TrialArm.objects.create(
+            nct_number='NCT55555555',
+            arm_name='Snapshot Arm',
+            arm_code='SNAP_ARM',
+            arm_type='EXPERIMENTAL',
+            status='ACTIVE',
+            enrollment_start_date=date(2023, 1, 1),
+            last_data_cut=date(2024, 1, 1),
+            n_patients=100,
+            follow_up_months=Decimal('12.0')
+        )
+
+    def create_metrics(self, data_cut_date, safety_score):
+        """Create a metrics row with the given data cut and score."""
+        return TrialArmSafetyMetrics.objects.create(
+            trial_arm=self.trial_arm,
+            data_cut_date=data_cut_date,
+            person_years=Decimal('100.0'),
+            n_patients=100,
+            eair=Decimal('0.05'),
+            web=Decimal('12.0'),
+            safety_score=Decimal(safety_score)
+        )
+
+    def test_command_writes_current_snapshot(self):
+        """Test that compute_safety_scores updates the snapshot columns."""
+        AdverseEvent.objects.create(
+            person=self.person,
+            trial_arm=self.trial_arm,
+            event_name='Neutropenia',
+            event_date=date(2023, 6, 1),
+            grade=3
+        )
+
+        call_command('compute_safety_scores', force=True, verbosity=0)
+
+        self.trial_arm.refresh_from_db()
+        metrics = TrialArmSafetyMetrics.objects.get(trial_arm=self.trial_arm)
+        self.assertEqual(self.trial_arm.current_data_cut_date, date(2024, 1, 1))
+        self.assertEqual(self.trial_arm.current_safety_score, metrics.safety_score)
+        self.assertEqual(self.trial_arm.current_web, Decimal('10'))
+        self.assertEqual(self.trial_arm.current_eair, metrics.eair)
+        self.assertEqual(self.trial_arm.current_safety_category, 'MODERATE_RISK')
+
+    def test_refresh_uses_latest_data_cut(self):
+        """Test that the snapshot follows data_cut_date, not insertion order."""
+        self.create_metrics(date(2024, 1, 1), '55.00')
+        self.create_metrics(date(2023, 6, 1), '90.00')
+
+        TrialArm.objects.filter(pk=self.trial_arm.pk).refresh_current_safety()
+
+        self.trial_arm.refresh_from_db()
+        self.assertEqual(self.trial_arm.current_data_cut_date, date(2024, 1, 1))
+        self.assertEqual(self.trial_arm.current_safety_score, Decimal('55.00'))
+        self.assertEqual(self.trial_arm.current_safety_category, 'ELEVATED_RISK')
+
+    def test_refresh_without_metrics(self):
+        """Test that arms without metrics have an empty snapshot."""
+        TrialArm.objects.filter(pk=self.trial_arm.pk).refresh_current_safety()
+
+        self.trial_arm.refresh_from_db()
+        self.assertIsNone(self.trial_arm.current_safety_score)
+        self.assertEqual(self.trial_arm.current_safety_category, '')
+
+
+class AggregationDataMixin:
+    """Arms with different data cuts and overlapping patients."""
+
+    def setUp(self):
+        """Set up arms with different data cuts and overlapping patients."""
+        self.persons = [
+            Person.objects.create(
+                person_id=8000 + i,
+                gender_concept_id=8507,
+                year_of_birth=1970,
+                month_of_birth=1,
+                day_of_birth=1
+            )
+            for i in range(6)
+        ]
+        self.arm_a = TrialArm.objects.create(
+            nct_number='NCT77777777',
+            arm_name='Arm A',
+            arm_code='ARM_A',
+            arm_type='EXPERIMENTAL',
+            status='ACTIVE',
+            enrollment_start_date=date(2023, 1, 1),
+            last_data_cut=date(2024, 1, 1),
+            n_patients=60,
+            follow_up_months=Decimal('10.0')
+        )
+        self.arm_b = TrialArm.objects.create(
+            nct_number='NCT77777777',
+            arm_name='Arm B',
+            arm_code='ARM_B',
+            arm_type='ACTIVE_COMPARATOR',
+            status='COMPLETED',
+            enrollment_start_date=date(2023, 1, 1),
+            last_data_cut=date(2023, 9, 1),
+            n_patients=40,
+            follow_up_months=None
+        )
+        self.arm_empty = TrialArm.objects.create(
+            nct_number='NCT77777777',
+            arm_name='Arm C',
+            arm_code='ARM_C',
+            arm_type='PLACEBO_COMPARATOR',
+            status='ACTIVE',
+            enrollment_start_date=date(2023, 1, 1),
+            last_data_cut=date(2024, 1, 1),
+            n_patients=20,
+            follow_up_months=Decimal('12.0')
+        )
+
+        events = [
+            (self.arm_a, 0, 1, date(2023, 3, 1)),
+            (self.arm_a, 0, 2, date(2023, 4, 1)),
+            (self.arm_a, 0, 4, date(2023, 5, 1)),
+            (self.arm_a, 1, 3, date(2023, 6, 1)),
+            (self.arm_a, 2, 5, date(2023, 7, 1)),
+            (self.arm_a, 3, 3, date(2024, 3, 1)),  # after arm A data cut
+            (self.arm_b, 3, 2, date(2023, 2, 1)),
+            (self.arm_b, 4, 3, date(2023, 8, 1)),
+            (self.arm_b, 5, 5, date(2023, 10, 1)),  # after arm B data cut
+        ]
+        for arm, person_index, grade, event_date in events:
+            AdverseEvent.objects.create(
+                person=self.persons[person_index],
+                trial_arm=arm,
+                event_name=f'Grade {grade} event',
+                event_date=event_date,
+                grade=grade
+            )
+
+
+
+class SetBasedAggregationTests(AggregationDataMixin, TestCase):
+    """Test that the GROUP BY aggregation matches compute_metrics_for_arm."""
+
+    def test_aggregate_matches_reference(self):
+        """Test grouped counts against the per-arm Python implementation."""
+        command = Command()
+        arms = [self.arm_a, self.arm_b, self.arm_empty]
+        today = timezone.now().date()
+
+        with self.assertNumQueries(1):
+            ae_counts = command.aggregate_ae_counts(arms, today)
+
+        self.assertNotIn(self.arm_empty.trial_arm_id, ae_counts)
+        for arm in arms:
+            reference = command.compute_metrics_for_arm(arm, Decimal('15.0'), verbosity=0)
+            metrics = command.build_metrics(
+                arm,
+                arm.last_data_cut,
+                ae_counts.get(arm.trial_arm_id, EMPTY_AE_COUNTS),
+                Decimal('15.0'),
+            )
+            self.assertEqual(metrics, reference)
+
+    def test_command_persists_grouped_counts(self):
+        """Test that the command stores the grouped counts for every arm."""
+        call_command('compute_safety_scores', force=True, verbosity=0)
+
+        metrics_a = TrialArmSafetyMetrics.objects.get(trial_arm=self.arm_a)
+        self.assertEqual(metrics_a.e1_2_count, 1)
+        self.assertEqual(metrics_a.e3_4_count, 2)
+        self.assertEqual(metrics_a.e5_count, 1)
+        self.assertEqual(metrics_a.patients_with_any_ae, 3)
+        self.assertEqual(metrics_a.total_ae_count, 5)
+
+        metrics_b = TrialArmSafetyMetrics.objects.get(trial_arm=self.arm_b)
+        self.assertEqual(metrics_b.total_ae_count, 2)
+        self.assertEqual(metrics_b.e5_count, 0)
+
+        metrics_empty = TrialArmSafetyMetrics.objects.get(trial_arm=self.arm_empty)
+        self.assertEqual(metrics_empty.safety_score, Decimal('100'))
+
+    def test_command_updates_existing_rows(self):
+        """Test that rerunning the command upserts instead of duplicating."""
+        call_command('compute_safety_scores', force=True, verbosity=0)
+        AdverseEvent.objects.create(
+            person=self.persons[5],
+            trial_arm=self.arm_empty,
+            event_name='Grade 3 event',
+            event_date=date(2023, 6, 1),
+            grade=3
+        )
+        call_command('compute_safety_scores', force=True, verbosity=0)
+
+        self.assertEqual(TrialArmSafetyMetrics.objects.count(), 3)
+        metrics_empty = TrialArmSafetyMetrics.objects.get(trial_arm=self.arm_empty)
+        self.assertEqual(metrics_empty.e3_4_count, 1)
+        self.arm_empty.refresh_from_db()
+        self.assertEqual(self.arm_empty.current_safety_score, metrics_empty.safety_score)
+
+    def test_command_chunked_upsert(self):
+        """Test that small chunks write every row in one run."""
+        out = StringIO()
+        call_command('compute_safety_scores', force=True, chunk_size=1, stdout=out)
+
+        self.assertEqual(TrialArmSafetyMetrics.objects.count(), 3)
+        self.assertIn('Saved 3 row(s)', out.getvalue())
+        self.assertIn('(chunk size 1)', out.getvalue())
+
+    def test_command_rejects_invalid_chunk_size(self):
+        """Test that a non-positive chunk size is rejected."""
+        with self.assertRaises(CommandError):
+            call_command('compute_safety_scores', force=True, chunk_size=0, verbosity=0)
+
+    def test_compute_partition_matches_inline(self):
+        """Test that a worker partition computes the same rows as the inline path."""
+        arms = [self.arm_a, self.arm_b, self.arm_empty]
+        today = timezone.now().date()
+        inline_metrics, inline_errors = Command().compute_metrics_for_arms(
+            arms, Decimal('15.0'), today
+        )
+
+        result = _compute_partition(
+            [arm.trial_arm_id for arm in arms], Decimal('15.0'), today
+        )
+
+        self.assertEqual(result['n_arms'], 3)
+        self.assertEqual(result['errors'], inline_errors)
+        self.assertEqual(result['computed_metrics'], inline_metrics)
+
+    def test_command_rejects_invalid_workers(self):
+        """Test that a non-positive worker count is rejected."""
+        with self.assertRaises(CommandError):
+            call_command('compute_safety_scores', force=True, workers=0, verbosity=0)
+
+    def test_sweep_matches_aggregate_at_each_cut(self):
+        """Test the cumulative sweep against per-cut aggregate queries."""
+        command = Command()
+        arms = [self.arm_a, self.arm_b, self.arm_empty]
+        cut_dates = parse_data_cuts('2023-01-01:2024-06-01:quarterly')
+
+        with self.assertNumQueries(1):
+            counts_by_cut = command.sweep_ae_counts(arms, cut_dates)
+
+        self.assertEqual(sorted(counts_by_cut), cut_dates)
+        for cut_date in cut_dates:
+            TrialArm.objects.update(last_data_cut=cut_date)
+            self.assertEqual(
+                counts_by_cut[cut_date],
+                command.aggregate_ae_counts(arms, cut_date)
+            )
+
+    def test_command_backfills_data_cuts(self):
+        """Test that --data-cuts writes one row per arm and cut date."""
+        TrialArm.objects.filter(pk=self.arm_b.pk).update(
+            enrollment_start_date=date(2023, 3, 1)
+        )
+
+        call_command(
+            'compute_safety_scores',
+            data_cuts='2023-01-01:2023-06-01:monthly',
+            verbosity=0
+        )
+
+        # Arm A enrolled on 2023-01-01, so the first cut is skipped
+        self.assertEqual(
+            TrialArmSafetyMetrics.objects.filter(trial_arm=self.arm_a).count(), 5
+        )
+        # Arm B is skipped up to and including its enrollment start
+        self.assertEqual(
+            list(
+                TrialArmSafetyMetrics.objects.filter(trial_arm=self.arm_b)
+                .order_by('data_cut_date').values_list('data_cut_date', flat=True)
+            ),
+            [date(2023, 4, 1), date(2023, 5, 1), date(2023, 6, 1)]
+        )
+        metrics = TrialArmSafetyMetrics.objects.get(
+            trial_arm=self.arm_a, data_cut_date=date(2023, 4, 1)
+        )
+        self.assertEqual(metrics.total_ae_count, 2)
+        self.assertEqual(metrics.e1_2_count, 1)
+
+        self.arm_a.refresh_from_db()
+        self.assertEqual(self.arm_a.current_data_cut_date, date(2023, 6, 1))
+
+    def test_backfill_stops_at_arm_data_cut(self):
+        """Test that cuts after last_data_cut or today are dropped and current_* is kept."""
+        call_command('compute_safety_scores', trial_arm_id=self.arm_a.pk, force=True, verbosity=0)
+        self.arm_a.refresh_from_db()
+        snapshot = (
+            self.arm_a.current_data_cut_date, self.arm_a.current_safety_score,
+            self.arm_a.current_web, self.arm_a.current_eair
+        )
+        future_cut = _add_months(timezone.now().date(), 6).isoformat()
+
+        call_command(
+            'compute_safety_scores', trial_arm_id=self.arm_a.pk,
+            data_cuts=f'2023-10-01:{future_cut}:quarterly', stdout=StringIO()
+        )
+
+        self.assertEqual(
+            list(
+                TrialArmSafetyMetrics.objects.filter(trial_arm=self.arm_a)
+                .order_by('data_cut_date').values_list('data_cut_date', flat=True)
+            ),
+            [date(2023, 10, 1), date(2024, 1, 1)]
+        )
+        self.arm_a.refresh_from_db()
+        self.assertEqual(
+            (
+                self.arm_a.current_data_cut_date, self.arm_a.current_safety_score,
+                self.arm_a.current_web, self.arm_a.current_eair
+            ),
+            snapshot
+        )
+
+    def test_backfill_prorates_person_years(self):
+        """Test that earlier cuts count only the follow-up accrued by then."""
+        call_command(
+            'compute_safety_scores', trial_arm_id=self.arm_a.pk,
+            data_cuts='2023-08-01:2024-01-01:monthly', verbosity=0
+        )
+
+        rows = list(
+            TrialArmSafetyMetrics.objects.filter(trial_arm=self.arm_a)
+            .order_by('data_cut_date')
+        )
+        person_years = [row.person_years for row in rows]
+        eairs = [row.eair for row in rows]
+        # Arm A has the same 3 patients with events at every cut
+        self.assertEqual({row.patients_with_any_ae for row in rows}, {3})
+        self.assertEqual(person_years, sorted(set(person_years)))
+        self.assertEqual(eairs, sorted(set(eairs), reverse=True))
+        # At its own data cut the arm's full follow-up is counted
+        self.assertEqual(person_years[-1], Decimal('50.00'))
+        self.assertEqual(
+            person_years[0],
+            (Decimal('50') * Decimal(212) / Decimal(365)).quantize(Decimal('0.01'))
+        )
+
+    def test_command_sweep_h_reports_without_saving(self):
+        """Test that --sweep-h prints per-H scores and saves nothing."""
+        out = StringIO()
+        call_command('compute_safety_scores', sweep_h='10,20', stdout=out)
+
+        self.assertIn('H=10', out.getvalue())
+        self.assertIn('H=20', out.getvalue())
+        self.assertIn('No data was saved', out.getvalue())
+        self.assertEqual(TrialArmSafetyMetrics.objects.count(), 0)
+
+
+class ParallelComputeTests(AggregationDataMixin, TransactionTestCase):
+    """Run compute_safety_scores --workers in forked processes against the test database."""
+
+    METRIC_FIELDS = [
+        'trial_arm_id', 'data_cut_date', 'person_years', 'e1_2_count', 'e3_4_count',
+        'e5_count', 'patients_with_any_ae', 'eair', 'web', 'safety_score',
+    ]
+
+    def setUp(self):
+        """Add an arm that cannot be computed, so one partition reports an error."""
+        super().setUp()
+        TrialArm.objects.create(
+            nct_number='NCT77777777',
+            arm_name='Arm D',
+            arm_code='ARM_D',
+            arm_type='EXPERIMENTAL',
+            status='ACTIVE',
+            n_patients=10,
+        )
+
+    def run_command(self, workers):
+        """Run the command from scratch; return its output and the stored metrics."""
+        TrialArmSafetyMetrics.objects.all().delete()
+        out = StringIO()
+        call_command('compute_safety_scores', force=True, workers=workers, stdout=out)
+        metrics = list(
+            TrialArmSafetyMetrics.objects.order_by('trial_arm_id', 'data_cut_date')
+            .values_list(*self.METRIC_FIELDS)
+        )
+        return out.getvalue(), metrics
+
+    def test_workers_match_inline(self):
+        """Test that two worker processes store the same rows and errors as one process."""
+        inline_output, inline_metrics = self.run_command(1)
+        parallel_output, parallel_metrics = self.run_command(2)
+
+        self.assertEqual(len(inline_metrics), 3)
+        self.assertEqual(parallel_metrics, inline_metrics)
+        workers = re.findall(r'^Worker (\d+):', parallel_output, re.MULTILINE)
+        self.assertEqual(len(workers), 2)
+        self.assertNotIn(str(os.getpid()), workers)
+        for output in (inline_output, parallel_output):
+            self.assertIn('Error computing metrics for ARM_D', output)
+            self.assertIn('Errors: 1', output)
+
+
+class ChangedOnlyRecomputationTests(TestCase):
+    """Test TrialArm.objects.needs_safety_recompute() and --changed-only."""
+
+    def setUp(self):
+        """Set up two computed arms."""
+        self.person = Person.objects.create(
+            person_id=9001,
+            gender_concept_id=8507,
+            year_of_birth=1970,
+            month_of_birth=1,
+            day_of_birth=1
+        )
+        self.arms = [
+            TrialArm.objects.create(
+                nct_number='NCT66666666',
+                arm_name=f'Arm {code}',
+                arm_code=code,
+                arm_type='EXPERIMENTAL',
+                status='ACTIVE',
+                enrollment_start_date=date(2023, 1, 1),
+                last_data_cut=date(2024, 1, 1),
+                n_patients=50,
+                follow_up_months=Decimal('12.0')
+            )
+            for code in ['ARM_A', 'ARM_B']
+        ]
+        self.event = AdverseEvent.objects.create(
+            person=self.person,
+            trial_arm=self.arms[0],
+            event_name='Fatigue',
+            event_date=date(2023, 6, 1),
+            grade=1
+        )
+        call_command('compute_safety_scores', force=True, verbosity=0)
+
+    def stale_arm_ids(self):
+        """IDs of arms currently flagged for recomputation."""
+        return set(
+            TrialArm.objects.needs_safety_recompute().values_list('trial_arm_id', flat=True)
+        )
+
+    def test_up_to_date_arms_are_skipped(self):
+        """Test that freshly computed arms are not stale."""
+        self.assertEqual(self.stale_arm_ids(), set())
+
+    def test_new_arm_is_stale(self):
+        """Test that arms without metrics are stale."""
+        arm = TrialArm.objects.create(
+            nct_number='NCT66666666',
+            arm_name='Arm C',
+            arm_code='ARM_C',
+            arm_type='EXPERIMENTAL',
+            n_patients=10,
+            follow_up_months=Decimal('6.0')
+        )
+        self.assertEqual(self.stale_arm_ids(), {arm.trial_arm_id})
+
+    def test_adverse_event_change_marks_arm_stale(self):
+        """Test that saving an AE marks only its arm stale."""
+        self.event.grade = 3
+        self.event.save()
+        self.assertEqual(self.stale_arm_ids(), {self.arms[0].trial_arm_id})
+
+    def test_adverse_event_delete_marks_arm_stale(self):
+        """Test that removing an AE is detected through the stored total."""
+        self.event.delete()
+        self.assertEqual(self.stale_arm_ids(), {self.arms[0].trial_arm_id})
+
+    def test_arm_change_marks_arm_stale(self):
+        """Test that editing enrollment fields marks the arm stale."""
+        self.arms[1].n_patients = 80
+        self.arms[1].save()
+        self.assertEqual(self.stale_arm_ids(), {self.arms[1].trial_arm_id})
+
+    def test_command_recomputes_changed_arms_only(self):
+        """Test that --changed-only recomputes just the stale arms."""
+        AdverseEvent.objects.create(
+            person=self.person,
+            trial_arm=self.arms[1],
+            event_name='Neutropenia',
+            event_date=date(2023, 7, 1),
+            grade=3
+        )
+        out = StringIO()
+        call_command('compute_safety_scores', changed_only=True, stdout=out)
+
+        self.assertIn('Found 1 trial arm(s) to process', out.getvalue())
+        self.assertEqual(
+            TrialArmSafetyMetrics.objects.get(trial_arm=self.arms[1]).e3_4_count, 1
+        )
+        self.assertEqual(self.stale_arm_ids(), set())
+
+
+class ParseDataCutsTests(TestCase):
+    """Test parsing of --data-cuts specs."""
+
+    def test_monthly_clamps_to_month_end(self):
+        """Test that month stepping keeps the day where the month allows."""
+        self.assertEqual(
+            parse_data_cuts('2024-01-31:2024-04-30:monthly'),
+            [date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31), date(2024, 4, 30)]
+        )
+
+    def test_weekly(self):
+        """Test weekly stepping includes the end date when it lands on a step."""
+        self.assertEqual(
+            parse_data_cuts('2024-01-01:2024-01-15:weekly'),
+            [date(2024, 1, 1), date(2024, 1, 8), date(2024, 1, 15)]
+        )
+
+    def test_invalid_specs(self):
+        """Test that malformed specs raise CommandError."""
+        for spec in ['2024-01-01:2024-06-01', '2024-01-01:2024-06-01:daily',
+                     '2024-06-01:2024-01-01:monthly', 'jan:feb:monthly']:
+            with self.assertRaises(CommandError):
+                parse_data_cuts(spec)
+
+
+class PartitionTrialArmIdsTests(TestCase):
+    """Test splitting trial arms across worker processes."""
+
+    def test_even_split(self):
+        """Test contiguous partitions covering every ID once."""
+        partitions = partition_trial_arm_ids(list(range(10)), 3)
+        self.assertEqual(partitions, [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]])
+
+    def test_more_workers_than_arms(self):
+        """Test that empty partitions are dropped."""
+        self.assertEqual(partition_trial_arm_ids([1, 2], 4), [[1], [2]])
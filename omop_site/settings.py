@@ -75,6 +75,11 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            'TEST': {
+                # A file rather than in-memory, so --workers processes forked
+                # by the commands under test open the same database
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
         }
     }
 
@@ -91,3 +96,7 @@ MIDDLEWARE.insert(1, "whitenoise.middleware.WhiteNoiseMiddleware")
 
 # Safety Scoring Configuration
 SAFETY_WEB_THRESHOLD = float(os.environ.get("SAFETY_WEB_THRESHOLD", "15.0"))
+
+# PatientInfo Population
+# Directory for populate_patient_info checkpoint files
+PATIENT_INFO_CHECKPOINT_DIR = os.environ.get("PATIENT_INFO_CHECKPOINT_DIR", str(BASE_DIR / "checkpoints"))